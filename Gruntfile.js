@@ -44,6 +44,7 @@ module.exports = function(grunt) {
           'ckanext/unhcr/src/js/geographies.js',
           'ckanext/unhcr/src/js/activities-list.js',
           'ckanext/unhcr/src/js/requests-history-list.js',
+          'ckanext/unhcr/src/js/search-index.js',
         ],
         dest: 'ckanext/unhcr/fanstatic/theme.js',
       },
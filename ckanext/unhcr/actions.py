@@ -4,9 +4,8 @@ import datetime
 import json
 import logging
 import requests
-from urllib.parse import urljoin
 from dateutil.parser import parse as parse_date
-from sqlalchemy import and_, desc, or_, select, not_, text
+from sqlalchemy import and_, desc, func, or_, select, not_, text, tuple_
 from sqlalchemy.dialects.postgresql import array
 from sqlalchemy.orm import aliased
 from ckan import model
@@ -15,11 +14,22 @@ from ckan.plugins import toolkit
 from ckan.lib import mailer as core_mailer
 from ckan.lib.mailer import MailerException
 import ckan.lib.plugins as lib_plugins
-from ckan.lib.search import index_for, commit
 import ckan.logic as core_logic
 import ckan.lib.dictization.model_dictize as model_dictize
-from ckanext.unhcr import helpers, mailer, utils
-from ckanext.unhcr.jobs import process_last_admin_on_delete, update_kobo_resource
+from ckanext.scheming.helpers import scheming_get_organization_schema
+from ckanext.unhcr.activity import get_download_buffer
+from ckanext.unhcr import (
+    clamav, container_tree, download_auth, helpers, mailer, pending_requests, scan_status,
+    search_index, utils
+)
+from ckanext.unhcr.cache import TieredCache
+from ckanext.unhcr.permission_labels import invalidate_user_labels
+from ckanext.unhcr.jobs import (
+    process_last_admin_on_delete,
+    rebuild_search_index_chunk,
+    update_kobo_resource,
+)
+from ckanext.unhcr.kobo import export_poller
 from ckanext.unhcr.kobo.api import KoBoAPI, KoBoSurvey
 from ckanext.unhcr.kobo.exceptions import (
     KoboApiError,
@@ -30,7 +40,7 @@ from ckanext.unhcr.kobo.kobo_dataset import KoboDataset
 from ckanext.unhcr.models import (
     AccessRequest, Geography, GisStatus, LAYER_TO_DISPLAY_NAME,
     USER_REQUEST_TYPE_NEW, USER_REQUEST_TYPE_RENEWAL,
-    DEFAULT_GEOGRAPHY_CODE
+    DEFAULT_GEOGRAPHY_CODE, get_geography_cache
 )
 from ckanext.unhcr.utils import is_saml2_user
 
@@ -278,6 +288,7 @@ def package_collaborator_create(up_func, context, data_dict):
         raise toolkit.ValidationError({'message': message}, error_summary=message)
 
     collaborator = up_func(context, data_dict)
+    invalidate_user_labels()
 
     mailer.mail_notification_to_collaborator(
         collaborator['package_id'],
@@ -292,6 +303,7 @@ def package_collaborator_create(up_func, context, data_dict):
 @toolkit.chained_action
 def package_collaborator_delete(up_func, context, data_dict):
     up_func(context, data_dict)
+    invalidate_user_labels()
 
     mailer.mail_notification_to_collaborator(
         data_dict['id'],
@@ -311,6 +323,9 @@ def organization_create(up_func, context, data_dict):
     # created as pending, and sysadmins notified
 
     org_dict = up_func(context, data_dict)
+    # The creator (and any user in data_dict['users']) is now a member
+    invalidate_user_labels()
+    _invalidate_organization_caches()
 
     # We create an organization as usual because we can't set
     # state=approval_needed on creation step and then
@@ -344,6 +359,31 @@ def organization_create(up_func, context, data_dict):
     return org_dict
 
 
+@toolkit.chained_action
+def organization_update(up_func, context, data_dict):
+    org_dict = up_func(context, data_dict)
+    # The parent, name or title of the container may have changed
+    _invalidate_organization_caches()
+    return org_dict
+
+
+@toolkit.chained_action
+def organization_delete(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    _invalidate_organization_caches()
+    return result
+
+
+@toolkit.chained_action
+def organization_purge(up_func, context, data_dict):
+    # e.g. a rejected data container request
+    result = up_func(context, data_dict)
+    # the members of the container lose its labels
+    invalidate_user_labels()
+    _invalidate_organization_caches()
+    return result
+
+
 @toolkit.chained_action
 def organization_member_create(up_func, context, data_dict):
 
@@ -369,7 +409,13 @@ def organization_member_create(up_func, context, data_dict):
         body = mailer.compose_membership_email_body(container, user, 'create', extra_mail_msg)
         mailer.mail_user_by_id(user['id'], subj, body)
 
-    return up_func(context, data_dict)
+    member = up_func(context, data_dict)
+    invalidate_user_labels()
+    container_tree.invalidate()
+    download_auth.invalidate_curators()
+    pending_requests.invalidate()
+
+    return member
 
 
 @toolkit.chained_action
@@ -386,7 +432,39 @@ def organization_member_delete(up_func, context, data_dict):
         body = mailer.compose_membership_email_body(container, user, 'delete')
         mailer.mail_user_by_id(user['id'], subj, body)
 
-    return up_func(context, data_dict)
+    result = up_func(context, data_dict)
+    invalidate_user_labels()
+    container_tree.invalidate()
+    download_auth.invalidate_curators()
+    pending_requests.invalidate()
+
+    return result
+
+
+@toolkit.chained_action
+def member_create(up_func, context, data_dict):
+    # group_member_create and organization_member_create end up here too
+    member = up_func(context, data_dict)
+    _invalidate_membership_caches(data_dict.get('object_type'))
+    return member
+
+
+@toolkit.chained_action
+def member_delete(up_func, context, data_dict):
+    # group_member_delete and organization_member_delete end up here too
+    result = up_func(context, data_dict)
+    _invalidate_membership_caches(data_dict.get('object_type'))
+    return result
+
+
+def _invalidate_membership_caches(object_type):
+    if object_type == 'user':
+        invalidate_user_labels()
+        download_auth.invalidate_curators()
+    if object_type in ('user', 'group'):
+        # users and sub-containers are both part of the container tree
+        container_tree.invalidate()
+        pending_requests.invalidate()
 
 
 def organization_list_all_fields(context, data_dict):
@@ -397,16 +475,34 @@ def organization_list_all_fields(context, data_dict):
     with {'all_fields': True, 'include_extras': True}
     but it only allows a much more constrained list of params.
 
+    Results are cached until an organization is created, updated or deleted.
+
     :param type: group type (optional, default: ``'data-container'``)
     :type type: string
     :param order_by: the field to sort the list by (optional, default: ``'title'``)
     :type order_by: string
+    :param fields: only return these fields (plus ``id``, ``name``, ``title``
+        and ``display_name``). The extras are not validated, only converted
+        to the type the schema outputs (optional, default: all the fields)
+    :type fields: list of strings
     """
     toolkit.check_access('organization_list_all_fields', context, data_dict)
     m = context.get('model', model)
     session = context.get('session', m.Session)
     group_type = data_dict.get('type', 'data-container')
     order_by = data_dict.get('order_by', 'title')
+    fields = data_dict.get('fields')
+    if isinstance(fields, str):
+        fields = toolkit.aslist(fields, ',')
+    if fields is not None:
+        fields = sorted((set(fields) - {'display_name'}) | {'id', 'name', 'title'})
+
+    cache = _get_organization_list_cache()
+    cache_key = json.dumps([group_type, order_by, fields])
+    cached = cache.get(cache_key)
+    if cached is not None:
+        # callers are free to modify the list
+        return copy.deepcopy(cached)
 
     extra_cols = [rec[0] for rec in session.query(m.GroupExtra.key).distinct()]
     group_table = m.meta.metadata.tables['group']
@@ -414,19 +510,37 @@ def organization_list_all_fields(context, data_dict):
     allowed_cols = [col.key for col in group_table.columns] + extra_cols
     if order_by not in allowed_cols:
         raise toolkit.Invalid("'order_by' must be one of {}".format(allowed_cols))
+    if fields is not None:
+        invalid = [field for field in fields if field not in allowed_cols]
+        if invalid:
+            raise toolkit.Invalid("'fields' must be in {}".format(allowed_cols))
+        select_extras = [col for col in extra_cols if col in fields or col == order_by]
+        select_cols = [col for col in group_table.columns if col.key in fields]
+    else:
+        select_extras = extra_cols
+        select_cols = [col for col in group_table.columns]
 
+    # Pivot the active extras into one row per group (instead of one join per key)
     join_obj = group_table
-    select_cols = [col for col in group_table.columns]
-    for col in extra_cols:
-        extras_alias = aliased(group_extra_table, name='extras_{}'.format(col))
-        select_cols.append(extras_alias.c.value.label(col))
-        join_obj = join_obj.join(
-            extras_alias,
+    if select_extras:
+        extras = select(
+            [group_extra_table.c.group_id] + [
+                func.max(group_extra_table.c.value).filter(
+                    group_extra_table.c.key == col
+                ).label(col)
+                for col in select_extras
+            ]
+        ).where(
             and_(
-                group_table.c.id==extras_alias.c.group_id,
-                extras_alias.c.key==col,
-                extras_alias.c.state=='active',
-            ), isouter=True,
+                group_extra_table.c.state == 'active',
+                group_extra_table.c.key.in_(select_extras),
+            )
+        ).group_by(
+            group_extra_table.c.group_id
+        ).alias('extras')
+        select_cols += [extras.c[col] for col in select_extras]
+        join_obj = join_obj.join(
+            extras, group_table.c.id == extras.c.group_id, isouter=True
         )
 
     sql = select(
@@ -445,25 +559,86 @@ def organization_list_all_fields(context, data_dict):
     result = session.execute(sql).fetchall()
 
     organization_plugin = lib_plugins.lookup_group_plugin(group_type)
-    schema = organization_plugin.form_to_db_schema()
 
     out_list = []
-    for row in result:
-        raw_dict = {k:v for k,v in row.items()}
-        validated_dict, errors = organization_plugin.validate(
-            context,
-            raw_dict,
-            schema,
-            'organization_show'
-        )
-        if errors:
-            raise toolkit.ValidationError(errors)
-        validated_dict['display_name'] = validated_dict['title'] or validated_dict['name']
-        out_list.append(validated_dict)
+    if fields is None:
+        schema = organization_plugin.form_to_db_schema()
+        for row in result:
+            raw_dict = {k:v for k,v in row.items()}
+            validated_dict, errors = organization_plugin.validate(
+                context,
+                raw_dict,
+                schema,
+                'organization_show'
+            )
+            if errors:
+                raise toolkit.ValidationError(errors)
+            out_list.append(validated_dict)
+    else:
+        converters = _get_organization_field_converters(group_type)
+        for row in result:
+            out_dict = {}
+            for key, value in row.items():
+                if key not in fields:
+                    continue
+                if key in converters and value is not None:
+                    value = converters[key](value)
+                out_dict[key] = value
+            out_list.append(out_dict)
+
+    for org_dict in out_list:
+        org_dict['display_name'] = org_dict['title'] or org_dict['name']
+        if isinstance(org_dict.get('created'), datetime.datetime):
+            org_dict['created'] = org_dict['created'].isoformat()
+
+    cache.set(cache_key, copy.deepcopy(out_list))
 
     return out_list
 
 
+_organization_list_cache = None
+def _get_organization_list_cache():
+    global _organization_list_cache
+    if _organization_list_cache is None:
+        _organization_list_cache = TieredCache(
+            'organization-list',
+            max_size=100,
+            ttl=toolkit.asint(
+                toolkit.config.get('ckanext.unhcr.organization_list_cache_seconds', 3600)
+            ),
+            generation_check_seconds=0,
+        )
+    return _organization_list_cache
+
+
+def _invalidate_organization_caches():
+    _get_organization_list_cache().invalidate()
+    container_tree.invalidate()
+    download_auth.invalidate_curators()
+    # containers waiting for approval are pending requests
+    pending_requests.invalidate()
+
+
+def _get_organization_field_converters(group_type):
+    # Light version of the output validation, for the fields parameter
+    converters = {}
+    schema = scheming_get_organization_schema(group_type) or {}
+    for field in schema.get('fields', []):
+        output_validators = field.get('output_validators', '')
+        if field.get('preset') == 'multiple_select':
+            converters[field['field_name']] = _multiple_select_output
+        elif 'boolean_validator' in output_validators:
+            converters[field['field_name']] = toolkit.asbool
+    return converters
+
+
+def _multiple_select_output(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return [value]
+
+
 # Pending requests
 
 def container_request_list(context, data_dict):
@@ -473,18 +648,15 @@ def container_request_list(context, data_dict):
     toolkit.check_access('sysadmin', context)
 
     # Containers
-    containers = []
     query = (model.Session
-        .query(model.Group.id)
+        .query(model.Group)
         .filter(model.Group.state == 'approval_needed')
         .filter(model.Group.is_organization == True)
         .order_by(model.Group.name))
-    for item in query.all():
-        if all_fields:
-            container = toolkit.get_action('organization_show')(context, {'id': item.id})
-        else:
-            container = item.id
-        containers.append(container)
+    if all_fields:
+        containers = _dictize_container_requests(query.all())
+    else:
+        containers = [item.id for item in query.with_entities(model.Group.id).all()]
 
     return {
         'containers': containers,
@@ -492,6 +664,71 @@ def container_request_list(context, data_dict):
     }
 
 
+def _dictize_container_requests(groups):
+    """
+    Lightweight version of organization_show for the pending containers:
+    the members (`users`) and parent containers (`groups`) are loaded with
+    one query each instead of a full dictization per container
+    """
+    if not groups:
+        return []
+    group_ids = [group.id for group in groups]
+
+    users = {}
+    query = (model.Session
+        .query(model.Member.group_id, model.Member.capacity, model.User)
+        .join(model.User, model.User.id == model.Member.table_id)
+        .filter(model.Member.group_id.in_(group_ids))
+        .filter(model.Member.table_name == 'user')
+        .filter(model.Member.state == 'active')
+        .order_by(model.User.name))
+    for group_id, capacity, user in query.all():
+        users.setdefault(group_id, []).append({
+            'id': user.id,
+            'name': user.name,
+            'fullname': user.fullname,
+            'display_name': user.display_name,
+            'email': user.email,
+            'capacity': capacity,
+        })
+
+    # A parent container is stored as Member(group_id=parent, table_id=child)
+    parent_groups = {}
+    parent_group = aliased(model.Group)
+    query = (model.Session
+        .query(model.Member.table_id, model.Member.capacity, parent_group)
+        .join(parent_group, parent_group.id == model.Member.group_id)
+        .filter(model.Member.table_id.in_(group_ids))
+        .filter(model.Member.table_name == 'group')
+        .filter(model.Member.state == 'active')
+        .order_by(parent_group.name))
+    for group_id, capacity, group in query.all():
+        parent_groups.setdefault(group_id, []).append({
+            'id': group.id,
+            'name': group.name,
+            'title': group.title,
+            'display_name': group.title or group.name,
+            'capacity': capacity,
+        })
+
+    return [
+        {
+            'id': group.id,
+            'name': group.name,
+            'title': group.title,
+            'display_name': group.title or group.name,
+            'type': group.type,
+            'state': group.state,
+            'notes': group.description,
+            'image_url': group.image_url,
+            'created': group.created.isoformat() if group.created else None,
+            'users': users.get(group.id, []),
+            'groups': parent_groups.get(group.id, []),
+        }
+        for group in groups
+    ]
+
+
 # Activity
 
 def _package_activity_list(
@@ -586,6 +823,16 @@ def organization_activity_list(up_func, context, data_dict):
     return _remove_internal_activities(up_func(context.copy(), data_dict))
 
 
+@toolkit.side_effect_free
+def download_activity_buffer_stats(context, data_dict):
+    """
+    Return the counters of the download activity buffer of this process:
+    events queued, written, dropped (buffer full) and failed (write errors)
+    """
+    toolkit.check_access('download_activity_buffer_stats', context, data_dict)
+    return get_download_buffer().stats()
+
+
 # Datastore
 
 @toolkit.side_effect_free
@@ -681,7 +928,6 @@ def scan_submit(context, data_dict):
     clamav_service_base_url = toolkit.config.get('ckanext.unhcr.clamav_url')
     site_url = toolkit.config.get('ckan.site_url')
     callback_url = toolkit.url_for('/api/3/action/scan_hook', qualified=True)
-    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
 
     try:
         resource_dict = toolkit.get_action('resource_show')(context, {'id': resource_id})
@@ -714,8 +960,8 @@ def scan_submit(context, data_dict):
         'error': 'null',
     }
 
-    payload = json.dumps({
-        'api_key': site_user['apikey'],
+    # The API key is added when the job is submitted, so it is not stored
+    payload = {
         'job_type': 'scan',
         'result_url': callback_url,
         'metadata': {
@@ -724,7 +970,7 @@ def scan_submit(context, data_dict):
             'task_created': task['last_updated'],
             'original_url': resource_dict.get('url'),
         }
-    })
+    }
 
     try:
         existing_task = toolkit.get_action('task_status_show')(context, {
@@ -733,7 +979,7 @@ def scan_submit(context, data_dict):
             'key': 'clamav'
         })
         if (
-            existing_task.get('state') == 'pending'
+            existing_task.get('state') in ('queued', 'submitting', 'pending')
             and not _task_is_stale(existing_task)
         ):
             log.info(
@@ -745,40 +991,16 @@ def scan_submit(context, data_dict):
         pass
 
     context['ignore_auth'] = True
-    toolkit.get_action('task_status_update')(context, task)
+    scan_status.clear_verdict(resource_id)
 
     if not clamav_service_base_url:
         error = {'message': 'Could not submit to Clam AV Service.'}
         _fail_task(context, task, error)
         return False
 
-    try:
-        r = requests.post(
-            urljoin(clamav_service_base_url, 'job'),
-            headers={'Content-Type': 'application/json'},
-            data=payload,
-        )
-        r.raise_for_status()
-    except requests.exceptions.ConnectionError as e:
-        error = {'message': ['Could not connect to Clam AV Service.'], 'details': [str(e)]}
-        _fail_task(context, task, error)
-        raise toolkit.ValidationError(error)
-    except requests.exceptions.HTTPError as e:
-        m = 'An Error occurred while sending the job: {0}'.format(
-            getattr(e, 'message', '')
-        )
-        try:
-            body = e.response.json()
-        except ValueError:
-            body = e.response.text
-        error = {'message': m, 'details': body, 'status_code': r.status_code}
-        _fail_task(context, task, error)
-        raise toolkit.ValidationError(error)
-
-    task['value'] = r.text
-    task['state'] = 'pending'
-    task['last_updated'] = datetime.datetime.utcnow().isoformat(),
-    toolkit.get_action('task_status_update')(context, task)
+    # The job is submitted to the Clam AV service by a background job,
+    # together with the other pending tasks
+    clamav.queue_scan(context, task, payload)
 
     return True
 
@@ -802,6 +1024,13 @@ def scan_hook(context, data_dict):
 
     task = toolkit.get_action('task_status_update')({'ignore_auth': True}, task)
 
+    # Keep the verdict in its own table so downloads and resource lists
+    # do not need to load and parse the task
+    if task['state'] == 'complete' and task['value'] and data_dict.get('data'):
+        scan_status.set_verdict(resource_id, data_dict['data'].get('status_code') == 1)
+    else:
+        scan_status.clear_verdict(resource_id)
+
     if task['state'] == 'error':
         recipients = toolkit.aslist(toolkit.config.get('ckanext.unhcr.error_emails', []))
         for address in recipients:
@@ -813,8 +1042,8 @@ def scan_hook(context, data_dict):
                 json.dumps(data_dict, indent=4)
             )
     elif task['state'] == 'complete' and task['value'] and data_dict.get('data'):
-        scan_status = data_dict.get('data').get('status_code')
-        if scan_status == 1:
+        status_code = data_dict.get('data').get('status_code')
+        if status_code == 1:
             # file is infected
             resource = toolkit.get_action('resource_show')(context, {'id': resource_id})
             resource_name = resource['name'] or "Unnamed resource"
@@ -949,6 +1178,16 @@ def resource_update(up_func, context, data_dict):
     return resource
 
 
+@toolkit.side_effect_free
+def kobo_export_poll_stats(context, data_dict):
+    """
+    Return the number of KoBo exports in flight (waiting to be checked
+    again by `ckan unhcr poll-kobo-exports`) and how many of them are due
+    """
+    toolkit.check_access('kobo_export_poll_stats', context, data_dict)
+    return export_poller.get_stats()
+
+
 # Access Requests
 
 def extract_keys_by_prefix(dct, prefix):
@@ -971,23 +1210,57 @@ def dictize_access_request(req):
     return access_request
 
 
+@core_logic.schema.validator_args
+def unhcr_access_request_list_for_user_schema(
+        ignore_missing,
+        unicode_safe,
+        natural_number_validator,
+        boolean_validator,
+    ):
+    return {
+        'status': [ignore_missing, unicode_safe],
+        'limit': [ignore_missing, natural_number_validator],
+        'offset': [ignore_missing, natural_number_validator],
+        'cursor': [ignore_missing, unicode_safe],
+        'count_only': [ignore_missing, boolean_validator],
+        'compact': [ignore_missing, boolean_validator],
+    }
+
+
 @toolkit.side_effect_free
+@core_logic.validate(unhcr_access_request_list_for_user_schema)
 def access_request_list_for_user(context, data_dict):
     """
-    Return a list of all access requests the user can see
+    Return a list of all access requests the user can see, newest first
 
-    :param status: ``'requested'``, ``'approved'`` or ``'rejected'``
+    :param status: ``'requested'``, ``'approved'``, ``'rejected'`` or ``'all'``
       (default: ``'requested'``)
     :type status: string
-
-    :returns: A list of AccessRequest objects
-    :rtype: list of dictionaries
+    :param limit: the maximum number of access requests to return (optional)
+    :type limit: int
+    :param offset: the number of access requests to skip (optional)
+    :type offset: int
+    :param cursor: the id of the last access request of the previous page,
+      only older access requests are returned (optional)
+    :type cursor: string
+    :param count_only: return the number of access requests instead
+      (optional, default: ``False``)
+    :type count_only: bool
+    :param compact: only include the id, name, title and type of the
+      ``object`` (plus ``owner_org`` for datasets) and the id, name,
+      fullname, email and state of the ``user``
+      (optional, default: ``False``)
+    :type compact: bool
+
+    :returns: A list of AccessRequest objects (or their number)
+    :rtype: list of dictionaries (or int)
     """
     m = context.get('model', model)
     user_id = toolkit.get_or_bust(context, "user")
     status = data_dict.get("status", "requested")
     if status not in ['requested', 'approved', 'rejected', 'all']:
         raise toolkit.ValidationError('Invalid status {}'.format(status))
+    count_only = data_dict.get("count_only", False)
 
     user = m.User.get(user_id)
     if not user:
@@ -1000,17 +1273,86 @@ def access_request_list_for_user(context, data_dict):
     package_table = m.meta.metadata.tables["package"]
     user_table = m.meta.metadata.tables["user"]
 
-    select_cols = (
-        [c for c in access_requests_table.columns] +
-        [c for c in group_table.columns] +
-        [c for c in package_table.columns] +
-        [
-            c for c in user_table.columns
-            if c.name != 'plugin_extras'
-            and c.name != 'password'
-            and c.name != 'apikey'
-        ]
-    )
+    conditions = []
+    if status != 'all':
+        conditions.append(access_requests_table.c.status == status)
+
+    if not user.sysadmin:
+        organizations = toolkit.get_action("organization_list_for_user")(
+            context, {"id": user_id, "permission": "admin"}
+        )
+        containers = [o["id"] for o in organizations]
+        if not containers:
+            return 0 if count_only else []
+
+        conditions.append(
+            or_(
+                and_(
+                    access_requests_table.c.object_type == "package",
+                    access_requests_table.c.object_id.in_(
+                        select([package_table.c.id]).where(
+                            package_table.c.owner_org.in_(containers)
+                        )
+                    ),
+                ),
+                and_(
+                    access_requests_table.c.object_type == "organization",
+                    access_requests_table.c.object_id.in_(containers),
+                ),
+                and_(
+                    access_requests_table.c.object_type == "user",
+                    or_(
+                        not_(access_requests_table.c.data.has_key("user_request_type")),
+                        access_requests_table.c.data["user_request_type"].astext == USER_REQUEST_TYPE_NEW,
+                    ),
+                    access_requests_table.c.data["default_containers"].has_any(array(containers)),
+                ),
+                and_(
+                    access_requests_table.c.object_type == "user",
+                    access_requests_table.c.data["user_request_type"].astext == USER_REQUEST_TYPE_RENEWAL,
+                    access_requests_table.c.data.has_key("users_who_can_approve"),
+                    access_requests_table.c.data["users_who_can_approve"].contains([user.id]),
+                )
+            )
+        )
+
+    if count_only:
+        sql = select([func.count()]).select_from(access_requests_table)
+        for condition in conditions:
+            sql = sql.where(condition)
+        return m.Session.execute(sql).scalar()
+
+    cursor = data_dict.get("cursor")
+    if cursor:
+        last = m.Session.query(AccessRequest.timestamp, AccessRequest.id).filter(
+            AccessRequest.id == cursor
+        ).first()
+        if not last:
+            raise toolkit.ValidationError({'cursor': ['Access request not found']})
+        conditions.append(
+            tuple_(access_requests_table.c.timestamp, access_requests_table.c.id) < tuple_(*last)
+        )
+
+    if data_dict.get("compact"):
+        # Only the columns used by the dashboard templates
+        select_cols = (
+            [c for c in access_requests_table.columns] +
+            [group_table.c[name] for name in ['id', 'name', 'title', 'type']] +
+            [package_table.c[name] for name in ['id', 'name', 'title', 'type', 'owner_org']] +
+            [user_table.c[name] for name in ['id', 'name', 'fullname', 'email', 'state']]
+        )
+    else:
+        select_cols = (
+            [c for c in access_requests_table.columns] +
+            [c for c in group_table.columns] +
+            [c for c in package_table.columns] +
+            [
+                c for c in user_table.columns
+                if c.name != 'plugin_extras'
+                and c.name != 'password'
+                and c.name != 'apikey'
+            ]
+        )
 
     sql = select(
         select_cols, use_labels=True,
@@ -1032,50 +1374,15 @@ def access_request_list_for_user(context, data_dict):
             access_requests_table.c.user_id == user_table.c.id
         )
     ).order_by(
-        desc(access_requests_table.c.timestamp)
-    )
-    if status != 'all':
-        sql = sql.where(
-            access_requests_table.c.status == status
-        )
-
-    if user.sysadmin:
-        return [dictize_access_request(req) for req in m.Session.execute(sql).fetchall()]
-
-    organizations = toolkit.get_action("organization_list_for_user")(
-        context, {"id": user_id, "permission": "admin"}
-    )
-
-    containers = [o["id"] for o in organizations]
-    if not containers:
-        return []
-
-    sql = sql.where(
-        or_(
-            and_(
-                access_requests_table.c.object_type == "package",
-                package_table.c.owner_org.in_(containers),
-            ),
-            and_(
-                access_requests_table.c.object_type == "organization",
-                access_requests_table.c.object_id.in_(containers),
-            ),
-            and_(
-                access_requests_table.c.object_type == "user",
-                or_(
-                    not_(access_requests_table.c.data.has_key("user_request_type")),
-                    access_requests_table.c.data["user_request_type"].astext == USER_REQUEST_TYPE_NEW,
-                ),
-                access_requests_table.c.data["default_containers"].has_any(array(containers)),
-            ),
-            and_(
-                access_requests_table.c.object_type == "user",
-                access_requests_table.c.data["user_request_type"].astext == USER_REQUEST_TYPE_RENEWAL,
-                access_requests_table.c.data.has_key("users_who_can_approve"),
-                access_requests_table.c.data["users_who_can_approve"].contains([user.id]),
-            )
-        )
+        desc(access_requests_table.c.timestamp),
+        desc(access_requests_table.c.id),
     )
+    for condition in conditions:
+        sql = sql.where(condition)
+    if data_dict.get("limit") is not None:
+        sql = sql.limit(data_dict["limit"])
+    if data_dict.get("offset"):
+        sql = sql.offset(data_dict["offset"])
 
     return [dictize_access_request(req) for req in m.Session.execute(sql).fetchall()]
 
@@ -1165,6 +1472,7 @@ def access_request_update(context, data_dict):
     request.actioned_by = model.User.by_name(context['user']).id
     model.Session.commit()
     model.Session.refresh(request)
+    pending_requests.invalidate()
 
     return {
         col.name: getattr(request, col.name)
@@ -1245,6 +1553,7 @@ def access_request_create(context, data_dict):
         model.Session.refresh(request)
     else:
         model.Session.flush()
+    pending_requests.invalidate()
 
     return {
         col.name: getattr(request, col.name)
@@ -1298,6 +1607,7 @@ def external_user_update_state(context, data_dict):
     user_obj.state = state
     m.Session.commit()
     m.Session.refresh(user_obj)
+    pending_requests.invalidate()
 
     return model_dictize.user_dictize(user_obj, context)
 
@@ -1327,36 +1637,75 @@ def user_update_sysadmin(context, data_dict):
     user_obj.sysadmin = is_sysadmin
     m.Session.commit()
     m.Session.refresh(user_obj)
+    # Sysadmins are members of all the containers
+    invalidate_user_labels()
+    pending_requests.invalidate()
 
     return model_dictize.user_dictize(user_obj, context)
 
 
 def search_index_rebuild(context, data_dict):
+    """
+    Rebuild the search index
+
+    Packages are split in chunks, each chunk is indexed and committed to Solr
+    on its own, by a background job (so several workers can share a rebuild).
+    The progress of each chunk is recorded, see `search_index_rebuild_status`
+
+    :param incremental: only reindex the packages modified since the start of
+        the last successful rebuild (optional, default: False)
+    :type incremental: bool
+    :param background: index the chunks in background jobs, if False the chunks
+        are indexed before returning (optional, default:
+        `ckanext.unhcr.search_index_rebuild_background`)
+    :type background: bool
+    :param chunk_size: the number of packages per chunk (optional, default:
+        `ckanext.unhcr.search_index_chunk_size`)
+    :type chunk_size: int
+
+    :returns: the status of the rebuild
+    :rtype: dict
+    """
     toolkit.check_access('search_index_rebuild', context, data_dict)
 
-    package_ids = [
-        r[0]
-        for r in model.Session.query(model.Package.id)
-        .filter(model.Package.state != "deleted")
-        .all()
-    ]
-    package_index = index_for(model.Package)
-    errors = []
-    context = {'model': model, 'ignore_auth': True, 'validate': False, 'use_cache': False}
-    for pkg_id in package_ids:
-        try:
-            package_index.update_dict(
-                core_logic.get_action('package_show')(context, {'id': pkg_id}),
-                defer_commit=True
+    incremental = toolkit.asbool(data_dict.get('incremental', False))
+    background = toolkit.asbool(data_dict.get(
+        'background',
+        toolkit.config.get('ckanext.unhcr.search_index_rebuild_background', True)
+    ))
+    try:
+        chunk_size = int(data_dict.get('chunk_size') or search_index.get_chunk_size())
+        if chunk_size < 1:
+            raise ValueError
+    except ValueError:
+        raise toolkit.ValidationError({'chunk_size': ['Must be a positive integer']})
+
+    since = search_index.get_last_success() if incremental else None
+    package_ids = search_index.get_package_ids(since=since)
+    rebuild_id, chunks = search_index.start_rebuild(
+        package_ids, chunk_size, incremental=incremental
+    )
+
+    for number, chunk in enumerate(chunks):
+        if background:
+            toolkit.enqueue_job(
+                rebuild_search_index_chunk,
+                [rebuild_id, number, chunk],
+                title='Rebuild search index (chunk {}/{})'.format(number + 1, len(chunks))
             )
-        except Exception as e:
-            errors.append('Encountered {error} processing {pkg}'.format(
-                error=repr(e),
-                pkg=pkg_id
-            ))
+        else:
+            search_index.index_chunk(rebuild_id, number, chunk)
 
-    commit()
-    return errors
+    return search_index.get_status()
+
+
+@toolkit.side_effect_free
+def search_index_rebuild_status(context, data_dict):
+    """
+    Return the progress of the current (or last) search index rebuild
+    """
+    toolkit.check_access('search_index_rebuild_status', context, data_dict)
+    return search_index.get_status()
 
 
 # Autocomplete
@@ -1517,6 +1866,16 @@ def geography_show(context, data_dict):
     raise toolkit.ObjectNotFound("Geography not found")
 
 
+@toolkit.side_effect_free
+def geography_cache_stats(context, data_dict):
+    """
+    Return the hit/miss counters of the geography cache of this process.
+    Useful to size the in-process LRU (ckanext.unhcr.geography_cache_size)
+    """
+    toolkit.check_access('geography_cache_stats', context, data_dict)
+    return get_geography_cache().stats()
+
+
 # User
 
 @toolkit.chained_action
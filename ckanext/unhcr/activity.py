@@ -1,5 +1,18 @@
+import atexit
+import datetime
+import logging
+import queue
+import threading
 from ckan import model
+from ckan.model.types import make_uuid
+from ckan.lib.dictization import model_dictize
 import ckan.plugins.toolkit as toolkit
+from ckanext.unhcr import download_stats
+
+
+log = logging.getLogger(__name__)
+
+_download_buffer = None
 
 
 def create_download_activity(context, resource_id):
@@ -31,6 +44,209 @@ def create_download_activity(context, resource_id):
     create_activity = toolkit.get_action('activity_create')
     create_activity(activity_create_context, activity_dict)
 
+    download_stats.increment([{
+        'object_id': resource['package_id'],
+        'user_id': user_id,
+        'timestamp': datetime.datetime.utcnow(),
+    }])
+
+
+def record_download_activity(user_obj, resource_obj):
+    """
+    Log a 'resource download' activity for a download that has already been
+    authorized, using the resource object loaded by the access check instead
+    of calling resource_show again.
+
+    The activity is queued in the download buffer of this process and
+    written in bulk by its flusher thread
+    (or right away if `ckanext.unhcr.download_activity_buffer` is false)
+    """
+    if not toolkit.asbool(toolkit.config.get('ckan.activity_streams_enabled', True)):
+        return
+
+    event = {
+        'id': make_uuid(),
+        'timestamp': datetime.datetime.utcnow(),
+        'user_id': user_obj.id if user_obj else None,
+        'object_id': resource_obj.package_id,
+        'activity_type': 'download resource',
+        'data': model_dictize.resource_dictize(resource_obj, {'model': model}),
+    }
+
+    if not toolkit.asbool(toolkit.config.get('ckanext.unhcr.download_activity_buffer', True)):
+        insert_download_activities([event])
+        return
+
+    get_download_buffer().add(event)
+
+
+def insert_download_activities(events):
+    """
+    Write the given 'download resource' activities with a single multi-row
+    INSERT and add them to the download counters, in the same transaction
+    """
+    if not events:
+        return
+    activity_table = model.meta.metadata.tables['activity']
+    with model.meta.engine.begin() as connection:
+        connection.execute(activity_table.insert().values(events))
+        download_stats.increment(events, connection=connection)
+
+
+def get_download_buffer():
+    global _download_buffer
+    if _download_buffer is None:
+        _download_buffer = DownloadActivityBuffer(
+            max_size=toolkit.asint(
+                toolkit.config.get('ckanext.unhcr.download_activity_buffer_size', 10000)
+            ),
+            batch_size=toolkit.asint(
+                toolkit.config.get('ckanext.unhcr.download_activity_batch_size', 500)
+            ),
+            flush_interval=float(
+                toolkit.config.get('ckanext.unhcr.download_activity_flush_seconds', 5)
+            ),
+            max_retries=toolkit.asint(
+                toolkit.config.get('ckanext.unhcr.download_activity_max_retries', 3)
+            ),
+        )
+        atexit.register(_download_buffer.stop)
+    return _download_buffer
+
+
+class DownloadActivityBuffer:
+    """
+    A bounded in-process queue of download activities, written in batches
+    by a daemon thread every `flush_interval` seconds (or as soon as a
+    batch is full) and on interpreter shutdown.
+
+    Events arriving while the queue is full are dropped and counted, as
+    the events that still can't be written after `max_retries` flushes
+
+    The flusher thread needs threads enabled in the server
+    (`enable-threads = true` under uWSGI)
+    """
+
+    def __init__(self, max_size, batch_size, flush_interval, max_retries=3):
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_size)
+        self._retries = []
+        self._flush_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, event):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._counter_lock:
+                self.dropped += 1
+            log.warning('Download activity buffer is full, dropping event for %s', event['object_id'])
+            return False
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def flush(self, final=False):
+        """ Write all the queued events, returns the number written.
+            A batch that can't be written is retried on the next flushes and
+            then written row by row, so only the failing events are dropped """
+        written = 0
+        with self._flush_lock:
+            retries, self._retries = self._retries, []
+            healthy = True
+            for attempts, events in retries:
+                count = self._write(events, attempts, final)
+                written += count
+                healthy = healthy and count == len(events)
+            # Leave the queue alone while the database is failing, the
+            # events are retried from there once it is back
+            while healthy or final:
+                events = []
+                while len(events) < self.batch_size:
+                    try:
+                        events.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not events:
+                    break
+                count = self._write(events, 0, final)
+                written += count
+                healthy = count == len(events)
+        with self._counter_lock:
+            self.written += written
+        return written
+
+    def _write(self, events, attempts, final):
+        try:
+            insert_download_activities(events)
+            return len(events)
+        except Exception:
+            attempts += 1
+            if attempts <= self.max_retries and not final:
+                log.warning(
+                    'Could not write %s download activities (attempt %s), retrying on the next flush',
+                    len(events), attempts, exc_info=True
+                )
+                self._retries.append((attempts, events))
+                return 0
+            log.exception('Could not write %s download activities, writing them one by one', len(events))
+        written = 0
+        for event in events:
+            try:
+                insert_download_activities([event])
+            except Exception:
+                log.exception('Could not write the download activity %s', event['id'])
+                with self._counter_lock:
+                    self.failed += 1
+                continue
+            written += 1
+        return written
+
+    def stop(self):
+        """ Stop the flusher thread and write what is left in the queue """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush(final=True)
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'retrying': sum(len(events) for attempts, events in self._retries),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _ensure_thread(self):
+        # The thread is started lazily so each forked worker gets its own
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._flush_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='unhcr-download-activity', daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
 
 def create_curation_activity(
         activity_type, dataset_id, dataset_name, user_id,
@@ -16,6 +16,7 @@ from ckanext.unhcr.models import (
     POC,
     PRP,
     DEFAULT_GEOGRAPHY_CODE,
+    get_geography_cache,
 )
 
 
@@ -198,7 +199,15 @@ def import_geographies(data={}, verbose=False, **kwargs):
       If we use the "where" param to update only some countries,
         we need to skip the inactivation for all countries
       *****
+    Cached geographies are invalidated when the import ends (even if it fails)
     """
+    try:
+        _import_geographies(data, verbose, **kwargs)
+    finally:
+        get_geography_cache().invalidate()
+
+
+def _import_geographies(data, verbose, **kwargs):
 
     model.Session.query(
         Geography
@@ -31,7 +31,7 @@ def requests():
 
     try:
         access_requests = toolkit.get_action('access_request_list_for_user')(
-            context, {}
+            context, {'compact': True}
         )
     except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
         access_requests = []
@@ -70,24 +70,45 @@ def requests():
     template_vars['user_account_requests'] = user_account_requests
     template_vars['user_renewal_requests'] = user_renewal_requests
 
+    # access_request_list_for_user removes plugin_extras where focal-point lives
+    user_requests = user_account_requests + user_renewal_requests
+    user_ids = {uar['user_id'] for uar in user_requests}
+    users = {}
+    if user_ids:
+        users = {
+            user.id: user for user in
+            model.Session.query(model.User).filter(model.User.id.in_(user_ids))
+        }
+
+    user_extras = {
+        user_id: (user.plugin_extras or {}).get('unhcr', {})
+        for user_id, user in users.items()
+    }
+    container_ids = {
+        container_id
+        for extras in user_extras.values()
+        for container_id in extras.get('default_containers', [])
+    }
+    containers = {}
+    if container_ids:
+        containers = {
+            container.id: container for container in
+            model.Session.query(model.Group)
+            .filter(model.Group.id.in_(container_ids))
+            .filter(model.Group.name != 'data-deposit')
+        }
+
     extras_user_access_request = {}
-    for uar in user_account_requests + user_renewal_requests:
-        # access_request_list_for_user removes plugin_extras where focal-point lives
-        user_obj = model.User.get(uar['user_id'])
-        focal_point = user_obj.plugin_extras.get('unhcr', {}).get('focal_point')
-        default_containers = user_obj.plugin_extras.get('unhcr', {}).get('default_containers', [])
-
-        containers = [
-            model.Group.get(container_id)
-            for container_id in default_containers
-        ]
-        cleaned_containers = [container for container in containers if container and container.name != 'data-deposit']
-
-        extras = {
-            'default_containers': cleaned_containers,
-            'focal_point': focal_point
+    for uar in user_requests:
+        extras = user_extras.get(uar['user_id'], {})
+        extras_user_access_request[uar['id']] = {
+            'default_containers': [
+                containers[container_id]
+                for container_id in extras.get('default_containers', [])
+                if container_id in containers
+            ],
+            'focal_point': extras.get('focal_point'),
         }
-        extras_user_access_request[uar['id']] = extras
 
     template_vars['extras_user_access_request'] = extras_user_access_request
 
@@ -118,7 +118,8 @@ def membership():
     # Containers
     containers = []
     if user:
-        containers = toolkit.get_action('organization_list_all_fields')(context, {})
+        containers = toolkit.get_action('organization_list_all_fields')(
+            context, {'fields': ['id', 'name', 'title']})
         containers = filter(lambda cont: cont['name'] != deposit['name'], containers)
 
     # Roles
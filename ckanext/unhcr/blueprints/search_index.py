@@ -20,19 +20,33 @@ def index():
     except toolkit.NotAuthorized:
         return toolkit.abort(403, 'Not authorized to manage search index')
 
-    return toolkit.render('admin/search_index.html')
+    status = toolkit.get_action('search_index_rebuild_status')({'user': toolkit.c.user}, {})
+
+    return toolkit.render('admin/search_index.html', {
+        'status': status,
+        'errors': "\n".join(status['errors']),
+    })
 
 
 @require_user
 def rebuild():
+    data_dict = {
+        'incremental': toolkit.asbool(toolkit.request.form.get('incremental', False)),
+    }
     try:
-        errors = toolkit.get_action('search_index_rebuild')({'user': toolkit.c.user}, {})
+        status = toolkit.get_action('search_index_rebuild')({'user': toolkit.c.user}, data_dict)
     except toolkit.NotAuthorized:
         return toolkit.abort(403, 'Not authorized to rebuild search index')
 
-    if errors:
+    if status['state'] == 'running':
+        toolkit.h.flash_success('Search Index rebuild started')
+        return toolkit.redirect_to('unhcr_search_index.index')
+    elif status['errors']:
         toolkit.h.flash_error('Search Index rebuild completed with errors')
-        return toolkit.render('admin/search_index.html', { 'errors': "\n".join(errors) })
+        return toolkit.render('admin/search_index.html', {
+            'status': status,
+            'errors': "\n".join(status['errors']),
+        })
     else:
         toolkit.h.flash_success('Search Index rebuild completed successfully')
         return toolkit.redirect_to('unhcr_search_index.index')
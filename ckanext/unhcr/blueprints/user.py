@@ -48,7 +48,8 @@ class RegisterView(BaseRegisterView):
 
     def _get_container_list(self):
         context = {'model': model, 'ignore_auth': True}
-        orgs = toolkit.get_action('organization_list_all_fields')(context, {})
+        orgs = toolkit.get_action('organization_list_all_fields')(
+            context, {'fields': ['visible_external']})
         deposit = get_data_deposit()
         containers = sorted(
             [
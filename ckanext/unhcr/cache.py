@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from redis import Redis, ConnectionPool
+from redis.exceptions import RedisError
+from ckan.common import config
+
+
+log = logging.getLogger(__name__)
+
+_redis_pool = None
+_tiered_caches = weakref.WeakSet()
+
+
+def get_redis():
+    """ Return a Redis client that shares a single module-level connection pool """
+    global _redis_pool
+    if _redis_pool is None:
+        redis_url = config.get('ckan.redis.url', 'redis://localhost:6379/0')
+        _redis_pool = ConnectionPool.from_url(redis_url)
+    return Redis(connection_pool=_redis_pool)
+
+
+def invalidate_all():
+    """ Invalidate all the TieredCache instances of this process """
+    for cache in list(_tiered_caches):
+        cache.invalidate()
+
+
+class LRUCache:
+    """ A bounded, thread-safe, in-process LRU cache (entries can expire) """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.monotonic():
+                self.misses += 1
+                return default
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ Store a value, for `ttl` seconds if given """
+        if self.max_size <= 0:
+            return
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache:
+    """
+    Two tier cache for JSON-serializable values
+
+    The first tier is a bounded LRU in process memory, the second one is
+    Redis (shared by all the web and worker processes).
+    Both tiers are invalidated by bumping a generation counter stored in Redis:
+    Redis keys include the generation, so old entries are never read again
+    (and expire with their TTL) and the processes clear their LRU when they
+    notice the generation changed (checked every `generation_check_seconds`).
+    Entries expire from both tiers after `ttl` seconds, even if an
+    invalidation is missed.
+    """
+
+    def __init__(self, namespace, max_size=1000, ttl=3000, generation_check_seconds=30):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.generation_check_seconds = generation_check_seconds
+        self.lru = LRUCache(max_size)
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self._generation = None
+        self._generation_checked = 0
+        _tiered_caches.add(self)
+
+    @property
+    def _generation_key(self):
+        return 'ckanext-unhcr:{}:generation'.format(self.namespace)
+
+    def _redis_key(self, key, generation):
+        return 'ckanext-unhcr:{}:{}:{}'.format(self.namespace, generation, key)
+
+    def _current_generation(self):
+        now = time.monotonic()
+        if self._generation is not None and now - self._generation_checked < self.generation_check_seconds:
+            return self._generation
+
+        try:
+            generation = int(get_redis().get(self._generation_key) or 0)
+        except RedisError as e:
+            log.warning('Error reading {} cache generation: {}'.format(self.namespace, e))
+            generation = self._generation or 0
+
+        if generation != self._generation:
+            self.lru.clear()
+            self._generation = generation
+        self._generation_checked = now
+        return generation
+
+    def get(self, key):
+        generation = self._current_generation()
+        value = self.lru.get(key)
+        if value is not None:
+            return value
+
+        try:
+            pipe = get_redis().pipeline()
+            pipe.get(self._redis_key(key, generation))
+            pipe.pttl(self._redis_key(key, generation))
+            cached, pttl = pipe.execute()
+        except RedisError as e:
+            log.warning('Error reading {} cache: {}'.format(self.namespace, e))
+            cached = None
+
+        if cached is None:
+            self.redis_misses += 1
+            return None
+
+        self.redis_hits += 1
+        value = json.loads(cached)
+        # kept in memory for the time left in Redis only
+        self.lru.set(key, value, ttl=pttl / 1000.0 if pttl and pttl > 0 else self.ttl)
+        return value
+
+    def set(self, key, value):
+        generation = self._current_generation()
+        self.lru.set(key, value, ttl=self.ttl)
+        try:
+            get_redis().set(self._redis_key(key, generation), json.dumps(value), ex=self.ttl)
+        except RedisError as e:
+            log.warning('Error writing {} cache: {}'.format(self.namespace, e))
+
+    def invalidate(self):
+        """ Bump the generation counter. This invalidates both tiers in every process """
+        self.lru.clear()
+        try:
+            self._generation = int(get_redis().incr(self._generation_key))
+        except RedisError as e:
+            log.warning('Error invalidating {} cache: {}'.format(self.namespace, e))
+            self._generation = (self._generation or 0) + 1
+        self._generation_checked = time.monotonic()
+
+    def stats(self):
+        return {
+            'namespace': self.namespace,
+            'generation': self._generation,
+            'lru_size': len(self.lru),
+            'lru_max_size': self.lru.max_size,
+            'lru_hits': self.lru.hits,
+            'lru_misses': self.lru.misses,
+            'redis_hits': self.redis_hits,
+            'redis_misses': self.redis_misses,
+        }
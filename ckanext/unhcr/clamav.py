@@ -0,0 +1,216 @@
+import datetime
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import and_, bindparam, or_, select
+from ckan import model
+import ckan.plugins.toolkit as toolkit
+
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_workers():
+    return toolkit.asint(toolkit.config.get('ckanext.unhcr.clamav_workers', 4))
+
+
+def get_session():
+    """
+    Return the HTTP session shared by all the submissions of this process,
+    so connections to the Clam AV service are kept alive and reused
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(get_workers(), 1))
+            _session = requests.Session()
+            _session.headers.update({'Content-Type': 'application/json'})
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+
+def queue_scan(context, task, payload):
+    """
+    Store the Clam AV task as 'queued' with the job payload as its value
+    (the API key is added at submission time) and enqueue the job that
+    submits the pending tasks in batches
+    """
+    task['state'] = 'queued'
+    task['value'] = json.dumps(payload)
+    toolkit.get_action('task_status_update')(context, task)
+    toolkit.enqueue_job(submit_pending_scans, title='Submit pending Clam AV scans')
+
+
+def submit_pending_scans():
+    """
+    Submit all the queued Clam AV tasks, `ckanext.unhcr.clamav_batch_size`
+    at a time, concurrently over the shared session. Returns the number of
+    tasks submitted and failed
+    """
+    base_url = toolkit.config.get('ckanext.unhcr.clamav_url')
+    batch_size = toolkit.asint(toolkit.config.get('ckanext.unhcr.clamav_batch_size', 50))
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+
+    stats = {'submitted': 0, 'failed': 0}
+    while True:
+        tasks = _claim_queued_tasks(batch_size)
+        if not tasks:
+            break
+        results = _submit_batch(base_url, site_user['apikey'], tasks)
+        _store_results(results)
+        for result in results:
+            stats['submitted' if result['_state'] == 'pending' else 'failed'] += 1
+
+    if stats['submitted'] or stats['failed']:
+        log.info('Clam AV tasks submitted: {submitted}, failed: {failed}'.format(**stats))
+    return stats
+
+
+def _get_task_table():
+    return model.meta.metadata.tables['task_status']
+
+
+def _claim_queued_tasks(batch_size):
+    """
+    Mark a batch of queued tasks as 'submitting' and return them. Rows
+    claimed by another worker are skipped, and rows left in 'submitting'
+    for longer than `ckanext.unhcr.clamav_submitting_timeout` seconds
+    (e.g. by a worker that crashed) are claimed again
+    """
+    table = _get_task_table()
+    now = datetime.datetime.utcnow()
+    timeout = toolkit.asint(toolkit.config.get('ckanext.unhcr.clamav_submitting_timeout', 900))
+    claimable = select([table.c.id]).where(
+        and_(
+            table.c.task_type == 'clamav',
+            table.c.key == 'clamav',
+            or_(
+                table.c.state == 'queued',
+                and_(
+                    table.c.state == 'submitting',
+                    table.c.last_updated < now - datetime.timedelta(seconds=timeout),
+                ),
+            ),
+        )
+    ).order_by(
+        table.c.last_updated
+    ).limit(batch_size).with_for_update(skip_locked=True)
+
+    stmt = table.update().where(
+        table.c.id.in_(claimable)
+    ).values(
+        state='submitting',
+        last_updated=now,
+    ).returning(table.c.id, table.c.entity_id, table.c.value)
+
+    with model.meta.engine.begin() as connection:
+        return [dict(row) for row in connection.execute(stmt)]
+
+
+def _submit_batch(base_url, api_key, tasks):
+    if not base_url:
+        error = {'message': 'Could not submit to Clam AV Service.'}
+        return [_task_result(task, 'error', error=error) for task in tasks]
+
+    url = urljoin(base_url, 'job')
+    workers = min(get_workers(), len(tasks))
+    if workers <= 1:
+        return [_submit_task(url, api_key, task) for task in tasks]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda task: _submit_task(url, api_key, task), tasks))
+
+
+def _submit_task(url, api_key, task):
+    try:
+        payload = json.loads(task['value'])
+    except (TypeError, ValueError):
+        error = {'message': 'Invalid Clam AV task payload.'}
+        return _task_result(task, 'error', error=error)
+    payload['api_key'] = api_key
+
+    try:
+        r = _post_with_retry(url, json.dumps(payload))
+    except requests.exceptions.ConnectionError as e:
+        error = {'message': ['Could not connect to Clam AV Service.'], 'details': [str(e)]}
+        return _task_result(task, 'error', error=error)
+    except requests.exceptions.HTTPError as e:
+        try:
+            body = e.response.json()
+        except ValueError:
+            body = e.response.text
+        error = {
+            'message': 'An Error occurred while sending the job: {0}'.format(str(e)),
+            'details': body,
+            'status_code': e.response.status_code,
+        }
+        return _task_result(task, 'error', error=error)
+    except requests.exceptions.RequestException as e:
+        error = {'message': 'An Error occurred while sending the job.', 'details': str(e)}
+        return _task_result(task, 'error', error=error)
+
+    return _task_result(task, 'pending', value=r.text)
+
+
+def _post_with_retry(url, data):
+    """
+    POST a job, retrying connection errors and 429/5xx responses with an
+    exponential backoff (`ckanext.unhcr.clamav_retries` times)
+    """
+    retries = toolkit.asint(toolkit.config.get('ckanext.unhcr.clamav_retries', 3))
+    backoff = float(toolkit.config.get('ckanext.unhcr.clamav_backoff_seconds', 0.5))
+    timeout = float(toolkit.config.get('ckanext.unhcr.clamav_timeout', 30))
+
+    attempt = 0
+    while True:
+        try:
+            r = get_session().post(url, data=data, timeout=timeout)
+            if r.status_code not in RETRY_STATUS_CODES or attempt >= retries:
+                r.raise_for_status()
+                return r
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt >= retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
+
+
+def _task_result(task, state, value=None, error=None):
+    return {
+        '_id': task['id'],
+        '_state': state,
+        '_value': value if value is not None else task['value'],
+        '_error': json.dumps(error),
+        '_last_updated': datetime.datetime.utcnow(),
+    }
+
+
+def _store_results(results):
+    """
+    Store the result of each submission, unless the task is not 'submitting'
+    anymore (e.g. the scan_hook callback already stored the verdict)
+    """
+    table = _get_task_table()
+    stmt = table.update().where(
+        and_(
+            table.c.id == bindparam('_id'),
+            table.c.state == 'submitting',
+        )
+    ).values(
+        state=bindparam('_state'),
+        value=bindparam('_value'),
+        error=bindparam('_error'),
+        last_updated=bindparam('_last_updated'),
+    )
+    with model.meta.engine.begin() as connection:
+        connection.execute(stmt, results)
@@ -3,12 +3,14 @@
 import click
 
 from ckan.plugins import toolkit
-import ckan.model as model
 
 from ckanext.unhcr.commands import expired_users_list, request_renewal
 from ckanext.unhcr.activity import create_system_activity
+from ckanext.unhcr import download_stats
+from ckanext.unhcr.jobs import poll_kobo_exports as enqueue_due_kobo_exports
 from ckanext.unhcr.arcgis import import_geographies as arcgis_import_geographies
-from ckanext.unhcr.models import create_tables, TimeSeriesMetric
+from ckanext.unhcr.models import create_tables
+from ckanext.unhcr.metrics import get_metrics, take_snapshot
 from ckanext.unhcr.mailer import (
     compose_summary_email_body,
     get_summary_email_recipients,
@@ -62,33 +64,37 @@ def import_geographies(where_list, verbose):
     short_help=u'Take a snapshot of time-series metrics'
 )
 def snapshot_metrics():
-    context = { 'ignore_auth': True }
-
-    data_dict = {
-        'q': '*:*',
-        'rows': 0,
-        'include_private': True,
-    }
-    packages = toolkit.get_action('package_search')(
-        context, dict(data_dict, fq='-type:deposited-dataset'))
-    deposits = toolkit.get_action('package_search')(
-        context, dict(data_dict, fq='type:deposited-dataset'))
-    organizations = toolkit.get_action('organization_list')(
-        context,
-        { 'type': 'data-container' },
-    )
-
-    rec = TimeSeriesMetric(
-        datasets_count=packages['count'],
-        deposits_count=deposits['count'],
-        containers_count=len(organizations),
-    )
-    model.Session.add(rec)
-    model.Session.commit()
-    model.Session.refresh(rec)
+    rec = take_snapshot()
     click.echo('Snapshot saved at {}'.format(rec.timestamp))
 
 
+@unhcr.command(
+    u'warm-metrics',
+    short_help=u'Compute all the metrics panels and cache them'
+)
+def warm_metrics():
+    panels = get_metrics(refresh=True)
+    click.echo('{} metrics panels cached'.format(len(panels)))
+
+
+@unhcr.command(
+    u'rebuild-download-stats',
+    short_help=u'Re-compute the download counters from the activity stream'
+)
+def rebuild_download_stats():
+    total = download_stats.rebuild()
+    click.echo('Download stats rebuilt: {} downloads counted'.format(total))
+
+
+@unhcr.command(
+    u'poll-kobo-exports',
+    short_help=u'Check the KoBoToolbox exports that are due (run it from cron)'
+)
+def poll_kobo_exports():
+    total = enqueue_due_kobo_exports()
+    click.echo('{} KoBoToolbox exports enqueued for checking'.format(total))
+
+
 @unhcr.command(
     u'send-summary-emails',
     short_help=u'Send a summary of activity over the last 7 days\nto sysadmins and curators'
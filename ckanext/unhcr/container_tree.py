@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import flask
+from ckan import authz, model
+from ckan.plugins import toolkit
+from ckanext.unhcr.cache import TieredCache
+
+
+_tree_cache = None
+
+
+def get_tree_cache():
+    """
+    Return the cache for the data container hierarchy index and for the
+    rendered tree, it is invalidated on any organization or membership change
+    """
+    global _tree_cache
+    if _tree_cache is None:
+        _tree_cache = TieredCache(
+            'container-tree',
+            max_size=10,
+            ttl=toolkit.asint(
+                toolkit.config.get('ckanext.unhcr.container_tree_cache_seconds', 3600)
+            ),
+            generation_check_seconds=0,
+        )
+    return _tree_cache
+
+
+def invalidate():
+    if flask.has_request_context():
+        flask.g.pop('unhcr_approved_data_containers', None)
+    get_tree_cache().invalidate()
+
+
+def get_approved_data_containers():
+    """
+    Return the approved data containers (as organization_list_all_fields
+    dicts), memoized for the current request
+    """
+    if flask.has_request_context() and 'unhcr_approved_data_containers' in flask.g:
+        return flask.g.unhcr_approved_data_containers
+
+    context = {'model': model, 'ignore_auth': True}
+    orgs = toolkit.get_action('organization_list_all_fields')(context, {})
+    containers = [org for org in orgs if org['approval_status'] == u'approved']
+
+    if flask.has_request_context():
+        flask.g.unhcr_approved_data_containers = containers
+    return containers
+
+
+def get_admin_container_ids(user_id):
+    """
+    Return the ids of the data containers a user is admin of, including
+    their sub-containers when the admin role cascades (as it does in
+    organization_list_for_user)
+    """
+    admin_ids = {
+        r[0] for r in
+        model.Session.query(model.Member.group_id)
+        .join(model.Group, model.Group.id == model.Member.group_id)
+        .filter(model.Member.table_name == 'user')
+        .filter(model.Member.table_id == user_id)
+        .filter(model.Member.capacity == 'admin')
+        .filter(model.Member.state == 'active')
+        .filter(model.Group.is_organization == True)
+        .filter(model.Group.state == 'active')
+        .all()
+    }
+    cascade_roles = authz.check_config_permission('roles_that_cascade_to_sub_groups')
+    if 'admin' in cascade_roles:
+        index = get_descendants_index()
+        for container_id in list(admin_ids):
+            admin_ids.update(index.get(container_id, []))
+    return admin_ids
+
+
+def get_descendants_index():
+    """
+    Return a dict mapping the id of every data container to the ids of all
+    its descendants (children, grand-children, etc)
+    """
+    cache = get_tree_cache()
+    index = cache.get('descendants')
+    if index is None:
+        index = _build_descendants_index()
+        cache.set('descendants', index)
+    return index
+
+
+def get_descendant_ids(container_id):
+    return get_descendants_index().get(container_id, [])
+
+
+def get_rendered_tree(render):
+    """
+    Return the HTML of the whole data container tree, calling `render()`
+    only if it is not cached
+    """
+    cache = get_tree_cache()
+    html = cache.get('html')
+    if html is None:
+        html = render()
+        cache.set('html', html)
+    return html
+
+
+def _build_descendants_index():
+    # ckanext-hierarchy stores the parent of a container as a member row
+    # where group_id is the parent and table_id is the child
+    container_ids = [
+        r[0] for r in
+        model.Session.query(model.Group.id)
+        .filter(model.Group.type == 'data-container')
+        .filter(model.Group.state != 'deleted')
+        .all()
+    ]
+    children = {container_id: [] for container_id in container_ids}
+    rows = (
+        model.Session.query(model.Member.group_id, model.Member.table_id)
+        .filter(model.Member.table_name == 'group')
+        .filter(model.Member.state == 'active')
+        .filter(model.Member.group_id.in_(container_ids))
+        .filter(model.Member.table_id.in_(container_ids))
+        .all()
+    )
+    for parent_id, child_id in rows:
+        children[parent_id].append(child_id)
+
+    index = {}
+    for container_id in container_ids:
+        descendants = []
+        seen = {container_id}
+        pending = list(children[container_id])
+        while pending:
+            child_id = pending.pop(0)
+            if child_id in seen:
+                continue
+            seen.add(child_id)
+            descendants.append(child_id)
+            pending.extend(children[child_id])
+        index[container_id] = descendants
+    return index
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from contextlib import contextmanager
+from sqlalchemy import or_
+from ckan import model
+
+
+_batch = threading.local()
+
+
+class DisplayNameResolver(object):
+    """
+    Resolve user and organization display names reading only the columns we
+    need from the user and group tables (instead of calling user_show and
+    organization_show). Results are memoized for the lifetime of the resolver.
+
+    :param users: optional pre-fetched map of user id/name -> display name
+    :param orgs: optional pre-fetched map of organization id/name -> display name
+    """
+
+    def __init__(self, users=None, orgs=None):
+        self.users = dict(users or {})
+        self.orgs = dict(orgs or {})
+
+    def prefetch(self, user_ids=(), org_ids=()):
+        """ Load all the missing users and organizations with one query each """
+        user_ids = {id_ for id_ in user_ids if id_ and id_ not in self.users}
+        if user_ids:
+            rows = (
+                model.Session.query(model.User.id, model.User.name, model.User.fullname)
+                .filter(or_(model.User.id.in_(user_ids), model.User.name.in_(user_ids)))
+                .all()
+            )
+            self._store(self.users, user_ids, [
+                (id_, name, fullname or name) for id_, name, fullname in rows
+            ])
+
+        org_ids = {id_ for id_ in org_ids if id_ and id_ not in self.orgs}
+        if org_ids:
+            rows = (
+                model.Session.query(model.Group.id, model.Group.name, model.Group.title)
+                .filter(model.Group.is_organization == True)
+                .filter(or_(model.Group.id.in_(org_ids), model.Group.name.in_(org_ids)))
+                .all()
+            )
+            self._store(self.orgs, org_ids, [
+                (id_, name, title or name) for id_, name, title in rows
+            ])
+
+    def user(self, id_or_name):
+        """ Return the display name of a user or None if it does not exist """
+        if id_or_name not in self.users:
+            self.prefetch(user_ids=[id_or_name])
+        return self.users.get(id_or_name)
+
+    def organization(self, id_or_name):
+        """ Return the display name of an organization or None if it does not exist """
+        if id_or_name not in self.orgs:
+            self.prefetch(org_ids=[id_or_name])
+        return self.orgs.get(id_or_name)
+
+    def _store(self, names, requested, rows):
+        for id_, name, display_name in rows:
+            names[id_] = display_name
+            names[name] = display_name
+        # Remember the missing ones too, so we don't look for them again
+        for id_ in requested:
+            names.setdefault(id_, None)
+
+
+@contextmanager
+def indexing_batch(users=None, orgs=None, download_counts=None):
+    """
+    Share a single DisplayNameResolver between all the packages indexed
+    inside this block (in the current thread)
+
+    :param download_counts: optional pre-fetched map of package id -> downloads
+    """
+    resolver = DisplayNameResolver(users=users, orgs=orgs)
+    _batch.resolver = resolver
+    _batch.download_counts = download_counts
+    try:
+        yield resolver
+    finally:
+        _batch.resolver = None
+        _batch.download_counts = None
+
+
+def get_resolver():
+    """
+    Return the resolver of the current indexing batch or a new one
+    """
+    resolver = getattr(_batch, 'resolver', None)
+    if resolver is None:
+        resolver = DisplayNameResolver()
+    return resolver
+
+
+def get_batch_download_count(package_id):
+    """
+    Return the pre-fetched downloads of a package in the current indexing
+    batch or None if they were not pre-fetched
+    """
+    download_counts = getattr(_batch, 'download_counts', None)
+    if download_counts is None:
+        return None
+    return download_counts.get(package_id)
+
+
+def get_deposit_related_ids(package_ids):
+    """
+    Return the (user_ids, org_ids) referenced by the deposited datasets in
+    `package_ids`, so they can be prefetched before indexing them
+    """
+    user_ids = set()
+    org_ids = set()
+    if not package_ids:
+        return user_ids, org_ids
+
+    rows = (
+        model.Session.query(model.Package.creator_user_id)
+        .filter(model.Package.id.in_(package_ids))
+        .filter(model.Package.type == 'deposited-dataset')
+        .all()
+    )
+    user_ids.update(r[0] for r in rows if r[0])
+
+    rows = (
+        model.Session.query(model.PackageExtra.key, model.PackageExtra.value)
+        .join(model.Package, model.Package.id == model.PackageExtra.package_id)
+        .filter(model.Package.id.in_(package_ids))
+        .filter(model.Package.type == 'deposited-dataset')
+        .filter(model.PackageExtra.key.in_(['curator_id', 'owner_org_dest']))
+        .all()
+    )
+    for key, value in rows:
+        if not value:
+            continue
+        if key == 'curator_id':
+            user_ids.add(value)
+        else:
+            org_ids.add(value)
+
+    return user_ids, org_ids
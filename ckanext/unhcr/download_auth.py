@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import and_, or_
+from ckan import authz, model
+from ckan.plugins import toolkit
+from ckanext.unhcr import container_tree, helpers
+from ckanext.unhcr.cache import TieredCache
+from ckanext.unhcr.permission_labels import get_owner_org_dest
+
+
+_curators_cache = None
+
+
+def get_curators_cache():
+    """
+    Return the cache of curator id sets, keyed by deposit target. It is
+    invalidated on any membership change
+    """
+    global _curators_cache
+    if _curators_cache is None:
+        _curators_cache = TieredCache(
+            'curators',
+            max_size=1000,
+            ttl=toolkit.asint(
+                toolkit.config.get('ckanext.unhcr.curators_cache_seconds', 3600)
+            ),
+            generation_check_seconds=0,
+        )
+    return _curators_cache
+
+
+def invalidate_curators():
+    get_curators_cache().invalidate()
+
+
+def get_curator_ids(deposit_id, owner_org_dest):
+    """
+    Return the ids of the users that can curate a deposited dataset with
+    this target: the admins and editors of the data deposit and the admins
+    of the target data container (same as helpers.get_data_curation_users)
+    """
+    if owner_org_dest == 'unknown':
+        owner_org_dest = None
+
+    cache = get_curators_cache()
+    key = owner_org_dest or '-'
+    curator_ids = cache.get(key)
+    if curator_ids is not None:
+        return set(curator_ids)
+
+    conditions = [
+        and_(
+            model.Member.group_id == deposit_id,
+            model.Member.capacity.in_(['admin', 'editor']),
+        )
+    ]
+    if owner_org_dest:
+        conditions.append(
+            and_(
+                model.Member.group_id == owner_org_dest,
+                model.Member.capacity == 'admin',
+            )
+        )
+    curator_ids = {
+        r[0] for r in
+        model.Session.query(model.Member.table_id)
+        .filter(model.Member.table_name == 'user')
+        .filter(model.Member.state == 'active')
+        .filter(or_(*conditions))
+        .all()
+    }
+    cache.set(key, sorted(curator_ids))
+    return curator_ids
+
+
+def is_member_of_owner_org(user_obj, owner_org):
+    """
+    Same answer as looking for owner_org in organization_list_for_user:
+    any capacity in the organization itself, or admin of a parent
+    """
+    if user_obj.sysadmin:
+        return True
+    member = (
+        model.Session.query(model.Member.id)
+        .join(model.Group, model.Group.id == model.Member.group_id)
+        .filter(model.Member.table_name == 'user')
+        .filter(model.Member.table_id == user_obj.id)
+        .filter(model.Member.group_id == owner_org)
+        .filter(model.Member.state == 'active')
+        .filter(model.Group.is_organization == True)
+        .filter(model.Group.state == 'active')
+        .first()
+    )
+    if member:
+        return True
+    return owner_org in container_tree.get_admin_container_ids(user_obj.id)
+
+
+def is_collaborator(user_obj, package_id):
+    if not authz.check_config_permission('allow_dataset_collaborators'):
+        return False
+    collaborator = (
+        model.Session.query(model.PackageMember.user_id)
+        .filter(model.PackageMember.package_id == package_id)
+        .filter(model.PackageMember.user_id == user_obj.id)
+        .first()
+    )
+    return collaborator is not None
+
+
+def get_download_access(user_obj, resource):
+    """
+    Decide if a user can download a resource file
+
+    Returns True or False when the custom rules give an answer, or None when
+    the standard `resource_show` check has to be applied.
+    """
+    dataset = resource.package
+    visibility = resource.extras.get('visibility')
+
+    if not user_obj or not visibility or visibility != 'restricted':
+        return None
+
+    if dataset.type == 'deposited-dataset':
+        if dataset.creator_user_id == user_obj.id:
+            return None
+        deposit = helpers.get_data_deposit()
+        curator_ids = get_curator_ids(deposit['id'], get_owner_org_dest(dataset))
+        if user_obj.id in curator_ids:
+            return None
+
+    # Restricted visibility (public metadata but private downloads)
+    if dataset.owner_org and is_member_of_owner_org(user_obj, dataset.owner_org):
+        return True
+
+    # Check if the user is a dataset collaborator
+    return is_collaborator(user_obj, dataset.id)
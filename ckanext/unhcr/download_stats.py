@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+from collections import Counter
+from sqlalchemy import and_, desc, func, select
+from sqlalchemy.dialects.postgresql import insert
+from ckan import model
+from ckanext.unhcr.models import DownloadStat
+
+
+def increment(events, connection=None):
+    """
+    Add the given 'download resource' activities (dicts with object_id,
+    user_id and timestamp) to the counters, with a single upsert
+    """
+    counts = Counter(
+        (event['object_id'], event['user_id'] or u'', event['timestamp'].date())
+        for event in events
+    )
+    if not counts:
+        return
+
+    table = DownloadStat.__table__
+    stmt = insert(table).values([
+        {'package_id': package_id, 'user_id': user_id, 'day': day, 'count': count}
+        for (package_id, user_id, day), count in counts.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.package_id, table.c.user_id, table.c.day],
+        set_={'count': table.c.count + stmt.excluded.count},
+    )
+    if connection is None:
+        model.Session.execute(stmt)
+        model.Session.commit()
+    else:
+        connection.execute(stmt)
+
+
+def rebuild():
+    """
+    Re-compute all the counters from the 'download resource' activities,
+    returns the number of downloads counted
+    """
+    activity_table = model.meta.metadata.tables['activity']
+    table = DownloadStat.__table__
+    user_id = func.coalesce(activity_table.c.user_id, u'')
+    day = func.date(activity_table.c.timestamp)
+    activities = select([
+        activity_table.c.object_id,
+        user_id,
+        day,
+        func.count(),
+    ]).where(
+        activity_table.c.activity_type == 'download resource'
+    ).group_by(
+        activity_table.c.object_id, user_id, day
+    )
+
+    with model.meta.engine.begin() as connection:
+        connection.execute(table.delete())
+        connection.execute(
+            table.insert().from_select(
+                ['package_id', 'user_id', 'day', 'count'], activities
+            )
+        )
+        total = connection.execute(select([func.coalesce(func.sum(table.c.count), 0)])).scalar()
+    return total
+
+
+def get_download_count(package_id):
+    return get_download_counts([package_id]).get(package_id, 0)
+
+
+def get_download_counts(package_ids):
+    """ Return a dict with the total number of downloads of each dataset """
+    if not package_ids:
+        return {}
+    rows = (
+        model.Session.query(DownloadStat.package_id, func.sum(DownloadStat.count))
+        .filter(DownloadStat.package_id.in_(package_ids))
+        .group_by(DownloadStat.package_id)
+        .all()
+    )
+    counts = {package_id: 0 for package_id in package_ids}
+    counts.update({package_id: int(count) for package_id, count in rows})
+    return counts
+
+
+def get_top_datasets(limit=10):
+    """
+    Return the most downloaded active datasets (deposited datasets
+    excluded) as package rows with a `count` column
+    """
+    package_table = model.meta.metadata.tables['package']
+    totals = select([
+        DownloadStat.package_id,
+        func.sum(DownloadStat.count).label('count'),
+    ]).group_by(DownloadStat.package_id).alias('totals')
+
+    sql = select(
+        [c for c in package_table.columns] + [totals.c.count]
+    ).select_from(
+        totals.join(package_table, package_table.c.id == totals.c.package_id)
+    ).where(
+        and_(
+            package_table.c.state == 'active',
+            package_table.c.type != 'deposited-dataset',
+        )
+    ).order_by(
+        desc(totals.c.count)
+    ).limit(limit)
+
+    return model.Session.execute(sql).fetchall()
+
+
+def get_top_users(exclude_user_names=None, limit=10):
+    """
+    Return the users with more downloads of active datasets (deposited
+    datasets excluded) as user rows with a `count` column
+    """
+    package_table = model.meta.metadata.tables['package']
+    user_table = model.meta.metadata.tables['user']
+    totals = select([
+        DownloadStat.user_id,
+        func.sum(DownloadStat.count).label('count'),
+    ]).select_from(
+        DownloadStat.__table__.join(
+            package_table, package_table.c.id == DownloadStat.package_id
+        )
+    ).where(
+        and_(
+            package_table.c.state == 'active',
+            package_table.c.type != 'deposited-dataset',
+        )
+    ).group_by(DownloadStat.user_id).alias('totals')
+
+    sql = select(
+        [c for c in user_table.columns] + [totals.c.count]
+    ).select_from(
+        totals.join(user_table, user_table.c.id == totals.c.user_id)
+    ).order_by(
+        desc(totals.c.count)
+    ).limit(limit)
+    if exclude_user_names:
+        sql = sql.where(user_table.c.name.notin_(exclude_user_names))
+
+    return model.Session.execute(sql).fetchall()
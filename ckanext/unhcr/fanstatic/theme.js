@@ -519,3 +519,40 @@ $( document ).ready(function() {
 	});
 
 });
+
+$( document ).ready(function() {
+
+  /*
+  Poll the progress of a running search index rebuild
+  */
+  var progress = $("#search-index-progress");
+  if (!progress.length || progress.data("state") != "running") {
+    return;
+  }
+
+  var poll = function() {
+    $.ajax({
+      url: progress.data("status-endpoint"),
+      type: 'GET',
+      success: function(response) {
+        var status = response.result;
+        var percent = status.chunks ? Math.round(100 * status.chunks_done / status.chunks) : 100;
+        progress.find(".progress-bar").css("width", percent + "%");
+        progress.find(".search-index-indexed").text(status.indexed);
+        progress.find(".search-index-chunks-done").text(status.chunks_done);
+        if (status.state == "running") {
+          setTimeout(poll, 3000);
+        } else {
+          // show the final state and errors
+          window.location.reload();
+        }
+      },
+      error: function() {
+        setTimeout(poll, 10000);
+      }
+    });
+  };
+
+  setTimeout(poll, 3000);
+
+});
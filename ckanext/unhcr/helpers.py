@@ -18,8 +18,10 @@ from ckanext.hierarchy import helpers as hierarchy_helpers
 from ckanext.scheming.helpers import (
     scheming_get_dataset_schema, scheming_field_by_name, scheming_get_organization_schema
 )
-from ckanext.unhcr import __VERSION__
-from ckanext.unhcr.models import AccessRequest, USER_REQUEST_TYPE_NEW, DEFAULT_GEOGRAPHY_CODE
+from ckanext.unhcr import __VERSION__, container_tree, download_stats, pending_requests, scan_status
+from ckanext.unhcr.models import (
+    AccessRequest, USER_REQUEST_TYPE_NEW, DEFAULT_GEOGRAPHY_CODE, resolve_geographies
+)
 from ckanext.unhcr.kobo import ALL_KOBO_EXPORT_FORMATS, FIXED_FIELDS_KOBO_EXPORT
 from ckanext.unhcr.kobo.exceptions import KoboApiError
 from ckanext.unhcr.kobo.kobo_dataset import KoboDataset
@@ -64,55 +66,44 @@ def get_all_data_containers(
     userobj=None,
     dataset=None,
 ):
-    if not exclude_ids:
-        exclude_ids = []
-    if not include_ids:
-        include_ids = []
-    include_ids = [id_ for id_ in include_ids if id_ and id_ != 'unknown']
+    exclude_ids = set(exclude_ids or [])
+    include_ids = {id_ for id_ in include_ids or [] if id_ and id_ != 'unknown'}
     if not userobj:
         userobj = toolkit.c.userobj
 
-    data_containers = []
-    context = {'model': model, 'ignore_auth': True}
-    orgs = toolkit.get_action('organization_list_all_fields')(context, {})
+    admin_ids = None
+    if (
+        # we're editing an existing dataset, not creating a new one
+        dataset
 
-    for org in orgs:
-        if org['id'] in exclude_ids:
-            continue
+        # sysadmins can always change the target to anything
+        and not userobj.sysadmin
+
+        # external users can always change the target of their own dataset to any visible_external container
+        and not userobj.external
+
+        # if I'm editing my own deposit, I can always change the target to anything
+        and 'creator_user_id' in dataset and dataset['creator_user_id'] != userobj.id
 
-        if org['approval_status'] != u'approved':
+        # curators can always change the target to anything
+        and not user_is_curator(userobj)
+    ):
+        admin_ids = container_tree.get_admin_container_ids(userobj.id)
+
+    data_containers = []
+    for org in container_tree.get_approved_data_containers():
+        if org['id'] in exclude_ids:
             continue
 
         if org['id'] in include_ids:
             data_containers.append(org)
             continue
 
-        if userobj.external and (
-            'visible_external' not in org or not org['visible_external']
-        ):
+        if userobj.external and not org.get('visible_external'):
             continue
 
-        if (
-            # we're editing an existing dataset, not creating a new one
-            dataset
-
-            # curators and sysadmins can always change the target to anything
-            and not user_is_curator(userobj)
-            and not userobj.sysadmin
-
-            # external users can always change the target of their own dataset to any visible_external container
-            and not userobj.external
-
-            # if I'm editing my own deposit, I can always change the target to anything
-            and 'creator_user_id' in dataset and dataset['creator_user_id'] != userobj.id
-        ):
-            user_orgs = toolkit.get_action('organization_list_for_user')(
-                context,
-                {'id': userobj.id, "permission": "admin"}
-            )
-            user_orgs_ids = [o['id'] for o in user_orgs]
-            if org['id'] not in user_orgs_ids:
-                continue
+        if admin_ids is not None and org['id'] not in admin_ids:
+            continue
 
         data_containers.append(org)
 
@@ -154,41 +145,47 @@ def get_allowable_parent_groups(group_id):
 
 def render_tree(top_nodes=None):
     '''Returns HTML for a hierarchy of all data containers'''
-    context = {'model': model, 'session': model.Session}
     if not top_nodes:
-        top_nodes = toolkit.get_action('group_tree')(
-            context,
-            data_dict={'type': 'data-container'})
+        # The whole tree is cached until a data container changes
+        return container_tree.get_rendered_tree(_render_full_tree)
 
-    # Remove data deposit
-    deposit = get_data_deposit()
-    top_nodes = filter(lambda node: node['id'] != deposit['id'], top_nodes)
+    return _render_tree(_remove_data_deposit(top_nodes))
 
-    return _render_tree(top_nodes)
+
+def _render_full_tree():
+    context = {'model': model, 'session': model.Session}
+    top_nodes = toolkit.get_action('group_tree')(
+        context,
+        data_dict={'type': 'data-container'})
+    return _render_tree(_remove_data_deposit(top_nodes))
+
+
+def _remove_data_deposit(top_nodes):
+    deposit = get_data_deposit()
+    return [node for node in top_nodes if node['id'] != deposit['id']]
 
 
 def _render_tree(top_nodes):
-    html = '<ul class="hierarchy-tree-top">'
+    html = ['<ul class="hierarchy-tree-top">']
     for node in top_nodes:
-        html += _render_tree_node(node)
-    return html + '</ul>'
-
+        _render_tree_node(node, html)
+    html.append('</ul>')
+    return ''.join(html)
 
-def _render_tree_node(node):
-    html = '<a href="/data-container/{}">{}</a>'.format(
-        node['name'], node['title'])
-    if node['children']:
-        html += '<ul class="hierarchy-tree">'
-        for child in node['children']:
-            html += _render_tree_node(child)
-        html += '</ul>'
 
+def _render_tree_node(node, html):
     if node['highlighted']:
-        html = '<li id="node_{}" class="highlighted">{}</li>'.format(
-            node['name'], html)
+        html.append('<li id="node_{}" class="highlighted">'.format(node['name']))
     else:
-        html = '<li id="node_{}">{}</li>'.format(node['name'], html)
-    return html
+        html.append('<li id="node_{}">'.format(node['name']))
+    html.append('<a href="/data-container/{}">{}</a>'.format(
+        node['name'], node['title']))
+    if node['children']:
+        html.append('<ul class="hierarchy-tree">')
+        for child in node['children']:
+            _render_tree_node(child, html)
+        html.append('</ul>')
+    html.append('</li>')
 
 
 # Access restriction
@@ -398,12 +395,11 @@ def get_linked_datasets_for_display(value, context=None):
 def get_geographies_for_display(value):
     geogs = []
     ids = normalize_list(value)
+    resolved = resolve_geographies(ids)
     for id_ in ids:
-        try:
-            geog = toolkit.get_action('geography_show')({}, {'id': id_})
-            geogs.append(geog)
-        except toolkit.ObjectNotFound:
-            pass
+        if id_ in resolved:
+            geog, parents = resolved[id_]
+            geogs.append(geog.dictize(include_parents=True, parents=parents))
     geogs = sorted(geogs, key=lambda k: k['name'])
     return geogs
 
@@ -415,21 +411,26 @@ def get_default_geography():
 
 def get_pending_requests_total(context=None):
     context = context or {'model': model, 'user': toolkit.c.user}
+    return pending_requests.get_total(
+        context.get('user'), lambda: _count_pending_requests(context)
+    )
+
+
+def _count_pending_requests(context):
     total = 0
 
     try:
         container_requests = toolkit.get_action('container_request_list')(
-            context, {'all_fields': False}
+            context.copy(), {'all_fields': False}
         )
         total += container_requests['count']
     except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
         pass
 
     try:
-        access_requests = toolkit.get_action('access_request_list_for_user')(
-            context, {}
+        total += toolkit.get_action('access_request_list_for_user')(
+            context.copy(), {'count_only': True}
         )
-        total += len(access_requests)
     except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
         pass
 
@@ -1048,25 +1049,65 @@ def current_path(action=None):
     return path
 
 
+_schema_labels_cache = {}
+def get_schema_labels(dataset_type):
+    '''
+    Return lookup tables for the field and choice labels of a dataset schema
+
+    The tables are built once per process and rebuilt whenever scheming
+    returns a different schema object (eg the schemas were reloaded)
+
+    :param dataset_type: The scheming dataset type (eg "dataset")
+    :type dataset_type: string
+
+    :returns: A dict with the keys "dataset_fields" and "resource_fields"
+        (field name to field label) and "dataset_choices" and
+        "resource_choices" ((field name, choice value) to choice label)
+    :rtype: dict
+    '''
+    schema = scheming_get_dataset_schema(dataset_type)
+    cached = _schema_labels_cache.get(dataset_type)
+    if cached and cached[0] is schema:
+        return cached[1]
+
+    labels = {}
+    for key in ['dataset', 'resource']:
+        fields = {}
+        choices = {}
+        for field in (schema or {}).get('{}_fields'.format(key), []):
+            name = field['field_name']
+            # keep the first match, like scheming_field_by_name does
+            if name in fields:
+                continue
+            fields[name] = field.get('label', name)
+            for choice in field.get('choices', []):
+                choices.setdefault((name, choice.get('value')), choice.get('label'))
+        labels['{}_fields'.format(key)] = fields
+        labels['{}_choices'.format(key)] = choices
+
+    _schema_labels_cache[dataset_type] = (schema, labels)
+    return labels
+
+
 def get_field_label(name, is_resource=False):
-    schema = scheming_get_dataset_schema('deposited-dataset')
-    fields = schema['resource_fields'] if is_resource else schema['dataset_fields']
-    field = scheming_field_by_name(fields, name)
-    if field:
-        return field.get('label', name)
+    labels = get_schema_labels('deposited-dataset')
+    fields = labels['resource_fields'] if is_resource else labels['dataset_fields']
+    if name in fields:
+        return fields[name]
     else:
         log.warning('Could not get field {} from deposited-dataset schema'.format(name))
 
 
 def get_choice_label(name, value, is_resource=False):
-    schema = scheming_get_dataset_schema('deposited-dataset')
-    fields = schema['resource_fields'] if is_resource else schema['dataset_fields']
-    field = scheming_field_by_name(fields, name)
-    if field:
-        for choice in field.get('choices', []):
-            if choice.get('value') == value:
-                return choice.get('label')
-        return value
+    labels = get_schema_labels('deposited-dataset')
+    fields = labels['resource_fields'] if is_resource else labels['dataset_fields']
+    choices = labels['resource_choices'] if is_resource else labels['dataset_choices']
+    if name in fields:
+        try:
+            return choices.get((name, value), value)
+        except TypeError:
+            # unhashable values can't match any choice
+            return value
     else:
         log.warning('Could not get field {} from deposited-dataset schema'.format(name))
 
@@ -1095,6 +1136,21 @@ def normalize_list(value):
     return value.split(',')
 
 
+def get_dataset_download_count(package_id):
+    return download_stats.get_download_count(package_id)
+
+
+def get_blocked_resource_ids(package_dict):
+    """ Ids of the resources of the dataset whose file is infected (one query) """
+    return scan_status.get_infected_ids(
+        [resource['id'] for resource in package_dict.get('resources', [])]
+    )
+
+
+def resource_is_blocked(resource_id):
+    return scan_status.is_infected(resource_id)
+
+
 def can_download(package_dict):
     """ True if the user can download ALL resources
         If one resource is not accessible, return False """
@@ -1,4 +1,4 @@
-from ckanext.unhcr.kobo.exceptions import KoboApiError
+from ckanext.unhcr.kobo.exceptions import KoboApiError, KoBoSurveyError
 from functools import wraps
 import datetime
 import logging
@@ -6,8 +6,9 @@ import time
 
 from ckan import model
 from ckan.authz import get_group_or_org_admin_ids
-from ckanext.unhcr import utils
+from ckanext.unhcr import search_index, utils
 from ckanext.unhcr.helpers import get_random_sysadmin
+from ckanext.unhcr.kobo import export_poller
 from ckanext.unhcr.kobo.filters import process_resource_kobo_filters
 import ckan.plugins.toolkit as toolkit
 
@@ -224,6 +225,14 @@ def update_pkg_kobo_resources(kobo_asset_id, user_id):
     kd.update_all_resources(user_id)
 
 
+def rebuild_search_index_chunk(rebuild_id, number, package_ids):
+    """ Index one chunk of a search index rebuild (see the search_index_rebuild action) """
+    log.info('Indexing chunk {} of search index rebuild {}'.format(number, rebuild_id))
+    errors = search_index.index_chunk(rebuild_id, number, package_ids)
+    for error in errors:
+        log.error(error)
+
+
 def update_kobo_resource(resource_id, user_id):
     """ Update a kobo resource
         For data resources: create an export and download the data in a new job
@@ -343,20 +352,31 @@ def download_kobo_file(resource_id):
         except (KoboApiError, ValueError) as e:
             _kobo_job_error(kd, resource, user_obj, 'Error downloading questionnaire {}'.format(e))
             return
-        kd.update_resource(resource, local_file, user_obj.name)
+        kd.update_resource(resource, local_file, user_obj.name, survey.last_download)
         return
 
     if resource['format'].lower() == 'json':
+        # only fetch the submissions newer than the ones already saved
+        since = None
+        if toolkit.asbool(toolkit.config.get('ckanext.unhcr.kobo_json_delta_sync', False)):
+            since = kobo_details.get('kobo_last_submission_time')
         try:
             local_file = survey.download_json_data(
                 destination_path=kd.upload_path,
-                resource_name=resource.get('name', 'unnamed-resource')
+                resource_name=resource.get('name', 'unnamed-resource'),
+                since=since,
             )
-        except (KoboApiError, ValueError) as e:
+        except (KoboApiError, KoBoSurveyError, ValueError) as e:
             _kobo_job_error(kd, resource, user_obj, 'Error downloading json kobo data {}'.format(e))
             return
 
-        kd.update_resource(resource, local_file, user_obj.name)
+        try:
+            kd.update_resource(resource, local_file, user_obj.name, survey.last_download)
+        except Exception:
+            # the next delta sync starts again from the saved file and submission time
+            survey.discard_json_data(local_file)
+            raise
+        survey.save_json_data(local_file)
         return
 
     # CSV and XLS require export and download
@@ -384,24 +404,32 @@ def download_kobo_file(resource_id):
             _kobo_job_error(kd, resource, user_obj, 'Error downloading kobo data {}'.format(e))
             return
 
-        kd.update_resource(resource, local_file, user_obj.name)
+        kd.update_resource(resource, local_file, user_obj.name, survey.last_download)
 
     elif export['status'] in ['processing', 'created']:
-        # wait and re-schedule
+        # check again later (see poll_kobo_exports), without keeping the worker busy
         kobo_download_attempts = kobo_details['kobo_download_attempts'] + 1
-        if kobo_download_attempts > 5:
+        if kobo_download_attempts > export_poller.get_max_attempts():
             error = 'Failed to download KoBoToolbox data resource {}. ' \
                     'Last export status from KoBo: {}'.format(resource['id'], export)
             _kobo_job_error(kd, resource, user_obj, error)
         else:
             kd.update_kobo_details(resource, user_obj.name, {"kobo_download_attempts": kobo_download_attempts})
-            time.sleep(30 * kobo_download_attempts)
-            toolkit.enqueue_job(
-                download_kobo_file,
-                [resource['id']],
-                title='Re-scheduling KoBoToolbox download: {}'.format(kobo_download_attempts)
-            )
+            export_poller.schedule_check(resource['id'], kobo_download_attempts)
     else:  # status = 'error' or unknown
         error = 'KoBo export error for resource {}. ' \
                 'Last export status from KoBo: {}'.format(resource['id'], export)
         _kobo_job_error(kd, resource, user_obj, error)
+
+
+def poll_kobo_exports():
+    """ Enqueue a download job for each pending KoBo export whose check is due.
+        Run it periodically (`ckan unhcr poll-kobo-exports`) """
+    resource_ids = export_poller.claim_due_checks()
+    for resource_id in resource_ids:
+        toolkit.enqueue_job(
+            download_kobo_file,
+            [resource_id],
+            title='Checking KoBoToolbox export for resource {}'.format(resource_id)
+        )
+    return len(resource_ids)
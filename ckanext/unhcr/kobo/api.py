@@ -3,17 +3,61 @@ import hashlib
 import json
 import logging
 import os
+import shutil
+import tempfile
+import threading
 import requests
-from redis import Redis, ConnectionPool
-from redis.exceptions import ConnectionError
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
+from urllib3.util.retry import Retry
 from requests.exceptions import ConnectionError, HTTPError, Timeout
 from ckan.common import config
-from ckanext.unhcr.kobo import VALID_KOBO_EXPORT_FORMATS
+from ckanext.unhcr.cache import get_redis
+from ckanext.unhcr.kobo import VALID_KOBO_EXPORT_FORMATS, rate_limit
 from ckanext.unhcr.kobo.exceptions import KoboApiError, KoBoSurveyError
 
 
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+JSON_INDENT = 4
+# JSON data is downloaded here and moved next to it once the resource is updated
+JSON_STAGING_DIR = '.staging'
+SUBMISSION_TIMES_CACHE_SECONDS = 7 * 24 * 3600
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """ Return the HTTP session shared by all the KoBoAPI instances of this process,
+        so connections to KoBoToolbox are kept alive and reused.
+        GET requests are retried on connection errors and 429/5xx responses """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retries = Retry(
+                total=int(config.get('ckanext.unhcr.kobo_retries', 3)),
+                backoff_factor=float(config.get('ckanext.unhcr.kobo_backoff_seconds', 0.5)),
+                status_forcelist=RETRY_STATUS_CODES,
+                raise_on_status=False,
+            )
+            pool_size = int(config.get('ckanext.unhcr.kobo_pool_size', 10))
+            adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retries)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+
+def get_timeout():
+    """ (connect, read) timeouts for KoBo requests """
+    return (
+        float(config.get('ckanext.unhcr.kobo_connect_timeout', 10)),
+        float(config.get('ckanext.unhcr.kobo_read_timeout', 60)),
+    )
+
 
 class KoBoAPI:
     """ About KoBo API
@@ -26,16 +70,8 @@ class KoBoAPI:
         self.surveys = None
         self._user = None
         self.cache_seconds = int(config.get('ckanext.unhcr.kobo_cache_seconds', '600'))
-        redis_url = config.get('ckan.redis.url', 'redis://localhost:6379/0')
-        if self.cache_seconds == 0:
-            self.cache = None
-        else:
-            try:
-                redis_pool = ConnectionPool.from_url(redis_url)
-                self.cache = Redis(connection_pool=redis_pool)
-            except ConnectionError:
-                logger.error('Error connecting to Redis cache: {} {} {}'.format(redis_url))
-                self.cache = None
+        # all the instances share the Redis connection pool
+        self.cache = get_redis() if self.cache_seconds else None
 
     def _get(self, resource_url, return_json=True, force=False):
         """ Get any api/v2 resource in JSON format (or base response)
@@ -45,12 +81,8 @@ class KoBoAPI:
         url = resource_url if resource_url.startswith('http') else self.base_url + resource_url
         logger.info('Getting KoBoToolbox resource: {}'.format(resource_url))
         if return_json:
+            cache_key = self._get_cache_key(url)
             if self.cache and not force:
-                # Different users calls the same URLs so we need unique cache keys
-                # For security, we don't use the token as is.
-                hashed_token = hashlib.sha256(self.token.encode('utf-8')).hexdigest()
-                cache_name = '{}__{}'.format(hashed_token, url)
-                cache_key = base64.b64encode(cache_name.encode())
                 if self.cache.get(cache_key):
                     data = json.loads(self.cache.get(cache_key))
                     logger.info('Using cache for KoBo response: {}'.format(resource_url))
@@ -59,7 +91,7 @@ class KoBoAPI:
             logger.info('Resource not cached: {}'.format(resource_url))
 
         try:
-            response = requests.get(url, headers={'Authorization': 'Token ' + self.token})
+            response = self._request('get', url)
             response.raise_for_status()
         except (ConnectionError, HTTPError, Timeout) as e:
             logger.error('Error getting KoBoToolbox resource {}: {}'.format(resource_url, e))
@@ -77,15 +109,69 @@ class KoBoAPI:
         else:
             return response
 
+    def _request(self, method, url, **kwargs):
+        """ Request KoBo over the shared session, within the rate limit of this token """
+        rate_limit.throttle(hashlib.sha256(self.token.encode('utf-8')).hexdigest())
+        return get_session().request(
+            method,
+            url,
+            headers={'Authorization': 'Token ' + self.token},
+            timeout=get_timeout(),
+            **kwargs
+        )
+
+    def _get_cache_key(self, name):
+        """ Different users calls the same URLs so we need unique cache keys
+            For security, we don't use the token as is. """
+        hashed_token = hashlib.sha256(self.token.encode('utf-8')).hexdigest()
+        cache_name = '{}__{}'.format(hashed_token, name)
+        return base64.b64encode(cache_name.encode())
+
+    def _download(self, resource_url, file_path, chunk_size=None):
+        """ Stream a KoBo file to disk, without holding it in memory.
+            The file is written next to file_path and renamed when complete,
+            so a failed download never leaves a partial file behind.
+            Returns the size and SHA-256 checksum of the file """
+        url = resource_url if resource_url.startswith('http') else self.base_url + resource_url
+        logger.info('Downloading KoBoToolbox file: {}'.format(resource_url))
+
+        sha256 = hashlib.sha256()
+        size = 0
+        tmp_file = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(file_path),
+            prefix='.{}.'.format(os.path.basename(file_path)),
+            suffix='.part',
+            delete=False,
+        )
+        try:
+            with tmp_file:
+                with self._request('get', url, stream=True) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size=chunk_size or DOWNLOAD_CHUNK_SIZE):
+                        tmp_file.write(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+            os.replace(tmp_file.name, file_path)
+        except (ConnectionError, HTTPError, Timeout) as e:
+            os.remove(tmp_file.name)
+            logger.error('Error downloading KoBoToolbox file {}: {}'.format(resource_url, e))
+            raise KoboApiError('Error downloading file from KoBoToolbox {}'.format(e))
+        except Exception:
+            os.remove(tmp_file.name)
+            raise
+
+        return {'size': size, 'sha256': sha256.hexdigest()}
+
     def _post(self, resource_url, data):
         """ POST to KoBo API """
         url = resource_url if resource_url.startswith('http') else self.base_url + resource_url
         try:
-            response = requests.post(url, json=data, headers={'Authorization': 'Token ' + self.token})
+            response = self._request('post', url, json=data)
             response.raise_for_status()
         except (ConnectionError, HTTPError, Timeout) as e:
             logger.error('Error posting KoBoToolbox {}: {}'.format(resource_url, e))
-            raise KoboApiError('Error posting data to KoBoToolbox {}: data: {} :: {}'.format(e, data, response.text))
+            response_text = e.response.text if e.response is not None else ''
+            raise KoboApiError('Error posting data to KoBoToolbox {}: data: {} :: {}'.format(e, data, response_text))
 
         return response
 
@@ -108,10 +194,10 @@ class KoBoAPI:
 
         return self.surveys
 
-    def get_asset(self, asset_id):
+    def get_asset(self, asset_id, force=False):
         """ get a single asset """
         resource_url = 'assets/{}.json'.format(asset_id)
-        asset = self._get(resource_url)
+        asset = self._get(resource_url, force=force)
         asset['user_is_manager'] = self._detect_manager_permission(asset)
 
         return asset
@@ -148,23 +234,31 @@ class KoBoSurvey:
         self.asset_id = asset_id
         self.asset = None
         self.data = None
+        # size and checksum of the last downloaded file
+        self.last_download = None
+        self.submission_times = None
 
-    def load_asset(self):
+    def load_asset(self, force=False):
         """ Load basic asset metadata """
-        if self.asset is None:
-            self.asset = self.kobo_api.get_asset(self.asset_id)
+        if self.asset is None or force:
+            self.asset = self.kobo_api.get_asset(self.asset_id, force=force)
 
-    def load_data(self):
-        """ Load actual data from survey """
+    def iter_data(self, query=None):
+        """ Iterate over the survey submissions, one page of data.json at a time
+            query: KoBo (MongoDB syntax) filter, e.g. {"_submission_time": {"$gt": "..."}} """
         next_url = 'assets/{}/data.json'.format(self.asset_id)
-        data = []
+        if query:
+            next_url += '?query={}'.format(quote(json.dumps(query)))
         while next_url:
             response = self.kobo_api._get(next_url)
-            data += response['results']
+            for submission in response['results']:
+                yield submission
             next_url = response.get('next')
 
-        self.data = data
-        return data
+    def load_data(self):
+        """ Load actual data from survey """
+        self.data = list(self.iter_data())
+        return self.data
 
     def get_total_submissions(self):
         """ Count all submissions for a survey """
@@ -189,24 +283,69 @@ class KoBoSurvey:
         logger.info('Downloading questionnaire for asset {}'.format(self.asset_id))
         file_name = '{}.{}'.format(self.asset_id, dformat)
         url = 'assets/{}'.format(file_name)
-        response = self.kobo_api._get(url, return_json=False)
-
         file_path = os.path.join(destination_path, file_name)
-        open(file_path, 'wb').write(response.content)
+        self.last_download = self.kobo_api._download(url, file_path)
 
         return file_path
 
-    def download_json_data(self, destination_path, resource_name):
-        """ Download JSON survey data (do not require export) """
+    def download_json_data(self, destination_path, resource_name, since=None):
+        """ Download JSON survey data (do not require export)
+            Submissions are written to the file as they arrive (same output as
+            json.dumps(submissions, indent=4)) and the first and last submission
+            times are tracked on the way.
+            since: last submission time already saved, to only fetch newer submissions
+            and append them to the saved file (a full download is done if the
+            file is missing)
+            The new file is left in a staging directory: call save_json_data once
+            the resource is updated, so the next delta starts from it (or
+            discard_json_data if the update failed) """
         file_name = '{}__{}_data.json'.format(resource_name, self.asset_id)
         file_path = os.path.join(destination_path, file_name)
-
-        data = self.load_data()
-        final_data = json.dumps(data, indent=4)
-        open(file_path, 'w').write(final_data)
-
+        if not os.path.exists(file_path):
+            since = None
+        staging_path = os.path.join(destination_path, JSON_STAGING_DIR)
+        os.makedirs(staging_path, exist_ok=True)
+        staged_file_path = os.path.join(staging_path, file_name)
+
+        tmp_file = tempfile.NamedTemporaryFile(
+            dir=staging_path,
+            prefix='.{}.'.format(file_name),
+            suffix='.part',
+            delete=False,
+        )
+        try:
+            with tmp_file:
+                if since:
+                    with open(file_path, 'rb') as existing:
+                        shutil.copyfileobj(existing, tmp_file)
+                    query = {'_submission_time': {'$gt': since}}
+                    stats = _append_json_array(tmp_file, self.iter_data(query=query))
+                else:
+                    stats = _write_json_array(tmp_file, self.iter_data())
+            os.replace(tmp_file.name, staged_file_path)
+        except Exception:
+            os.remove(tmp_file.name)
+            raise
+
+        stats.update(_get_file_info(staged_file_path))
+        stats['delta'] = bool(since)
+        self.last_download = stats
+        if not since:
+            self.submission_times = (stats['first_submission_time'], stats['last_submission_time'])
+        return staged_file_path
+
+    def save_json_data(self, staged_file_path):
+        """ Replace the saved JSON data file with the one left by download_json_data """
+        staging_path, file_name = os.path.split(staged_file_path)
+        file_path = os.path.join(os.path.dirname(staging_path), file_name)
+        os.replace(staged_file_path, file_path)
         return file_path
 
+    def discard_json_data(self, staged_file_path):
+        """ Remove the file left by download_json_data, the saved one is kept """
+        if os.path.exists(staged_file_path):
+            os.remove(staged_file_path)
+
     def download_data(self, destination_path, resource_name, dformat, url):
         """ Download survey data (require previous export) """
         if dformat.lower() not in VALID_KOBO_EXPORT_FORMATS.keys():
@@ -216,28 +355,54 @@ class KoBoSurvey:
         file_name = '{}__{}_data.{}'.format(resource_name, self.asset_id, extension)
         file_path = os.path.join(destination_path, file_name)
         # require private download
-        response = self.kobo_api._get(url, return_json=False)
-        if dformat.lower() in ['xls', 'spss_labels']:
-            final_data = response.content
-            open(file_path, 'wb').write(final_data)
-        else:  # csv and geojson are text files
-            final_data = response.text
-            open(file_path, 'w').write(final_data)
+        # csv and geojson are text files, they are also copied byte by byte
+        self.last_download = self.kobo_api._download(url, file_path)
 
         return file_path
 
     def get_submission_times(self):
-        """ read all submissions and get the first and the last one """
-        if self.data is None:
-            self.load_data()
-        if len(self.data) == 0:
-            return None, None
-
-        sorted_list = sorted(self.data, key=lambda k: k['_submission_time'])
-        first_submission = sorted_list[0]
-        last_submission = sorted_list[-1]
-
-        return first_submission['_submission_time'], last_submission['_submission_time']
+        """ Get the time of the first and the last submission
+            KoBo is asked for these two submissions only, and the result is cached
+            until a new submission is received (deployment__last_submission_time) """
+        if self.submission_times is not None:
+            return self.submission_times
+
+        self.load_asset(force=True)
+        validator = self.asset.get('deployment__last_submission_time')
+        cache = self.kobo_api.cache
+        cache_key = self.kobo_api._get_cache_key('submission_times__{}'.format(self.asset_id))
+        if cache and validator:
+            cached = cache.get(cache_key)
+            if cached:
+                cached = json.loads(cached)
+                if cached['validator'] == validator:
+                    self.submission_times = (cached['first'], cached['last'])
+                    return self.submission_times
+
+        first = self._get_edge_submission_time(ascending=True)
+        last = self._get_edge_submission_time(ascending=False) if first else None
+        self.submission_times = (first, last)
+
+        if cache and validator:
+            cache.set(
+                cache_key,
+                json.dumps({'validator': validator, 'first': first, 'last': last}),
+                ex=SUBMISSION_TIMES_CACHE_SECONDS,
+            )
+        return self.submission_times
+
+    def _get_edge_submission_time(self, ascending=True):
+        """ _submission_time of the first (or last) submission, None if there are no submissions """
+        resource_url = 'assets/{}/data.json?sort={}&limit=1&fields={}'.format(
+            self.asset_id,
+            quote(json.dumps({'_submission_time': 1 if ascending else -1})),
+            quote(json.dumps(['_submission_time'])),
+        )
+        response = self.kobo_api._get(resource_url, force=True)
+        results = response.get('results') or []
+        if not results:
+            return None
+        return results[0].get('_submission_time')
 
     def create_export(
         self,
@@ -280,3 +445,86 @@ class KoBoSurvey:
         data = response.json()
         logger.info('KoBoToolbox Export created {}'.format(data))
         return data
+
+
+
+def _min_max(first, last, value):
+    if value is None:
+        return first, last
+    if first is None or value < first:
+        first = value
+    if last is None or value > last:
+        last = value
+    return first, last
+
+
+def _dump_submission(submission):
+    """ A submission as an item of an array dumped with indent=JSON_INDENT """
+    padding = ' ' * JSON_INDENT
+    dumped = json.dumps(submission, indent=JSON_INDENT)
+    return padding + dumped.replace('\n', '\n' + padding)
+
+
+def _write_submissions(json_file, submissions, first_separator):
+    """ Write the submissions one by one, returns the count and the time range """
+    count = 0
+    first, last = None, None
+    for submission in submissions:
+        json_file.write(b',\n' if count else first_separator)
+        json_file.write(_dump_submission(submission).encode('utf-8'))
+        first, last = _min_max(first, last, submission.get('_submission_time'))
+        count += 1
+    return {'submissions': count, 'first_submission_time': first, 'last_submission_time': last}
+
+
+def _write_json_array(json_file, submissions):
+    """ Write a JSON array of submissions without holding them in memory """
+    json_file.write(b'[')
+    stats = _write_submissions(json_file, submissions, b'\n')
+    # an empty array is written as json.dumps([]) does
+    json_file.write(b'\n]' if stats['submissions'] else b']')
+    return stats
+
+
+def _append_json_array(json_file, submissions):
+    """ Append submissions to the JSON array at the end of json_file """
+    # find the closing bracket of the array
+    char = b''
+    position = json_file.seek(0, os.SEEK_END)
+    while position > 0:
+        position -= 1
+        json_file.seek(position)
+        char = json_file.read(1)
+        if not char.isspace():
+            break
+    if char != b']':
+        raise KoBoSurveyError('Invalid JSON data file, a JSON array was expected')
+
+    # and the last item (or the opening bracket if the array is empty)
+    while position > 0:
+        position -= 1
+        json_file.seek(position)
+        char = json_file.read(1)
+        if not char.isspace():
+            break
+    is_empty = char == b'['
+
+    json_file.seek(position + 1)
+    json_file.truncate()
+    stats = _write_submissions(json_file, submissions, b'\n' if is_empty else b',\n')
+    if is_empty and not stats['submissions']:
+        json_file.write(b']')
+    else:
+        json_file.write(b'\n]')
+    return stats
+
+
+def _get_file_info(file_path):
+    """ Size and SHA-256 checksum of a file, read in chunks """
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+    return {'size': size, 'sha256': sha256.hexdigest()}
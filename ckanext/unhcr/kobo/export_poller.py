@@ -0,0 +1,59 @@
+import logging
+import time
+from ckan.plugins import toolkit
+from ckanext.unhcr.cache import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+# Sorted set of the resources waiting for a KoBo export, scored by the time of their next check
+PENDING_EXPORTS_KEY = 'ckanext-unhcr:kobo-pending-exports'
+
+
+def get_max_attempts():
+    return toolkit.asint(toolkit.config.get('ckanext.unhcr.kobo_export_max_attempts', 5))
+
+
+def get_delay(attempts):
+    """ Seconds to wait before the next check of an export, growing with the attempts """
+    poll_seconds = float(toolkit.config.get('ckanext.unhcr.kobo_export_poll_seconds', 30))
+    backoff = float(toolkit.config.get('ckanext.unhcr.kobo_export_poll_backoff', 2))
+    max_seconds = float(toolkit.config.get('ckanext.unhcr.kobo_export_poll_max_seconds', 600))
+    return min(poll_seconds * backoff ** max(attempts - 1, 0), max_seconds)
+
+
+def schedule_check(resource_id, attempts):
+    """ Check again the export of this resource after the backoff delay.
+        A resource is scheduled only once, the last call wins """
+    next_check = time.time() + get_delay(attempts)
+    get_redis().zadd(PENDING_EXPORTS_KEY, {resource_id: next_check})
+    return next_check
+
+
+def claim_due_checks(limit=None):
+    """ Remove and return the resources whose next check is due.
+        A resource claimed by another sweep is skipped """
+    redis = get_redis()
+    if limit:
+        due = redis.zrangebyscore(PENDING_EXPORTS_KEY, '-inf', time.time(), start=0, num=limit)
+    else:
+        due = redis.zrangebyscore(PENDING_EXPORTS_KEY, '-inf', time.time())
+    claimed = []
+    for resource_id in due:
+        if redis.zrem(PENDING_EXPORTS_KEY, resource_id):
+            claimed.append(resource_id.decode('utf-8'))
+    return claimed
+
+
+def get_stats():
+    """ Exports in flight (waiting for KoBo) and how many of them are due for a check """
+    redis = get_redis()
+    now = time.time()
+    in_flight = redis.zcard(PENDING_EXPORTS_KEY)
+    due = redis.zcount(PENDING_EXPORTS_KEY, '-inf', now)
+    next_check = redis.zrange(PENDING_EXPORTS_KEY, 0, 0, withscores=True)
+    return {
+        'in_flight': in_flight,
+        'due': due,
+        'next_check_in_seconds': max(next_check[0][1] - now, 0) if next_check else None,
+    }
@@ -333,8 +333,10 @@ class KoboDataset:
         )
         return resource
 
-    def update_resource(self, resource_dict, local_file, user_name):
-        """ Update the resource with real data """
+    def update_resource(self, resource_dict, local_file, user_name, file_info=None):
+        """ Update the resource with real data
+            file_info: size and sha256 of the downloaded file (if known)
+            and the submissions time range for JSON data """
         logger.info('Updating resource {} from file {}'.format(resource_dict['id'], local_file))
         context = {'user': user_name, 'job': True}
         if not resource_dict:
@@ -347,6 +349,19 @@ class KoboDataset:
         kobo_details['kobo_download_status'] = 'complete'
         kobo_details['kobo_download_attempts'] = kobo_download_attempts + 1
         kobo_details['kobo_last_updated'] = datetime.datetime.utcnow().isoformat()
+        if file_info:
+            kobo_details['kobo_file_size'] = file_info['size']
+            kobo_details['kobo_file_sha256'] = file_info['sha256']
+        if file_info and 'submissions' in file_info:
+            # JSON data, for the next delta sync
+            if not file_info.get('delta'):
+                kobo_details['kobo_first_submission_time'] = file_info['first_submission_time']
+                kobo_details['kobo_last_submission_time'] = file_info['last_submission_time']
+            elif file_info['last_submission_time']:
+                kobo_details['kobo_first_submission_time'] = (
+                    kobo_details.get('kobo_first_submission_time') or file_info['first_submission_time']
+                )
+                kobo_details['kobo_last_submission_time'] = file_info['last_submission_time']
 
         resource = toolkit.get_action('resource_patch')(
             context,
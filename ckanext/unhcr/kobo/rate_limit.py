@@ -0,0 +1,85 @@
+import logging
+import time
+from redis.exceptions import RedisError
+from rq import get_current_job
+from ckan.plugins import toolkit
+from ckanext.unhcr.cache import get_redis
+from ckanext.unhcr.kobo.exceptions import KoboApiError
+
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'ckanext-unhcr:kobo-rate-limit:'
+
+# Token bucket stored in a Redis hash, so all the web and worker processes share it.
+# Each call refills the bucket for the time elapsed, takes one token and returns the
+# seconds the caller must wait for it (the bucket goes below zero for reserved tokens).
+# If the wait is longer than the max wait (when not negative) no token is reserved
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - timestamp, 0) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if max_wait >= 0 and wait > max_wait then
+    return tostring(wait)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'timestamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens + 1) / rate) + 1)
+return tostring(wait)
+'''
+
+
+def get_rate():
+    """ Requests per second allowed for each KoBo token (0 to disable the limit) """
+    return float(toolkit.config.get('ckanext.unhcr.kobo_rate_limit', 5))
+
+
+def get_burst():
+    return max(float(toolkit.config.get('ckanext.unhcr.kobo_rate_limit_burst', 10)), 1)
+
+
+def get_max_wait():
+    """ Seconds a web request can wait for KoBo (None inside background jobs, they always wait) """
+    if get_current_job() is not None:
+        return None
+    return float(toolkit.config.get('ckanext.unhcr.kobo_rate_limit_max_wait', 10))
+
+
+def acquire(name, now=None, max_wait=None):
+    """ Take a token from the bucket `name`, returns the seconds to wait before using it.
+        No token is taken if the wait is longer than `max_wait` """
+    rate = get_rate()
+    if rate <= 0:
+        return 0
+    if now is None:
+        now = time.time()
+    if max_wait is None:
+        max_wait = -1
+    try:
+        wait = get_redis().eval(
+            TOKEN_BUCKET_SCRIPT, 1, KEY_PREFIX + name, rate, get_burst(), now, max_wait
+        )
+    except RedisError as e:
+        logger.error('KoBo rate limit not applied, error connecting to Redis: {}'.format(e))
+        return 0
+    return float(wait)
+
+
+def throttle(name):
+    """ Wait until a request to KoBo is allowed for the bucket `name`.
+        Raise KoboApiError if that takes longer than the max wait """
+    max_wait = get_max_wait()
+    wait = acquire(name, max_wait=max_wait)
+    if max_wait is not None and wait > max_wait:
+        raise KoboApiError('KoBo rate limit reached, try again in {:.0f} seconds'.format(wait))
+    if wait > 0:
+        logger.info('KoBo rate limit reached, waiting {:.2f}s'.format(wait))
+        time.sleep(wait)
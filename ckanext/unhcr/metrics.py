@@ -1,27 +1,145 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from operator import itemgetter
+import flask
 from slugify import slugify
 from sqlalchemy import and_, desc, func, select
 import ckan.model as model
+from ckan.lib.plugins import get_permission_labels
 import ckan.plugins.toolkit as toolkit
-from ckanext.unhcr.models import TimeSeriesMetric
+from ckanext.unhcr import download_stats
+from ckanext.unhcr.cache import TieredCache
+from ckanext.unhcr.models import DownloadStat, TimeSeriesMetric
 
 
-def _get_timeseries_metric(field):
-    sql = select([
-        func.date(TimeSeriesMetric.timestamp).label('date'),
-        getattr(TimeSeriesMetric, field)
-    ]).order_by(
-        TimeSeriesMetric.timestamp
+log = logging.getLogger(__name__)
+
+_metrics_cache = None
+
+
+TIMESERIES_BUCKETS = ['day', 'week', 'month']
+
+
+def get_timeseries(fields, bucket=None, start=None, end=None):
+    """
+    Return the snapshots of the given TimeSeriesMetric fields, one per day,
+    week or month (the last snapshot taken in each of them), as a list of
+    (date, {field: value}) tuples sorted by date
+
+    Buckets are computed in SQL with DISTINCT ON, and only the snapshots taken
+    between `start` and `end` (dates, both optional) are read. The default
+    bucket and range come from `ckanext.unhcr.metrics_timeseries_bucket`
+    and `ckanext.unhcr.metrics_timeseries_days`
+    """
+    if bucket is None:
+        bucket = toolkit.config.get('ckanext.unhcr.metrics_timeseries_bucket', 'day')
+    if bucket not in TIMESERIES_BUCKETS:
+        raise toolkit.ValidationError({'bucket': ['Must be one of: {}'.format(
+            ', '.join(TIMESERIES_BUCKETS))]})
+    if start is None:
+        days = toolkit.asint(toolkit.config.get('ckanext.unhcr.metrics_timeseries_days', 0))
+        if days > 0:
+            start = datetime.date.today() - datetime.timedelta(days=days)
+
+    date = func.date(func.date_trunc(bucket, TimeSeriesMetric.timestamp))
+    sql = select(
+        [date.label('date')] + [getattr(TimeSeriesMetric, field) for field in fields]
+    ).distinct(
+        date
+    ).order_by(
+        # the last value recorded on each bucket
+        date, desc(TimeSeriesMetric.timestamp)
     )
+    if start is not None:
+        sql = sql.where(TimeSeriesMetric.timestamp >= start)
+    if end is not None:
+        sql = sql.where(TimeSeriesMetric.timestamp < end + datetime.timedelta(days=1))
+
     result = model.Session.execute(sql).fetchall()
-    dates = {}
-    for row in result:
-        # De-dupe on date. As long as we've ordered our query by timestamp,
-        # we'll take the last value recorded on each date
-        dates[row['date']] = row[field]
-    return dates
+    return [(row['date'], {field: row[field] for field in fields}) for row in result]
+
+
+def take_snapshot():
+    """
+    Store the current value of every TimeSeriesMetric series, counted in SQL
+    """
+    package = model.Package
+    datasets = model.Session.query(func.count(package.id)).filter(
+        package.state == 'active',
+        package.type != 'deposited-dataset',
+    )
+    deposits = model.Session.query(func.count(package.id)).filter(
+        package.state == 'active',
+        package.type == 'deposited-dataset',
+    )
+    deposits_by_state = dict(
+        model.Session.query(model.PackageExtra.value, func.count(package.id))
+        .join(model.PackageExtra, model.PackageExtra.package_id == package.id)
+        .filter(package.state == 'active')
+        .filter(package.type == 'deposited-dataset')
+        .filter(model.PackageExtra.key == 'curation_state')
+        .filter(model.PackageExtra.state == 'active')
+        .group_by(model.PackageExtra.value)
+        .all()
+    )
+    kobo_imports = (
+        model.Session.query(func.count(package.id))
+        .join(model.PackageExtra, model.PackageExtra.package_id == package.id)
+        .filter(package.state == 'active')
+        .filter(package.type != 'deposited-dataset')
+        .filter(model.PackageExtra.key == 'kobo_asset_id')
+        .filter(model.PackageExtra.state == 'active')
+        .filter(model.PackageExtra.value != '')
+    )
+    containers = model.Session.query(func.count(model.Group.id)).filter(
+        model.Group.state == 'active',
+        model.Group.is_organization == True,
+        model.Group.type == 'data-container',
+    )
+    downloads = model.Session.query(
+        func.coalesce(func.sum(DownloadStat.count), 0)
+    )
+
+    # Users with any activity over the last days (the site user excluded)
+    days = toolkit.asint(toolkit.config.get('ckanext.unhcr.metrics_active_user_days', 30))
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    active_users = model.Session.query(
+        func.count(func.distinct(model.Activity.user_id))
+    ).filter(
+        model.Activity.timestamp >= datetime.datetime.utcnow() - datetime.timedelta(days=days),
+        model.Activity.user_id != site_user['id'],
+    )
+
+    rec = TimeSeriesMetric(
+        datasets_count=datasets.scalar(),
+        deposits_count=deposits.scalar(),
+        containers_count=containers.scalar(),
+        downloads_count=int(downloads.scalar()),
+        active_users_count=active_users.scalar(),
+        deposits_draft_count=deposits_by_state.get('draft', 0),
+        deposits_submitted_count=deposits_by_state.get('submitted', 0),
+        deposits_review_count=deposits_by_state.get('review', 0),
+        kobo_imports_count=kobo_imports.scalar(),
+    )
+    model.Session.add(rec)
+    model.Session.commit()
+    model.Session.refresh(rec)
+    return rec
+
+
+def _get_timeseries_columns(series):
+    """ Return the c3 columns of a graph with the given (label, field) series """
+    rows = get_timeseries([field for _, field in series])
+    columns = [['x'] + [str(date) for date, _ in rows]]
+    for label, field in series:
+        columns.append([label] + [values[field] for _, values in rows])
+    return columns
+
 
 def _get_facet_table(facet, context):
     data_dict = {
@@ -54,8 +172,6 @@ def get_datasets_by_date(context):
     deposits_total = toolkit.get_action('package_search')(
         context, dict(data_dict, fq='type:deposited-dataset')
     )
-    datasets = _get_timeseries_metric('datasets_count')
-    deposits = _get_timeseries_metric('deposits_count')
 
     return {
         'type': 'timeseries_graph',
@@ -66,41 +182,15 @@ def get_datasets_by_date(context):
             datasets=datasets_total['count'],
             deposits=deposits_total['count']
         ),
-        'data': [
-            ['x'] + [str(date) for date in datasets.keys()],
-            ['Datasets'] + [count for count in datasets.values()],
-            ['Deposits'] + [count for count in deposits.values()],
-        ],
+        'data': _get_timeseries_columns([
+            ('Datasets', 'datasets_count'),
+            ('Deposits', 'deposits_count'),
+            ('KoBo imports', 'kobo_imports_count'),
+        ]),
     }
 
 def get_datasets_by_downloads(context):
-    activity_table = model.meta.metadata.tables['activity']
-    package_table = model.meta.metadata.tables['package']
-    join_obj = activity_table.join(
-        package_table, package_table.c.id==activity_table.c.object_id
-    )
-    select_cols = (
-        [c for c in package_table.columns] +
-        [func.count(package_table.c.id).label('count')]
-    )
-
-    sql = select(
-        select_cols
-    ).select_from(
-        join_obj
-    ).where(
-        and_(
-            package_table.c.state == 'active',
-            package_table.c.type != 'deposited-dataset',
-            activity_table.c.activity_type == 'download resource',
-        )
-    ).group_by(
-        package_table.c.id
-    ).order_by(
-        desc('count')
-    ).limit(10)
-
-    result = model.Session.execute(sql).fetchall()
+    result = download_stats.get_top_datasets(limit=10)
 
     data = []
     for row in result:
@@ -135,18 +225,40 @@ def get_containers(context):
 
 def get_containers_by_date(context):
     title = 'Total number of Containers'
-    dates = _get_timeseries_metric('containers_count')
+    data = _get_timeseries_columns([('Containers', 'containers_count')])
 
     return {
         'type': 'timeseries_graph',
         'short_title': 'Containers',
         'title': title,
-        'total': list(dates.values())[-1] if len(dates.values()) > 0 else None,
+        'total': data[1][-1] if len(data[1]) > 1 else None,
+        'id': slugify(title),
+        'data': data,
+    }
+
+def get_downloads_by_date(context):
+    title = 'Downloads and active users'
+    return {
+        'type': 'timeseries_graph',
+        'title': title,
+        'id': slugify(title),
+        'data': _get_timeseries_columns([
+            ('Downloads', 'downloads_count'),
+            ('Active users', 'active_users_count'),
+        ]),
+    }
+
+def get_deposits_by_date(context):
+    title = 'Deposits by curation state'
+    return {
+        'type': 'timeseries_graph',
+        'title': title,
         'id': slugify(title),
-        'data': [
-            ['x'] + [str(date) for date in dates.keys()],
-            ['Containers'] + [count for count in dates.values()],
-        ],
+        'data': _get_timeseries_columns([
+            ('Draft', 'deposits_draft_count'),
+            ('Submitted', 'deposits_submitted_count'),
+            ('Review', 'deposits_review_count'),
+        ]),
     }
 
 def get_tags(context):
@@ -177,8 +289,16 @@ def get_keywords(context):
         'data': data,
     }
 
+def _count_users():
+    # Same users as user_list returns, without building their dicts
+    return (
+        model.Session.query(func.count(model.User.id))
+        .filter(model.User.state != model.State.DELETED)
+        .scalar()
+    )
+
 def get_users_by_datasets(context):
-    all_users = toolkit.get_action('user_list')(context, {})
+    users_total = _count_users()
     default_user = toolkit.get_action('get_site_user')({ 'ignore_auth': True })
 
     package_table = model.meta.metadata.tables['package']
@@ -223,45 +343,17 @@ def get_users_by_datasets(context):
         'short_title': 'Users',
         'title': title,
         'id': slugify(title),
-        'total': len(all_users),
+        'total': users_total,
         'headers': ['User', 'Datasets Created'],
         'data': data,
     }
 
 def get_users_by_downloads(context):
     default_user = toolkit.get_action('get_site_user')({ 'ignore_auth': True })
-    activity_table = model.meta.metadata.tables['activity']
-    package_table = model.meta.metadata.tables['package']
-    user_table = model.meta.metadata.tables['user']
-    join_obj = activity_table.join(
-        package_table, package_table.c.id==activity_table.c.object_id
-    ).join(
-        user_table, user_table.c.id==activity_table.c.user_id
-    )
-    select_cols = (
-        [c for c in user_table.columns] +
-        [func.count(user_table.c.id).label('count')]
+    result = download_stats.get_top_users(
+        exclude_user_names=[default_user['name']], limit=10
     )
 
-    sql = select(
-        select_cols
-    ).select_from(
-        join_obj
-    ).where(
-        and_(
-            package_table.c.state == 'active',
-            package_table.c.type != 'deposited-dataset',
-            activity_table.c.activity_type == 'download resource',
-            user_table.c.name != default_user['name'],
-        )
-    ).group_by(
-        user_table.c.id
-    ).order_by(
-        desc('count')
-    ).limit(10)
-
-    result = model.Session.execute(sql).fetchall()
-
     data = []
     for row in result:
         data.append({
@@ -278,3 +370,129 @@ def get_users_by_downloads(context):
         'headers': ['User', 'Downloads'],
         'data': data,
     }
+
+
+# Metrics service
+
+# Panels of the metrics page, in display order, with the default number of
+# seconds their payload is cached (`ckanext.unhcr.metrics_cache_seconds.<key>`)
+METRICS_PANELS = [
+    ('datasets-by-date', get_datasets_by_date, 3600),
+    ('datasets-by-downloads', get_datasets_by_downloads, 900),
+    ('containers-by-date', get_containers_by_date, 3600),
+    ('downloads-by-date', get_downloads_by_date, 3600),
+    ('deposits-by-date', get_deposits_by_date, 3600),
+    ('containers', get_containers, 3600),
+    ('tags', get_tags, 3600),
+    ('keywords', get_keywords, 3600),
+    ('users-by-datasets', get_users_by_datasets, 3600),
+    ('users-by-downloads', get_users_by_downloads, 900),
+]
+
+
+def get_panel_ttl(key, default):
+    return toolkit.asint(
+        toolkit.config.get('ckanext.unhcr.metrics_cache_seconds.{}'.format(key), default)
+    )
+
+
+# Panels built with package_search: their payload depends on the datasets
+# the viewer can see, so they are cached per permission scope
+SCOPED_PANELS = ['datasets-by-date', 'containers', 'tags', 'keywords']
+
+SYSADMIN_SCOPE = 'sysadmin'
+
+
+def get_metrics_cache():
+    global _metrics_cache
+    if _metrics_cache is None:
+        # Each entry stores when it was computed, so every panel is expired
+        # with its own TTL (Redis keys use the longest one)
+        _metrics_cache = TieredCache(
+            'metrics',
+            max_size=len(METRICS_PANELS) * 100,
+            ttl=max(get_panel_ttl(key, ttl) for key, _, ttl in METRICS_PANELS) or 1,
+        )
+    return _metrics_cache
+
+
+def get_permission_scope(user_obj):
+    """
+    Return the cache scope of the panels in SCOPED_PANELS for a viewer:
+    viewers with the same dataset permission labels see the same datasets
+    """
+    if user_obj is None or user_obj.sysadmin:
+        return SYSADMIN_SCOPE
+    labels = get_permission_labels().get_user_dataset_labels(user_obj)
+    return hashlib.sha256(' '.join(sorted(labels)).encode('utf-8')).hexdigest()
+
+
+def get_metrics(user_obj=None, refresh=False):
+    """
+    Return the payload of every panel of the metrics page for `user_obj`
+    (all the datasets are counted if it is None)
+
+    Cached panels are returned as they are, the rest (or all of them if
+    `refresh` is True) are computed concurrently and cached.
+    Panels in SCOPED_PANELS are computed as the viewer and shared by the
+    viewers with the same permission scope, the rest are computed as the
+    site user and shared by everyone (the page is only available to
+    sysadmins and curators)
+    """
+    cache = get_metrics_cache()
+    now = time.time()
+    scope = get_permission_scope(user_obj)
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    site_context = {'user': site_user['name'], 'ignore_auth': True}
+    if scope == SYSADMIN_SCOPE:
+        viewer_context = site_context
+    else:
+        viewer_context = {'user': user_obj.name}
+
+    payloads = {}
+    pending = []
+    for key, get_panel, ttl in METRICS_PANELS:
+        scoped = key in SCOPED_PANELS
+        cache_key = '{}:{}'.format(key, scope) if scoped else key
+        cached = None if refresh else cache.get(cache_key)
+        if cached and now - cached['computed'] < get_panel_ttl(key, ttl):
+            payloads[key] = cached['payload']
+        else:
+            pending.append((key, get_panel, viewer_context if scoped else site_context))
+
+    for key, payload in _compute_panels(pending):
+        cache_key = '{}:{}'.format(key, scope) if key in SCOPED_PANELS else key
+        cache.set(cache_key, {'computed': now, 'payload': payload})
+        payloads[key] = payload
+
+    return [payloads[key] for key, _, _ in METRICS_PANELS]
+
+
+def _compute_panels(panels):
+    """ Compute the given (key, get_panel, context) panels """
+    if not panels:
+        return []
+    workers = toolkit.asint(toolkit.config.get('ckanext.unhcr.metrics_workers', 4))
+    if workers <= 1 or not flask.has_app_context():
+        return [(key, get_panel(context.copy())) for key, get_panel, context in panels]
+
+    app = flask.current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=min(workers, len(panels))) as executor:
+        futures = [
+            (key, executor.submit(_compute_panel, app, get_panel, context.copy()))
+            for key, get_panel, context in panels
+        ]
+        return [(key, future.result()) for key, future in futures]
+
+
+def _compute_panel(app, get_panel, context):
+    # Worker threads don't share the Flask context or the DB session
+    # of the thread that submitted them
+    start = time.monotonic()
+    with app.test_request_context():
+        try:
+            return get_panel(context)
+        finally:
+            model.Session.remove()
+            log.debug('Metrics panel {} computed in {:.3f}s'.format(
+                get_panel.__name__, time.monotonic() - start))
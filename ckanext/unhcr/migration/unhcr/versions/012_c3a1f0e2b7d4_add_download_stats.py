@@ -0,0 +1,42 @@
+"""Add download_stats table
+
+Revision ID: c3a1f0e2b7d4
+Revises: 611cfba10d28
+Create Date: 2022-07-04 10:12:41.350217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a1f0e2b7d4'
+down_revision = '611cfba10d28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'download_stats',
+        sa.Column('package_id', sa.UnicodeText, primary_key=True),
+        sa.Column('user_id', sa.UnicodeText, primary_key=True, server_default=''),
+        sa.Column('day', sa.Date, primary_key=True),
+        sa.Column('count', sa.Integer, nullable=False, server_default='0'),
+    )
+    op.create_index('idx_download_stats_user_id', 'download_stats', ['user_id'])
+    # Fill the counters with the download activities created so far
+    op.execute(
+        """
+        INSERT INTO download_stats (package_id, user_id, day, count)
+            SELECT object_id, coalesce(user_id, ''), date(timestamp), count(*)
+            FROM activity
+            WHERE activity_type = 'download resource'
+            GROUP BY object_id, coalesce(user_id, ''), date(timestamp);
+        """
+    )
+
+
+def downgrade():
+    op.drop_index('idx_download_stats_user_id', table_name='download_stats')
+    op.drop_table('download_stats')
@@ -0,0 +1,48 @@
+"""Add indexes to access_requests
+
+Revision ID: 5e2d7c9a41b3
+Revises: c3a1f0e2b7d4
+Create Date: 2022-07-11 09:48:27.504119
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2d7c9a41b3'
+down_revision = 'c3a1f0e2b7d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # access_request_list_for_user filters on status and object_type and sorts by timestamp
+    op.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_access_requests_status_object_type_timestamp
+            ON access_requests (status, object_type, timestamp);
+        """
+    )
+    # user account requests are filtered on keys of data (?, ?| and @> operators)
+    op.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_access_requests_data
+            ON access_requests USING gin (data);
+        CREATE INDEX IF NOT EXISTS idx_access_requests_data_default_containers
+            ON access_requests USING gin ((data -> 'default_containers'));
+        CREATE INDEX IF NOT EXISTS idx_access_requests_data_users_who_can_approve
+            ON access_requests USING gin ((data -> 'users_who_can_approve'));
+        """
+    )
+
+
+def downgrade():
+    op.execute(
+        """
+        DROP INDEX IF EXISTS idx_access_requests_data_users_who_can_approve;
+        DROP INDEX IF EXISTS idx_access_requests_data_default_containers;
+        DROP INDEX IF EXISTS idx_access_requests_data;
+        DROP INDEX IF EXISTS idx_access_requests_status_object_type_timestamp;
+        """
+    )
@@ -0,0 +1,42 @@
+"""Add resource_scan_status table
+
+Revision ID: 9b0e4d6f2a17
+Revises: 5e2d7c9a41b3
+Create Date: 2022-07-18 11:05:52.718403
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b0e4d6f2a17'
+down_revision = '5e2d7c9a41b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'resource_scan_status',
+        sa.Column('resource_id', sa.UnicodeText, primary_key=True),
+        sa.Column('infected', sa.Boolean, nullable=False, server_default=sa.false()),
+        sa.Column('last_updated', sa.DateTime, nullable=False, server_default=sa.func.now()),
+    )
+    # Fill the verdicts with the Clam AV scans completed so far
+    # (scan_hook stores the whole callback as the task value)
+    op.execute(
+        """
+        INSERT INTO resource_scan_status (resource_id, infected, last_updated)
+            SELECT entity_id,
+                   coalesce((value::jsonb -> 'data' ->> 'status_code') = '1', false),
+                   coalesce(last_updated, now())
+            FROM task_status
+            WHERE task_type = 'clamav' AND key = 'clamav' AND state = 'complete'
+              AND value LIKE '{%';
+        """
+    )
+
+
+def downgrade():
+    op.drop_table('resource_scan_status')
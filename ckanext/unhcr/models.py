@@ -1,11 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import datetime
-import json
 import logging
 
-from redis import Redis, ConnectionPool
-from sqlalchemy import Column, DateTime, Integer
+from sqlalchemy import Column, Date, DateTime, Integer, and_, or_, select, union
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -18,6 +16,7 @@ from ckan.common import config
 from ckan.model.meta import metadata
 import ckan.model as model
 from ckan.model.types import make_uuid
+from ckanext.unhcr.cache import TieredCache
 
 
 log = logging.getLogger(__name__)
@@ -34,6 +33,38 @@ class TimeSeriesMetric(Base):
     datasets_count = Column(Integer)
     deposits_count = Column(Integer)
     containers_count = Column(Integer)
+    downloads_count = Column(Integer)
+    active_users_count = Column(Integer)
+    deposits_draft_count = Column(Integer)
+    deposits_submitted_count = Column(Integer)
+    deposits_review_count = Column(Integer)
+    kobo_imports_count = Column(Integer)
+
+
+class DownloadStat(Base):
+    """
+    Number of 'download resource' activities per dataset, user and day
+    (kept up to date by ckanext.unhcr.download_stats)
+    """
+    __tablename__ = u'download_stats'
+
+    package_id = Column(UnicodeText, primary_key=True)
+    # empty for downloads that could not be linked to a user
+    user_id = Column(UnicodeText, primary_key=True, default=u'')
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ResourceScanStatus(Base):
+    """
+    Verdict of the last Clam AV scan of each resource
+    (written by the scan_hook action, see ckanext.unhcr.scan_status)
+    """
+    __tablename__ = u'resource_scan_status'
+
+    resource_id = Column(UnicodeText, primary_key=True)
+    infected = Column(Boolean, nullable=False, default=False)
+    last_updated = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
 
 
 class AccessRequest(Base):
@@ -127,22 +158,23 @@ class Geography(Base):
 
     @property
     def display_full_name(self):
-        parent_names = [parent.gis_name for parent in self.parents]
+        return self._full_name(self.parents)
+
+    def _full_name(self, parents):
+        parent_names = [parent.gis_name for parent in parents]
         if len(parent_names) > 0:
             parent_names_str = ', '.join(parent_names)
             return f'{self.gis_name} ({parent_names_str})'
         else:
             return self.gis_name
 
+    @property
+    def parent_pcodes(self):
+        return get_parent_pcodes(self.hierarchy_pcode)
+
     @hybrid_property
     def parents(self):
-        # see diagram in https://github.com/okfn/ckanext-unhcr/issues/618 for pcode structure
-        parent_pcodes = [
-            self.hierarchy_pcode[0:11] if len(self.hierarchy_pcode) >= 14 else None, # admin2
-            self.hierarchy_pcode[0:8] if len(self.hierarchy_pcode) >= 11 else None, # admin1
-            self.hierarchy_pcode[2:5] if len(self.hierarchy_pcode) >= 8 else None, # country
-        ]
-        parent_pcodes = list(filter(lambda x: x is not None, parent_pcodes))
+        parent_pcodes = self.parent_pcodes
         if len(parent_pcodes) == 0:
             return []
 
@@ -174,13 +206,42 @@ class Geography(Base):
             Geography.layer == COUNTRY['layer_name']
         ).one_or_none()
 
-    def dictize(self, include_parents=False):
-        cache_key = 'geography__{}_{}'.format(self.pcode, int(include_parents))
-        if self.cache and self.cache.get(cache_key):
-            return json.loads(self.cache.get(cache_key))
+    def dictize(self, include_parents=False, parents=None):
+        """ Dictize this geography. Callers that already loaded the parents
+            (see resolve_geographies) can pass them to avoid extra queries """
+        cache = get_geography_cache()
+        record = cache.get(self.pcode)
+        if record is None:
+            if parents is None:
+                parents = self.parents
+            record = self._cache_record(parents)
+            cache.set(self.pcode, record)
+
+        dct = dict(record['geography'])
+        if include_parents:
+            dct['parents'] = []
+            parents_by_pcode = None
+            for parent_pcode in record['parents']:
+                parent_record = cache.get(parent_pcode)
+                if parent_record is not None:
+                    dct['parents'].append(dict(parent_record['geography']))
+                    continue
+                if parents_by_pcode is None:
+                    if parents is None:
+                        parents = self.parents
+                    parents_by_pcode = {parent.pcode: parent for parent in parents}
+                if parent_pcode in parents_by_pcode:
+                    dct['parents'].append(
+                        parents_by_pcode[parent_pcode].dictize(include_parents=False)
+                    )
 
+        return dct
+
+    def _cache_record(self, parents):
+        """ Compact record we keep in the geography cache: the serializable
+            geography dict and the pcodes of its parents """
         dct = {k:v for k,v in self.__dict__.items() if not k.startswith('_')}
-        dct['name'] = self.display_full_name
+        dct['name'] = self._full_name(parents)
         dct['layer_nice_name'] = self.layer_nice_name
         # ensure serializable for API calls
         for k, v in dct.items():
@@ -190,30 +251,134 @@ class Geography(Base):
                 dct[k] = v.isoformat()
             else:
                 dct[k] = str(v)
-        if include_parents:
-            dct['parents'] = [
-                parent.dictize(include_parents=False)
-                for parent in self.parents
-                ]
-
-        if self.cache:
-            self.cache.set(cache_key, json.dumps(dct), ex=3000)
-        return dct
+        return {
+            'geography': dct,
+            'parents': [parent.pcode for parent in parents],
+        }
+
+
+_geography_cache = None
+def get_geography_cache():
+    """
+    Return the two tier (in-process LRU + Redis) cache for dictized geographies
+    Use the `stats()` method of the cache to check hits and misses
+    """
+    global _geography_cache
+    if _geography_cache is None:
+        _geography_cache = TieredCache(
+            'geography',
+            max_size=int(config.get('ckanext.unhcr.geography_cache_size', 10000)),
+            ttl=int(config.get('ckanext.unhcr.geography_cache_seconds', 3000)),
+        )
+    return _geography_cache
+
+
+def get_parent_pcodes(hierarchy_pcode):
+    """ Return the pcodes of the admin2, admin1 and country a hierarchy_pcode belongs to """
+    # see diagram in https://github.com/okfn/ckanext-unhcr/issues/618 for pcode structure
+    parent_pcodes = [
+        hierarchy_pcode[0:11] if len(hierarchy_pcode) >= 14 else None, # admin2
+        hierarchy_pcode[0:8] if len(hierarchy_pcode) >= 11 else None, # admin1
+        hierarchy_pcode[2:5] if len(hierarchy_pcode) >= 8 else None, # country
+    ]
+    return [pcode for pcode in parent_pcodes if pcode is not None]
+
+
+def resolve_geographies(pcodes, include_parents=True):
+    """
+    Load a list of Geographies and all their parents in a single query
+
+    The parent pcodes are sliced from hierarchy_pcode in the database
+    (the same way Geography.parents does it in Python) so a package
+    with many geographies (or a whole batch of packages) costs one round trip.
+
+    Returns a dict {pcode: (geography, parents)} for the pcodes found.
+    Parents are ordered ADMIN2 > ADMIN1 > COUNTRY
+    """
+    pcodes = list(set(pcodes))
+    if not pcodes:
+        return {}
+
+    condition = Geography.pcode.in_(pcodes)
+    if include_parents:
+        requested = select(
+            [Geography.hierarchy_pcode.label('hierarchy_pcode')]
+        ).where(
+            Geography.pcode.in_(pcodes)
+        ).alias('requested')
+        hierarchy_pcode = requested.c.hierarchy_pcode
+        parent_pcodes = union(
+            select([func.substr(hierarchy_pcode, 1, 11)]).where(func.length(hierarchy_pcode) >= 14),
+            select([func.substr(hierarchy_pcode, 1, 8)]).where(func.length(hierarchy_pcode) >= 11),
+            select([func.substr(hierarchy_pcode, 3, 3)]).where(func.length(hierarchy_pcode) >= 8),
+        )
+        condition = or_(
+            condition,
+            and_(
+                Geography.pcode.in_(parent_pcodes),
+                Geography.gis_status == GisStatus.ACTIVE,
+                # secondary terrirories are not counted as countries
+                Geography.secondary_territory == false(),
+            )
+        )
 
-    @property
-    def cache(self):
-        if not hasattr(self, '_cache'):
-            redis_url = config.get('ckan.redis.url', 'redis://localhost:6379/0')
-            try:
-                redis_pool = ConnectionPool.from_url(redis_url)
-                self._cache = Redis(connection_pool=redis_pool)
-            except ConnectionError:
-                self._cache = None
+    geographies = {
+        geog.pcode: geog
+        for geog in model.Session.query(Geography).filter(condition)
+    }
+
+    out = {}
+    for pcode in pcodes:
+        geog = geographies.get(pcode)
+        if not geog:
+            continue
+        parents = []
+        if include_parents:
+            parents = [
+                geographies[parent_pcode]
+                for parent_pcode in geog.parent_pcodes
+                if parent_pcode in geographies
+                and geographies[parent_pcode].gis_status == GisStatus.ACTIVE
+                and not geographies[parent_pcode].secondary_territory
+            ]
+            # ADMIN2 > ADMIN1 > COUNTRY
+            parents.sort(key=lambda parent: len(parent.pcode), reverse=True)
+        out[pcode] = (geog, parents)
+
+    return out
+
+
+def get_geography_vocab(pcodes, resolved=None):
+    """
+    Return the (vocab_geo_name, vocab_geo_pcodes) lists we index for a package
+
+    :param pcodes: The pcodes in the package "geographies" field
+    :param resolved: Optional output of resolve_geographies, when the
+        geographies for a batch of packages were already loaded
+    """
+    if resolved is None:
+        resolved = resolve_geographies(pcodes)
+
+    names = []
+    codes = []
+    for pcode in pcodes:
+        if pcode not in resolved:
+            continue
+        geog, parents = resolved[pcode]
+        for item in [geog] + parents:
+            names.append(item.gis_name)
+            codes.append(item.pcode)
+
+    return names, codes
 
-        return self._cache
 
 def create_metric_columns():
-    cols = ['datasets_count', 'deposits_count', 'containers_count']
+    cols = [
+        'datasets_count', 'deposits_count', 'containers_count',
+        'downloads_count', 'active_users_count',
+        'deposits_draft_count', 'deposits_submitted_count', 'deposits_review_count',
+        'kobo_imports_count',
+    ]
     table = TimeSeriesMetric.__tablename__
     for col in cols:
         model.Session.execute(
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from ckan.plugins import toolkit
+from ckanext.unhcr.cache import TieredCache
+
+
+_pending_requests_cache = None
+
+
+def get_pending_requests_cache():
+    """
+    Return the cache of the number of pending requests of each user (shown in
+    the dashboard header). It is invalidated by any action that creates or
+    resolves a request and expires after a short TTL as a safety net
+    """
+    global _pending_requests_cache
+    if _pending_requests_cache is None:
+        _pending_requests_cache = TieredCache(
+            'pending-requests',
+            max_size=1000,
+            ttl=toolkit.asint(
+                toolkit.config.get('ckanext.unhcr.pending_requests_cache_seconds', 300)
+            ),
+            generation_check_seconds=0,
+        )
+    return _pending_requests_cache
+
+
+def invalidate():
+    # A request is visible to many users (sysadmins, container admins) so
+    # all the counts are dropped
+    get_pending_requests_cache().invalidate()
+
+
+def get_total(user_name, compute):
+    """
+    Return the number of pending requests of a user, calling `compute()`
+    only if it is not cached
+    """
+    if not user_name or get_pending_requests_cache().ttl <= 0:
+        return compute()
+
+    cache = get_pending_requests_cache()
+    total = cache.get(user_name)
+    if total is not None:
+        return total
+
+    total = compute()
+    cache.set(user_name, total)
+    return total
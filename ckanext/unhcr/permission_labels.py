@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import flask
+from sqlalchemy import inspect
+from ckan import model
+from ckan.plugins import toolkit
+from ckanext.unhcr.cache import LRUCache, TieredCache
+
+
+_labels_cache = None
+_dataset_labels_cache = LRUCache(max_size=10000)
+
+
+def is_cache_enabled():
+    return toolkit.asbool(
+        toolkit.config.get('ckanext.unhcr.permission_labels_cache', False)
+    )
+
+
+def get_labels_cache():
+    """
+    Return the cross-request cache of user dataset labels
+
+    Entries are keyed by user id inside a generation that is bumped every
+    time a membership changes (see `invalidate_user_labels`). The generation
+    is checked on every read, so a membership change is seen straight away
+    by all the processes.
+    """
+    global _labels_cache
+    if _labels_cache is None:
+        _labels_cache = TieredCache(
+            'permission-labels',
+            max_size=toolkit.asint(
+                toolkit.config.get('ckanext.unhcr.permission_labels_cache_size', 1000)
+            ),
+            ttl=toolkit.asint(
+                toolkit.config.get('ckanext.unhcr.permission_labels_cache_seconds', 300)
+            ),
+            generation_check_seconds=0,
+        )
+    return _labels_cache
+
+
+def get_user_dataset_labels(user_obj, compute):
+    """
+    Return the dataset labels of a user, calling `compute(user_obj)` only if
+    they are not memoized for the current request (or in the optional
+    cross-request cache)
+    """
+    if not user_obj:
+        return compute(user_obj)
+
+    memo = _get_request_memo()
+    if memo is not None and user_obj.id in memo:
+        return list(memo[user_obj.id])
+
+    labels = None
+    if is_cache_enabled():
+        labels = get_labels_cache().get(user_obj.id)
+    if labels is None:
+        labels = compute(user_obj)
+        if is_cache_enabled():
+            get_labels_cache().set(user_obj.id, labels)
+
+    if memo is not None:
+        memo[user_obj.id] = labels
+    return list(labels)
+
+
+def get_deposited_dataset_labels(dataset_obj, deposit_id):
+    """
+    Return the labels of a deposited dataset without calling package_show
+
+    The labels only depend on the dataset creator and on its target data
+    container, so they are cached by (package_id, metadata_modified)
+    """
+    key = None
+    if dataset_obj.metadata_modified:
+        key = (dataset_obj.id, dataset_obj.metadata_modified, deposit_id)
+        labels = _dataset_labels_cache.get(key)
+        if labels is not None:
+            return list(labels)
+
+    labels = [
+        'deposited-dataset',
+        'creator-%s' % dataset_obj.creator_user_id,
+    ]
+    owner_org_dest = get_owner_org_dest(dataset_obj)
+    if owner_org_dest and owner_org_dest not in [deposit_id, 'unknown']:
+        labels.append(
+            'deposited-dataset-{}'.format(owner_org_dest)
+        )
+
+    if key:
+        _dataset_labels_cache.set(key, labels)
+    return list(labels)
+
+
+def get_owner_org_dest(dataset_obj):
+    """
+    Return the owner_org_dest of a deposited dataset, from its extras if they
+    are already loaded or reading just that value from package_extra
+    """
+    if '_extras' not in inspect(dataset_obj).unloaded:
+        return dataset_obj.extras.get('owner_org_dest')
+    row = (
+        model.Session.query(model.PackageExtra.value)
+        .filter(model.PackageExtra.package_id == dataset_obj.id)
+        .filter(model.PackageExtra.key == 'owner_org_dest')
+        .filter(model.PackageExtra.state != 'deleted')
+        .first()
+    )
+    return row[0] if row else None
+
+
+def invalidate_user_labels():
+    """
+    Forget the labels computed so far, to be called after any change in
+    organization memberships or dataset collaborators
+    """
+    memo = _get_request_memo()
+    if memo is not None:
+        memo.clear()
+    get_labels_cache().invalidate()
+
+
+def _get_request_memo():
+    if not flask.has_request_context():
+        return None
+    if not hasattr(flask.g, 'unhcr_user_dataset_labels'):
+        flask.g.unhcr_user_dataset_labels = {}
+    return flask.g.unhcr_user_dataset_labels
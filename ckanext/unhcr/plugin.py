@@ -11,11 +11,14 @@ from ckan.lib.plugins import DefaultPermissionLabels
 # 🙈
 import ckan.authz as authz
 
-from ckanext.unhcr import actions, auth, click_commands, blueprints, helpers, jobs, utils, validators
+from ckanext.unhcr import (
+    actions, auth, click_commands, blueprints, container_tree, download_stats, helpers, jobs,
+    permission_labels, utils, validators
+)
 from ckanext.unhcr.activity import create_curation_activity
-from ckanext.unhcr.models import Geography
-from ckanext.scheming.helpers import scheming_get_dataset_schema
-from ckanext.hierarchy.helpers import group_tree_section
+from ckanext.unhcr.display_names import get_resolver as get_display_name_resolver
+from ckanext.unhcr.display_names import get_batch_download_count
+from ckanext.unhcr.models import get_geography_vocab
 
 log = logging.getLogger(__name__)
 
@@ -236,6 +239,9 @@ class UnhcrPlugin(
             'normalize_list': helpers.normalize_list,
             'get_field_label': helpers.get_field_label,
             'can_download': helpers.can_download,
+            'get_dataset_download_count': helpers.get_dataset_download_count,
+            'get_blocked_resource_ids': helpers.get_blocked_resource_ids,
+            'resource_is_blocked': helpers.resource_is_blocked,
             'can_request_access': helpers.can_request_access,
             'get_choice_label': helpers.get_choice_label,
             'get_data_container_choice_label': helpers.get_data_container_choice_label,
@@ -287,7 +293,7 @@ class UnhcrPlugin(
 
         # Index labels on selected fields
 
-        schema = scheming_get_dataset_schema('dataset')
+        labels = helpers.get_schema_labels('dataset')
         fields = ['data_collector', 'keywords', 'sampling_procedure',
                   'operational_purpose_of_data',  'data_collection_technique',
                   'process_status', 'identifiability', 'geographies']
@@ -301,19 +307,8 @@ class UnhcrPlugin(
                 # Index geo info (names and pcodes)
                 elif field == 'geographies':
                     if pkg_dict.get('geographies'):
-                        vocab_geo_names = []
-                        vocab_geo_pcodes = []
                         ids = helpers.normalize_list(pkg_dict['geographies'])
-                        for id_ in ids:
-                            geog = model.Session.query(Geography).get(id_)
-                            if geog:
-                                vocab_geo_names.append(geog.gis_name)
-                                vocab_geo_pcodes.append(geog.pcode)
-
-                                for parent in geog.parents:
-                                    vocab_geo_names.append(parent.gis_name)
-                                    vocab_geo_pcodes.append(parent.pcode)
-
+                        vocab_geo_names, vocab_geo_pcodes = get_geography_vocab(ids)
                         pkg_dict['vocab_geo_name'] = vocab_geo_names
                         pkg_dict['vocab_geo_pcodes'] = vocab_geo_pcodes
 
@@ -323,45 +318,49 @@ class UnhcrPlugin(
                         values = json.loads(pkg_dict[field])
                     except ValueError:
                         values = [value]
+                    if not isinstance(values, list):
+                        values = [values]
                     out = []
-                    for schema_field in schema['dataset_fields']:
-                        if schema_field['field_name'] == field:
-                            for item in values:
-                                for choice in schema_field['choices']:
-                                    if choice['value'] == item:
-                                        out.append(choice['label'])
+                    if field in labels['dataset_fields']:
+                        for item in values:
+                            # unhashable values (e.g. nested lists) can't match any choice
+                            if not isinstance(item, str):
+                                continue
+                            label = labels['dataset_choices'].get((field, item))
+                            if label is not None:
+                                out.append(label)
                     pkg_dict['vocab_' + field] = out
 
+        # Index the number of downloads (not for deposited datasets, as metrics)
+
+        if pkg_dict.get('type') != 'deposited-dataset':
+            downloads = get_batch_download_count(pkg_dict['id'])
+            if downloads is None:
+                downloads = download_stats.get_download_count(pkg_dict['id'])
+            pkg_dict['downloads'] = downloads
+
         # Index additional data for deposited dataset
 
         if pkg_dict.get('type') == 'deposited-dataset':
+            names = get_display_name_resolver()
             # curator
             curator_id = pkg_dict.get('curator_id')
             if curator_id:
-                try:
-                    curator = toolkit.get_action('user_show')(
-                        {'ignore_auth': True}, {'id': curator_id})
-                    pkg_dict['curator_display_name'] = curator.get('display_name')
-                except toolkit.ObjectNotFound:
-                    pass
+                curator_display_name = names.user(curator_id)
+                if curator_display_name is not None:
+                    pkg_dict['curator_display_name'] = curator_display_name
             # depositor
             depositor_id = pkg_dict.get('creator_user_id')
             if depositor_id:
-                try:
-                    depositor = toolkit.get_action('user_show')(
-                        {'ignore_auth': True}, {'id': depositor_id})
-                    pkg_dict['depositor_display_name'] = depositor.get('display_name')
-                except toolkit.ObjectNotFound:
-                    pass
+                depositor_display_name = names.user(depositor_id)
+                if depositor_display_name is not None:
+                    pkg_dict['depositor_display_name'] = depositor_display_name
             # data-container
             owner_org_dest_id = pkg_dict.get('owner_org_dest')
             if owner_org_dest_id:
-                try:
-                    owner_org_dest = toolkit.get_action('organization_show')(
-                        {'ignore_auth': True}, {'id': owner_org_dest_id})
-                    pkg_dict['owner_org_dest_display_name'] = owner_org_dest.get('display_name')
-                except toolkit.ObjectNotFound:
-                    pass
+                owner_org_dest_display_name = names.organization(owner_org_dest_id)
+                if owner_org_dest_display_name is not None:
+                    pkg_dict['owner_org_dest_display_name'] = owner_org_dest_display_name
 
         return pkg_dict
 
@@ -382,30 +381,13 @@ class UnhcrPlugin(
             # Always include sub-containers to container_read search
             toolkit.c.include_children_selected = True
 
-            # helper function
-            def _children_name_list(children):
-                name_list = []
-                for child in children:
-                    name = child.get('name', "")
-                    name_list += [name] + _children_name_list(child.get('children', []))
-                return name_list
-
             # update filter query
             if getattr(toolkit.c, "group", None):
-                children = _children_name_list(
-                    group_tree_section(
-                        toolkit.c.group.name,
-                        type_='data-container',
-                        include_parents=False,
-                        include_siblings=False
-                    ).get('children',[])
-                )
-                if children:
-                    search_params['fq'] = 'organization:%s' % toolkit.c.group.name
-                    for name in children:
-                        if name:
-                            search_params['fq'] += ' OR organization:%s' %  name
-                    search_params['fq'] = '({})'.format(search_params['fq'])
+                descendant_ids = container_tree.get_descendant_ids(toolkit.c.group.id)
+                if descendant_ids:
+                    search_params['fq'] = 'owner_org:({})'.format(
+                        ' OR '.join([toolkit.c.group.id] + descendant_ids)
+                    )
         return search_params
 
     # IPackageController, IResourceController
@@ -518,6 +500,7 @@ class UnhcrPlugin(
         functions['organization_list_all_fields'] = auth.organization_list_all_fields
         functions['group_list_authz'] = auth.group_list_authz
         functions['package_internal_activity_list'] = auth.package_internal_activity_list
+        functions['download_activity_buffer_stats'] = auth.download_activity_buffer_stats
         functions['package_create'] = auth.package_create
         functions['package_collaborator_create'] = auth.package_collaborator_create
         functions['package_update'] = auth.package_update
@@ -529,12 +512,15 @@ class UnhcrPlugin(
         functions['user_update_sysadmin'] = auth.user_update_sysadmin
         functions['external_user_update_state'] = auth.external_user_update_state
         functions['search_index_rebuild'] = auth.search_index_rebuild
+        functions['search_index_rebuild_status'] = auth.search_index_rebuild_status
         functions['geography_autocomplete'] = auth.geography_autocomplete
         functions['geography_show'] = auth.geography_show
+        functions['geography_cache_stats'] = auth.geography_cache_stats
         functions['user_show'] = auth.user_show
         functions['user_reset'] = auth.user_reset
         functions['request_reset'] = auth.request_reset
         functions['package_kobo_update'] = auth.package_kobo_update
+        functions['kobo_export_poll_stats'] = auth.kobo_export_poll_stats
         return functions
 
     # IActions
@@ -551,10 +537,16 @@ class UnhcrPlugin(
             'package_collaborator_create': actions.package_collaborator_create,
             'package_collaborator_delete': actions.package_collaborator_delete,
             'organization_create': actions.organization_create,
+            'organization_update': actions.organization_update,
+            'organization_delete': actions.organization_delete,
+            'organization_purge': actions.organization_purge,
+            'member_create': actions.member_create,
+            'member_delete': actions.member_delete,
             'organization_member_create': actions.organization_member_create,
             'organization_member_delete': actions.organization_member_delete,
             'organization_list_all_fields': actions.organization_list_all_fields,
             'package_internal_activity_list': actions.package_internal_activity_list,
+            'download_activity_buffer_stats': actions.download_activity_buffer_stats,
             'container_request_list': actions.container_request_list,
             'package_activity_list': actions.package_activity_list,
             'dashboard_activity_list': actions.dashboard_activity_list,
@@ -569,9 +561,12 @@ class UnhcrPlugin(
             'user_update_sysadmin': actions.user_update_sysadmin,
             'external_user_update_state': actions.external_user_update_state,
             'search_index_rebuild': actions.search_index_rebuild,
+            'search_index_rebuild_status': actions.search_index_rebuild_status,
             'user_autocomplete': actions.user_autocomplete,
             'geography_autocomplete': actions.geography_autocomplete,
             'geography_show': actions.geography_show,
+            'geography_cache_stats': actions.geography_cache_stats,
+            'kobo_export_poll_stats': actions.kobo_export_poll_stats,
             'user_list': actions.user_list,
             'user_show': actions.user_show,
             'user_create': actions.user_create,
@@ -610,21 +605,10 @@ class UnhcrPlugin(
 
         # For deposited datasets
         if dataset_obj.type == 'deposited-dataset':
-            context = {'ignore_auth': True}
-            dataset = toolkit.get_action('package_show')(
-                context,
-                {'id': dataset_obj.id}
-            )
             deposit = helpers.get_data_deposit()
-
-            labels = [
-                'deposited-dataset',
-                'creator-%s' % dataset_obj.creator_user_id,
-            ]
-            if dataset['owner_org_dest'] not in [deposit['id'], 'unknown']:
-                labels.append(
-                    'deposited-dataset-{}'.format(dataset['owner_org_dest'])
-                )
+            labels = permission_labels.get_deposited_dataset_labels(
+                dataset_obj, deposit['id']
+            )
 
         # For normal datasets
         else:
@@ -633,6 +617,13 @@ class UnhcrPlugin(
         return labels
 
     def get_user_dataset_labels(self, user_obj):
+        # Memoized per request (and optionally cached in Redis) as this is
+        # called on every package_search and package_show
+        return permission_labels.get_user_dataset_labels(
+            user_obj, self._get_user_dataset_labels
+        )
+
+    def _get_user_dataset_labels(self, user_obj):
         # https://github.com/ckan/ckan/blob/master/ckanext/example_ipermissionlabels/plugin.py
 
         # For normal users
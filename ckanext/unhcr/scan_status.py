@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from sqlalchemy.dialects.postgresql import insert
+from ckan import model
+from ckanext.unhcr.models import ResourceScanStatus
+
+
+def set_verdict(resource_id, infected):
+    """ Store the verdict of the last Clam AV scan of a resource """
+    table = ResourceScanStatus.__table__
+    values = {
+        'resource_id': resource_id,
+        'infected': infected,
+        'last_updated': datetime.datetime.utcnow(),
+    }
+    stmt = insert(table).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.resource_id],
+        set_={'infected': stmt.excluded.infected, 'last_updated': stmt.excluded.last_updated},
+    )
+    model.Session.execute(stmt)
+    model.Session.commit()
+
+
+def clear_verdict(resource_id):
+    """ Forget the verdict of a resource that is going to be scanned again """
+    model.Session.query(ResourceScanStatus).filter(
+        ResourceScanStatus.resource_id == resource_id
+    ).delete(synchronize_session=False)
+    model.Session.commit()
+
+
+def is_infected(resource_id):
+    return bool(get_infected_ids([resource_id]))
+
+
+def get_infected_ids(resource_ids):
+    """ Return the set of ids of the given resources flagged as infected """
+    if not resource_ids:
+        return set()
+    rows = (
+        model.Session.query(ResourceScanStatus.resource_id)
+        .filter(ResourceScanStatus.resource_id.in_(resource_ids))
+        .filter(ResourceScanStatus.infected == True)
+        .all()
+    )
+    return {row[0] for row in rows}
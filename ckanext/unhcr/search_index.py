@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import logging
+import uuid
+from dateutil.parser import parse as parse_date
+from ckan import model
+from ckan.lib.search import commit, index_for
+import ckan.logic as core_logic
+from ckan.plugins import toolkit
+from ckanext.unhcr import display_names, download_stats
+
+
+log = logging.getLogger(__name__)
+
+# All the progress of a rebuild is stored as task_status rows sharing these
+# values: one row for the rebuild itself (key "rebuild"), one row per chunk
+# (key "chunk-<n>") and one row with the start time of the last successful
+# rebuild (key "last_success"), used by the incremental mode
+TASK = {
+    'entity_id': 'search_index',
+    'entity_type': 'search_index',
+    'task_type': 'search_index_rebuild',
+}
+REBUILD_KEY = 'rebuild'
+LAST_SUCCESS_KEY = 'last_success'
+CHUNK_KEY_PREFIX = 'chunk-'
+
+
+# Module API
+
+def get_chunk_size():
+    return toolkit.asint(
+        toolkit.config.get('ckanext.unhcr.search_index_chunk_size', 500)
+    )
+
+
+def get_package_ids(since=None):
+    query = (
+        model.Session.query(model.Package.id)
+        .filter(model.Package.state != 'deleted')
+    )
+    if since:
+        query = query.filter(model.Package.metadata_modified > since)
+    return [r[0] for r in query.order_by(model.Package.metadata_modified).all()]
+
+
+def get_last_success():
+    task = _get_task(LAST_SUCCESS_KEY)
+    if not task or not task.value:
+        return None
+    return parse_date(task.value)
+
+
+def start_rebuild(package_ids, chunk_size, incremental=False):
+    """
+    Create the task_status rows for a new rebuild and return its chunks
+
+    Rows left by a previous rebuild are removed, so the chunks of an
+    older rebuild still in the queue will notice and skip themselves.
+    """
+    rebuild_id = str(uuid.uuid4())
+    now = datetime.datetime.utcnow()
+    chunks = [
+        package_ids[i:i + chunk_size]
+        for i in range(0, len(package_ids), chunk_size)
+    ]
+
+    (
+        model.Session.query(model.TaskStatus)
+        .filter(model.TaskStatus.entity_id == TASK['entity_id'])
+        .filter(model.TaskStatus.task_type == TASK['task_type'])
+        .filter(model.TaskStatus.key.like(CHUNK_KEY_PREFIX + '%'))
+        .delete(synchronize_session=False)
+    )
+    _set_task(REBUILD_KEY, 'running' if chunks else 'complete', value={
+        'id': rebuild_id,
+        'started': now.isoformat(),
+        'incremental': incremental,
+        'total': len(package_ids),
+        'chunks': len(chunks),
+    }, commit=False)
+    for number, chunk in enumerate(chunks):
+        _set_task(_chunk_key(number), 'pending', value={
+            'id': rebuild_id,
+            'total': len(chunk),
+            'indexed': 0,
+        }, commit=False)
+    model.Session.commit()
+
+    if not chunks:
+        _set_task(LAST_SUCCESS_KEY, 'complete', value=now.isoformat())
+
+    return rebuild_id, chunks
+
+
+def index_chunk(rebuild_id, number, package_ids):
+    """
+    Index a chunk of packages, commit them to Solr and record the progress
+    """
+    if not _set_chunk_task(rebuild_id, number, 'running', {
+        'total': len(package_ids),
+        'indexed': 0,
+    }):
+        log.info('Skipping chunk {} of outdated search index rebuild {}'.format(number, rebuild_id))
+        return []
+
+    package_index = index_for(model.Package)
+    context = {'model': model, 'ignore_auth': True, 'validate': False, 'use_cache': False}
+    errors = []
+    download_counts = download_stats.get_download_counts(package_ids)
+    with display_names.indexing_batch(download_counts=download_counts) as names:
+        # Users and data containers referenced by deposited datasets
+        user_ids, org_ids = display_names.get_deposit_related_ids(package_ids)
+        names.prefetch(user_ids=user_ids, org_ids=org_ids)
+        for pkg_id in package_ids:
+            try:
+                package_index.update_dict(
+                    core_logic.get_action('package_show')(context.copy(), {'id': pkg_id}),
+                    defer_commit=True
+                )
+            except Exception as e:
+                errors.append('Encountered {error} processing {pkg}'.format(
+                    error=repr(e),
+                    pkg=pkg_id
+                ))
+    commit()
+
+    if not _set_chunk_task(rebuild_id, number, 'error' if errors else 'complete', {
+        'total': len(package_ids),
+        'indexed': len(package_ids) - len(errors),
+    }, error=errors):
+        # a new rebuild was started meanwhile, its own chunk will index these packages
+        log.info('Chunk {} of outdated search index rebuild {} not recorded'.format(number, rebuild_id))
+        return errors
+    _finish_rebuild(rebuild_id)
+
+    return errors
+
+
+def get_status():
+    """
+    Return a summary of the current (or last) rebuild
+    """
+    tasks = (
+        model.Session.query(model.TaskStatus)
+        .filter(model.TaskStatus.entity_id == TASK['entity_id'])
+        .filter(model.TaskStatus.task_type == TASK['task_type'])
+        .all()
+    )
+    tasks = {task.key: task for task in tasks}
+
+    status = {
+        'id': None,
+        'state': None,
+        'started': None,
+        'finished': None,
+        'incremental': False,
+        'total': 0,
+        'indexed': 0,
+        'chunks': 0,
+        'chunks_done': 0,
+        'errors': [],
+        'last_success': None,
+    }
+    if LAST_SUCCESS_KEY in tasks:
+        status['last_success'] = tasks[LAST_SUCCESS_KEY].value
+
+    rebuild = tasks.get(REBUILD_KEY)
+    if not rebuild:
+        return status
+
+    value = json.loads(rebuild.value)
+    status.update({
+        'id': value['id'],
+        'state': rebuild.state,
+        'started': value['started'],
+        'finished': value.get('finished'),
+        'incremental': value['incremental'],
+        'total': value['total'],
+        'chunks': value['chunks'],
+    })
+    chunks = sorted(
+        [task for key, task in tasks.items() if key.startswith(CHUNK_KEY_PREFIX)],
+        key=lambda task: int(task.key[len(CHUNK_KEY_PREFIX):])
+    )
+    for task in chunks:
+        if task.state in ('complete', 'error'):
+            status['chunks_done'] += 1
+        status['indexed'] += json.loads(task.value)['indexed']
+        if task.error:
+            status['errors'].extend(json.loads(task.error))
+
+    return status
+
+
+# Internal
+
+def _chunk_key(number):
+    return '{}{}'.format(CHUNK_KEY_PREFIX, number)
+
+
+def _get_task(key):
+    return (
+        model.Session.query(model.TaskStatus)
+        .filter(model.TaskStatus.entity_id == TASK['entity_id'])
+        .filter(model.TaskStatus.task_type == TASK['task_type'])
+        .filter(model.TaskStatus.key == key)
+        .first()
+    )
+
+
+def _set_task(key, state, value=None, error=None, commit=True):
+    task = _get_task(key)
+    if not task:
+        task = model.TaskStatus(key=key, **TASK)
+        model.Session.add(task)
+    task.state = state
+    task.value = value if isinstance(value, str) else json.dumps(value)
+    task.error = json.dumps(error) if error else None
+    task.last_updated = datetime.datetime.utcnow()
+    if commit:
+        model.Session.commit()
+    return task
+
+
+def _set_chunk_task(rebuild_id, number, state, value, error=None):
+    """
+    Update the row of a chunk only if it still belongs to `rebuild_id`.
+    The row is locked while checked, so a new rebuild can't recreate it
+    in between. Returns False if the chunk is outdated
+    """
+    task = (
+        model.Session.query(model.TaskStatus)
+        .filter(model.TaskStatus.entity_id == TASK['entity_id'])
+        .filter(model.TaskStatus.task_type == TASK['task_type'])
+        .filter(model.TaskStatus.key == _chunk_key(number))
+        .with_for_update()
+        .first()
+    )
+    if not task or json.loads(task.value).get('id') != rebuild_id:
+        model.Session.commit()
+        return False
+
+    task.state = state
+    task.value = json.dumps(dict(value, id=rebuild_id))
+    task.error = json.dumps(error) if error else None
+    task.last_updated = datetime.datetime.utcnow()
+    model.Session.commit()
+    return True
+
+
+def _finish_rebuild(rebuild_id):
+    # Lock the rebuild row, so only the last chunk to finish closes it
+    rebuild = (
+        model.Session.query(model.TaskStatus)
+        .filter(model.TaskStatus.entity_id == TASK['entity_id'])
+        .filter(model.TaskStatus.task_type == TASK['task_type'])
+        .filter(model.TaskStatus.key == REBUILD_KEY)
+        .with_for_update()
+        .first()
+    )
+    value = json.loads(rebuild.value) if rebuild else {}
+    if value.get('id') != rebuild_id or rebuild.state != 'running':
+        model.Session.commit()
+        return
+
+    states = [
+        r[0] for r in
+        model.Session.query(model.TaskStatus.state)
+        .filter(model.TaskStatus.entity_id == TASK['entity_id'])
+        .filter(model.TaskStatus.task_type == TASK['task_type'])
+        .filter(model.TaskStatus.key.like(CHUNK_KEY_PREFIX + '%'))
+        .all()
+    ]
+    if any(state not in ('complete', 'error') for state in states):
+        model.Session.commit()
+        return
+
+    failed = 'error' in states
+    value['finished'] = datetime.datetime.utcnow().isoformat()
+    rebuild.value = json.dumps(value)
+    rebuild.state = 'error' if failed else 'complete'
+    rebuild.last_updated = datetime.datetime.utcnow()
+    if not failed:
+        # Packages modified while the rebuild was running will be picked up
+        # by the next incremental rebuild
+        _set_task(LAST_SUCCESS_KEY, 'complete', value=value['started'], commit=False)
+    model.Session.commit()
@@ -2,6 +2,11 @@
 
 import os
 import contextlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import sqlalchemy as sa
 import pytest
 
@@ -11,6 +16,7 @@ from ckan.common import config
 from ckan.config import environment
 
 
+from ckanext.unhcr.cache import invalidate_all as invalidate_all_caches
 from ckanext.unhcr.models import create_tables as unhcr_create_tables
 
 
@@ -46,6 +52,9 @@ def unhcr_migrate():
           """
     engine.execute(sql)
 
+    # the DB was cleared, so anything cached from a previous test is stale
+    invalidate_all_caches()
+
 
 @pytest.fixture(autouse=True, scope='session')
 def use_test_env():
@@ -57,3 +66,72 @@ def use_test_env():
 
     # teardown
     os.environ.pop('CKAN_TESTING', None)
+
+
+class ClamAVServer(object):
+    """
+    Local stand-in for the Clam AV job service: accepts `POST /job` and
+    answers like the real one after `latency` seconds, without scanning
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.jobs = []
+        self.connections = set()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._get_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _get_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                job = json.loads(self.rfile.read(length))
+                if self.path != '/job':
+                    return self._respond(404, {'error': 'Not found'})
+                if server.latency:
+                    time.sleep(server.latency)
+                job_id = str(uuid.uuid4())
+                with server._lock:
+                    server.jobs.append(job)
+                    server.connections.add(self.client_address)
+                self._respond(200, {'job_id': job_id, 'job_key': job_id})
+
+            def _respond(self, status, body):
+                body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def clamav_server():
+    server = ClamAVServer()
+    server.start()
+
+    yield server
+
+    server.stop()
@@ -456,6 +456,64 @@ class TestAccessRequestListForUser(object):
         )
         assert 6 == len(access_requests)
 
+    def test_access_request_list_for_user_count_only(self):
+        action = toolkit.get_action("access_request_list_for_user")
+        for user, status in [
+            (self.sysadmin, "requested"),
+            (self.sysadmin, "all"),
+            (self.container1_admin, "requested"),
+            (self.multi_container_admin, "all"),
+        ]:
+            context = {"model": model, "user": user["name"]}
+            count = action(context, {"status": status, "count_only": True})
+            assert count == len(action(context, {"status": status}))
+
+    def test_access_request_list_for_user_pagination(self):
+        action = toolkit.get_action("access_request_list_for_user")
+        context = {"model": model, "user": self.sysadmin["name"]}
+        all_ids = [req["id"] for req in action(context, {"status": "all"})]
+
+        page1 = action(context, {"status": "all", "limit": 4})
+        page2 = action(context, {"status": "all", "limit": 4, "offset": 4})
+        assert [req["id"] for req in page1 + page2] == all_ids
+
+        cursor_ids = []
+        data_dict = {"status": "all", "limit": 4}
+        while True:
+            page = action(context, data_dict)
+            if not page:
+                break
+            cursor_ids += [req["id"] for req in page]
+            data_dict["cursor"] = page[-1]["id"]
+        assert cursor_ids == all_ids
+
+        with pytest.raises(toolkit.ValidationError):
+            action(context, {"cursor": "invalid-id"})
+
+    def test_access_request_list_for_user_columns(self):
+        access_requests = toolkit.get_action("access_request_list_for_user")(
+            {"model": model, "user": self.container1_admin["name"]}, {}
+        )
+        assert access_requests
+        for req in access_requests:
+            assert "plugin_extras" not in req["user"]
+            assert "password" not in req["user"]
+            assert "apikey" not in req["user"]
+            assert "created" in req["user"]
+            assert "notes" in req["object"] or "description" in req["object"]
+
+    def test_access_request_list_for_user_compact(self):
+        access_requests = toolkit.get_action("access_request_list_for_user")(
+            {"model": model, "user": self.container1_admin["name"]}, {"compact": True}
+        )
+        assert access_requests
+        for req in access_requests:
+            assert set(req["user"].keys()) == {"id", "name", "fullname", "email", "state"}
+            assert req["user"]["id"] == self.requesting_user["id"]
+            assert req["object"]["id"] == req["object_id"]
+            assert req["object"]["name"]
+            assert req["object"]["title"]
+
     def test_access_request_list_for_user_container_admins(self):
         # container admins can only see access requests for their own container(s)
         # and datasets owned by their own container(s)
@@ -11,6 +11,7 @@ from dateutil.parser import parse as parse_date
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
 from ckan.plugins import toolkit
 from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import clamav, scan_status
 from ckanext.unhcr.tests import factories
 from ckanext.unhcr.kobo.kobo_dataset import DOWNLOAD_PENDING_MSG
 
@@ -52,17 +53,32 @@ class TestClamAVActions(object):
             }
         )
 
+    def submit(self, resource_ids=None):
+        with mock.patch('ckan.plugins.toolkit.enqueue_job') as enqueue_job:
+            results = [
+                toolkit.get_action("scan_submit")(
+                    {'user': self.sysadmin['name']},
+                    {'id': resource_id}
+                )
+                for resource_id in (resource_ids or [self.resource['id']])
+            ]
+        return results, enqueue_job
+
     @responses.activate
     @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
     def test_scan_submit_valid(self):
         responses.add_passthru(re.compile(r'^http:\/\/.*solr/.*$'))
         responses.add(responses.POST, 'http://clamav:1234/job', status=200)
 
-        result = toolkit.get_action("scan_submit")(
-            {'user': self.sysadmin['name']},
-            {'id': self.resource['id']}
-        )
-        assert result
+        results, enqueue_job = self.submit()
+        assert results == [True]
+
+        # the upload does not wait for the Clam AV service
+        assert responses.assert_call_count('http://clamav:1234/job', 0)
+        assert enqueue_job.call_args[0][0] == clamav.submit_pending_scans
+        assert u'queued' == self.get_task()['state']
+
+        assert clamav.submit_pending_scans() == {'submitted': 1, 'failed': 0}
 
         assert responses.assert_call_count('http://clamav:1234/job', 1)
         request_body = json.loads(responses.calls[0].request.body)
@@ -74,6 +90,72 @@ class TestClamAVActions(object):
 
         task = self.get_task()
         assert u'pending' == task['state']
+        assert 'api_key' not in task['value']
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_scan_submit_batch(self):
+        responses.add_passthru(re.compile(r'^http:\/\/.*solr/.*$'))
+        responses.add(responses.POST, 'http://clamav:1234/job', status=200)
+        resources = [
+            factories.Resource(package_id=self.dataset['id'], url_type='upload')
+            for i in range(3)
+        ]
+
+        results, enqueue_job = self.submit([resource['id'] for resource in resources])
+        assert results == [True, True, True]
+
+        assert clamav.submit_pending_scans() == {'submitted': 3, 'failed': 0}
+        assert responses.assert_call_count('http://clamav:1234/job', 3)
+        assert {
+            json.loads(call.request.body)['metadata']['resource_id']
+            for call in responses.calls
+        } == {resource['id'] for resource in resources}
+
+        # nothing left to submit
+        assert clamav.submit_pending_scans() == {'submitted': 0, 'failed': 0}
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_backoff_seconds', '0')
+    def test_scan_submit_retry(self):
+        responses.add_passthru(re.compile(r'^http:\/\/.*solr/.*$'))
+        responses.add(responses.POST, 'http://clamav:1234/job', status=503)
+        responses.add(responses.POST, 'http://clamav:1234/job', status=200)
+
+        self.submit()
+
+        assert clamav.submit_pending_scans() == {'submitted': 1, 'failed': 0}
+        assert responses.assert_call_count('http://clamav:1234/job', 2)
+        assert u'pending' == self.get_task()['state']
+
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_scan_submit_result_after_callback(self):
+        self.submit()
+        tasks = clamav._claim_queued_tasks(10)
+        # the Clam AV service calls scan_hook before the batch is stored
+        task = self.get_task()
+        task['state'] = 'complete'
+        toolkit.get_action('task_status_update')({'ignore_auth': True}, task)
+
+        clamav._store_results([clamav._task_result(tasks[0], 'pending', value='{}')])
+
+        assert u'complete' == self.get_task()['state']
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_scan_submit_stuck_task(self, ckan_config, monkeypatch):
+        responses.add_passthru(re.compile(r'^http:\/\/.*solr/.*$'))
+        responses.add(responses.POST, 'http://clamav:1234/job', status=200)
+        self.submit()
+        # claimed by a worker that crashed before storing the result
+        assert len(clamav._claim_queued_tasks(10)) == 1
+
+        assert clamav.submit_pending_scans() == {'submitted': 0, 'failed': 0}
+
+        monkeypatch.setitem(ckan_config, 'ckanext.unhcr.clamav_submitting_timeout', '-1')
+        assert clamav.submit_pending_scans() == {'submitted': 1, 'failed': 0}
+        assert u'pending' == self.get_task()['state']
 
     @responses.activate
     @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
@@ -104,18 +186,26 @@ class TestClamAVActions(object):
 
     @responses.activate
     @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_retries', '0')
     def test_scan_submit_failure(self):
         responses.add_passthru(re.compile(r'^http:\/\/.*solr/.*$'))
         responses.add(responses.POST, 'http://clamav:1234/job', status=500)
 
-        with pytest.raises(toolkit.ValidationError):
-            toolkit.get_action("scan_submit")(
-                {'user': self.sysadmin['name']},
-                {'id': self.resource['id']}
-            )
+        self.submit()
+
+        assert clamav.submit_pending_scans() == {'submitted': 0, 'failed': 1}
 
         task = self.get_task()
         assert u'error' == task['state']
+        assert json.loads(task['error'])['status_code'] == 500
+
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_scan_submit_clears_verdict(self):
+        scan_status.set_verdict(self.resource['id'], infected=True)
+
+        self.submit()
+
+        assert not scan_status.is_infected(self.resource['id'])
 
     def test_scan_submit_invalid_params(self):
         with pytest.raises(toolkit.ValidationError):
@@ -146,6 +236,7 @@ class TestClamAVActions(object):
 
         task = self.get_task()
         assert u'complete' == task['state']
+        assert not scan_status.is_infected(self.resource['id'])
 
         mock_mailer.assert_not_called()
 
@@ -171,6 +262,7 @@ class TestClamAVActions(object):
 
         task = self.get_task()
         assert u'complete' == task['state']
+        assert scan_status.is_infected(self.resource['id'])
 
         mock_mailer.assert_called_once()
 
@@ -256,21 +348,24 @@ class TestClamAVActions(object):
 
         self.insert_pending_task()
 
-        toolkit.get_action("scan_hook")(
-            {'user': self.sysadmin['name']},
-            {
-                "status": "complete",
-                "data": {
-                    "status_code": 0,
-                        "status_text": "SUCCESSFUL SCAN, FILE CLEAN",
-                        "description": "/tmp/tmp37q_kv9u: OK...",
-                },
-                "metadata": {
-                    "resource_id": self.resource['id'],
-                    'original_url': 'not the same url stored on the task'
+        with mock.patch('ckan.plugins.toolkit.enqueue_job'):
+            toolkit.get_action("scan_hook")(
+                {'user': self.sysadmin['name']},
+                {
+                    "status": "complete",
+                    "data": {
+                        "status_code": 0,
+                            "status_text": "SUCCESSFUL SCAN, FILE CLEAN",
+                            "description": "/tmp/tmp37q_kv9u: OK...",
+                    },
+                    "metadata": {
+                        "resource_id": self.resource['id'],
+                        'original_url': 'not the same url stored on the task'
+                    }
                 }
-            }
-        )
+            )
+
+        clamav.submit_pending_scans()
 
         assert responses.assert_call_count('http://clamav:1234/job', 1)
 
@@ -284,21 +379,24 @@ class TestClamAVActions(object):
 
         last_modified = parse_date(self.resource['last_modified'])
         task_created = last_modified - datetime.timedelta(minutes=1)
-        toolkit.get_action("scan_hook")(
-            {'user': self.sysadmin['name']},
-            {
-                "status": "complete",
-                "data": {
-                    "status_code": 0,
-                    "status_text": "SUCCESSFUL SCAN, FILE CLEAN",
-                    "description": "/tmp/tmp37q_kv9u: OK...",
-                },
-                "metadata": {
-                    "resource_id": self.resource['id'],
-                    'task_created': task_created.isoformat(),
+        with mock.patch('ckan.plugins.toolkit.enqueue_job'):
+            toolkit.get_action("scan_hook")(
+                {'user': self.sysadmin['name']},
+                {
+                    "status": "complete",
+                    "data": {
+                        "status_code": 0,
+                        "status_text": "SUCCESSFUL SCAN, FILE CLEAN",
+                        "description": "/tmp/tmp37q_kv9u: OK...",
+                    },
+                    "metadata": {
+                        "resource_id": self.resource['id'],
+                        'task_created': task_created.isoformat(),
+                    }
                 }
-            }
-        )
+            )
+
+        clamav.submit_pending_scans()
 
         assert responses.assert_call_count('http://clamav:1234/job', 1)
 
@@ -47,6 +47,68 @@ class TestOrganizationActions(object):
                 **{'order_by': 'foobar'}
             )
 
+    def test_organization_list_all_fields_fields(self):
+        orgs = call_action(
+            'organization_list_all_fields',
+            {'ignore_auth': True},
+            **{'fields': ['visible_external', 'country']}
+        )
+        assert [org['name'] for org in orgs] == ['so', 'za', 'tz']
+        for org in orgs:
+            assert sorted(org.keys()) == [
+                'country', 'display_name', 'id', 'name', 'title', 'visible_external'
+            ]
+            assert org['visible_external'] is True
+            assert org['country'] == ['SVN']
+            assert org['display_name'] == org['title']
+
+    def test_organization_list_all_fields_fields_invalid(self):
+        with pytest.raises(toolkit.Invalid):
+            call_action(
+                'organization_list_all_fields',
+                {'ignore_auth': True},
+                **{'fields': ['foobar']}
+            )
+
+    def test_organization_list_all_fields_fields_match_full_list(self):
+        full = call_action('organization_list_all_fields', {'ignore_auth': True})
+        pruned = call_action(
+            'organization_list_all_fields',
+            {'ignore_auth': True},
+            **{'fields': 'visible_external,geographic_area'}
+        )
+        for full_org, pruned_org in zip(full, pruned):
+            for key in pruned_org:
+                assert pruned_org[key] == full_org[key]
+
+    def test_organization_list_all_fields_cached(self):
+        orgs = call_action('organization_list_all_fields', {'ignore_auth': True})
+        with mock.patch('ckan.lib.plugins.lookup_group_plugin') as lookup:
+            assert call_action('organization_list_all_fields', {'ignore_auth': True}) == orgs
+        assert lookup.call_count == 0
+
+    def test_organization_list_all_fields_invalidated(self):
+        call_action('organization_list_all_fields', {'ignore_auth': True})
+        factories.DataContainer(name='ke', title='Kenya')
+        orgs = call_action('organization_list_all_fields', {'ignore_auth': True})
+        assert [org['name'] for org in orgs] == ['ke', 'so', 'za', 'tz']
+
+        call_action(
+            'organization_patch',
+            {'ignore_auth': True, 'user': core_factories.Sysadmin()['name']},
+            **{'id': 'ke', 'title': 'Zambia'}
+        )
+        orgs = call_action('organization_list_all_fields', {'ignore_auth': True})
+        assert [org['name'] for org in orgs] == ['so', 'za', 'tz', 'ke']
+
+        call_action('organization_delete', {'ignore_auth': True}, **{'id': 'ke'})
+        orgs = call_action('organization_list_all_fields', {'ignore_auth': True})
+        assert [org['name'] for org in orgs] == ['so', 'za', 'tz']
+
+        call_action('organization_purge', {'ignore_auth': True}, **{'id': 'za'})
+        orgs = call_action('organization_list_all_fields', {'ignore_auth': True})
+        assert [org['name'] for org in orgs] == ['so', 'tz']
+
 
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestOrganizationMemberCreate(object):
@@ -125,6 +187,25 @@ class TestPendingRequestsList(object):
         assert requests['count'] == 1
         assert requests['containers'][0]['name'] == 'container1'
 
+    def test_container_request_list_all_fields_parent(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        parent = factories.DataContainer(name='parent')
+        factories.DataContainer(
+            name='child',
+            state='approval_needed',
+            groups=[{'name': parent['name']}],
+        )
+        # a child of the pending container is not its parent
+        pending = factories.DataContainer(name='pending', state='approval_needed')
+        factories.DataContainer(name='grandchild', groups=[{'name': pending['name']}])
+        context = {'model': model, 'user': 'sysadmin'}
+        requests = toolkit.get_action("container_request_list")(
+            context, {'all_fields': True}
+        )
+        containers = {container['name']: container for container in requests['containers']}
+        assert [group['name'] for group in containers['child']['groups']] == ['parent']
+        assert containers['pending']['groups'] == []
+
     def test_container_request_list_empty(self):
         sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
         context = {'model': model, 'user': 'sysadmin'}
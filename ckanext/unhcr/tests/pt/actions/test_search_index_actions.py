@@ -0,0 +1,140 @@
+import datetime
+import mock
+import pytest
+from ckan.lib import search
+import ckan.model as model
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr.jobs import rebuild_search_index_chunk
+from ckanext.unhcr.tests import factories
+
+
+def _search_count():
+    return toolkit.get_action('package_search')(
+        {'ignore_auth': True}, {'q': '*:*', 'rows': 0}
+    )['count']
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestSearchIndexRebuild(object):
+
+    def setup(self):
+        self.sysadmin = core_factories.Sysadmin()
+        self.context = {'user': self.sysadmin['name']}
+        self.datasets = [factories.Dataset() for i in range(5)]
+        search.index_for(model.Package).clear()
+
+    def test_rebuild_not_sysadmin(self):
+        user = core_factories.User()
+        with pytest.raises(toolkit.NotAuthorized):
+            toolkit.get_action('search_index_rebuild')({'user': user['name']}, {})
+        with pytest.raises(toolkit.NotAuthorized):
+            toolkit.get_action('search_index_rebuild_status')({'user': user['name']}, {})
+
+    def test_rebuild_in_chunks(self):
+        status = toolkit.get_action('search_index_rebuild')(
+            self.context, {'background': False, 'chunk_size': 2}
+        )
+
+        assert status['state'] == 'complete'
+        assert status['total'] == 5
+        assert status['indexed'] == 5
+        assert status['chunks'] == 3
+        assert status['chunks_done'] == 3
+        assert status['errors'] == []
+        assert status['last_success'] == status['started']
+        assert _search_count() == 5
+
+    def test_rebuild_background(self):
+        with mock.patch('ckan.plugins.toolkit.enqueue_job') as enqueue_job:
+            status = toolkit.get_action('search_index_rebuild')(
+                self.context, {'chunk_size': 2}
+            )
+        assert enqueue_job.call_count == 3
+        assert status['state'] == 'running'
+        assert status['chunks_done'] == 0
+        assert _search_count() == 0
+
+        # run the jobs
+        for call in enqueue_job.call_args_list:
+            assert call[0][0] == rebuild_search_index_chunk
+            rebuild_search_index_chunk(*call[0][1])
+
+        status = toolkit.get_action('search_index_rebuild_status')(self.context, {})
+        assert status['state'] == 'complete'
+        assert status['indexed'] == 5
+        assert status['chunks_done'] == 3
+        assert _search_count() == 5
+
+    def test_outdated_chunks_are_skipped(self):
+        with mock.patch('ckan.plugins.toolkit.enqueue_job') as enqueue_job:
+            toolkit.get_action('search_index_rebuild')(self.context, {'chunk_size': 2})
+        outdated = enqueue_job.call_args_list[0][0][1]
+
+        toolkit.get_action('search_index_rebuild')(self.context, {'background': False})
+        search.index_for(model.Package).clear()
+        rebuild_search_index_chunk(*outdated)
+
+        assert _search_count() == 0
+
+    def test_outdated_chunk_finishing_after_new_rebuild(self):
+        with mock.patch('ckan.plugins.toolkit.enqueue_job') as enqueue_job:
+            toolkit.get_action('search_index_rebuild')(self.context, {'chunk_size': 10})
+        outdated = enqueue_job.call_args_list[0][0][1]
+
+        new_chunks = []
+
+        def start_new_rebuild(*args, **kwargs):
+            # a new rebuild starts while the old chunk is running
+            if not new_chunks:
+                with mock.patch('ckan.plugins.toolkit.enqueue_job') as enqueue_job:
+                    toolkit.get_action('search_index_rebuild')(self.context, {'chunk_size': 10})
+                new_chunks.append(enqueue_job.call_args_list[0][0][1])
+
+        with mock.patch('ckan.lib.search.PackageSearchIndex.update_dict', side_effect=start_new_rebuild):
+            rebuild_search_index_chunk(*outdated)
+
+        # the old chunk didn't mark the new one as done
+        status = toolkit.get_action('search_index_rebuild_status')(self.context, {})
+        assert status['id'] == new_chunks[0][0]
+        assert status['state'] == 'running'
+        assert status['chunks_done'] == 0
+        assert status['last_success'] is None
+
+        rebuild_search_index_chunk(*new_chunks[0])
+        status = toolkit.get_action('search_index_rebuild_status')(self.context, {})
+        assert status['state'] == 'complete'
+        assert _search_count() == 5
+
+    def test_rebuild_errors(self):
+        with mock.patch('ckan.lib.search.PackageSearchIndex.update_dict', side_effect=Exception('Solr error')):
+            status = toolkit.get_action('search_index_rebuild')(
+                self.context, {'background': False, 'chunk_size': 2}
+            )
+
+        assert status['state'] == 'error'
+        assert len(status['errors']) == 5
+        assert status['last_success'] is None
+
+    def test_incremental_rebuild(self):
+        toolkit.get_action('search_index_rebuild')(self.context, {'background': False})
+        search.index_for(model.Package).clear()
+
+        # only this one was modified after the last rebuild
+        pkg = model.Package.get(self.datasets[0]['id'])
+        pkg.metadata_modified = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        model.Session.commit()
+
+        status = toolkit.get_action('search_index_rebuild')(
+            self.context, {'background': False, 'incremental': True}
+        )
+
+        assert status['incremental']
+        assert status['total'] == 1
+        assert _search_count() == 1
+
+    def test_invalid_chunk_size(self):
+        with pytest.raises(toolkit.ValidationError):
+            toolkit.get_action('search_index_rebuild')(
+                self.context, {'background': False, 'chunk_size': 0}
+            )
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import random
+import time
+from ckan import plugins
+from ckanext.scheming.helpers import scheming_get_dataset_schema
+from ckanext.unhcr import display_names
+
+
+log = logging.getLogger(__name__)
+
+PACKAGES = 10000
+SELECT_FIELDS = [
+    'keywords', 'sampling_procedure', 'operational_purpose_of_data',
+    'data_collection_technique', 'process_status', 'identifiability',
+]
+MULTIPLE_FIELDS = ['keywords', 'sampling_procedure', 'operational_purpose_of_data']
+
+
+def _synthetic_packages(schema, count):
+    rnd = random.Random(42)
+    choices = {
+        field['field_name']: [c['value'] for c in field['choices']]
+        for field in schema['dataset_fields']
+        if field['field_name'] in SELECT_FIELDS
+    }
+    packages = []
+    for index in range(count):
+        pkg_dict = {
+            'id': 'pkg-{}'.format(index),
+            'type': 'dataset',
+            'data_collector': 'ACF,UNHCR',
+        }
+        for field in SELECT_FIELDS:
+            if field in MULTIPLE_FIELDS:
+                pkg_dict[field] = json.dumps(rnd.sample(choices[field], 2))
+            else:
+                pkg_dict[field] = rnd.choice(choices[field])
+        packages.append(pkg_dict)
+    return packages
+
+
+def _legacy_vocab_labels(schema, pkg_dict):
+    """ The nested loops before_index used before the lookup tables """
+    for field in SELECT_FIELDS:
+        try:
+            values = json.loads(pkg_dict[field])
+        except ValueError:
+            values = [pkg_dict[field]]
+        out = []
+        for schema_field in schema['dataset_fields']:
+            if schema_field['field_name'] == field:
+                for item in values:
+                    for choice in schema_field['choices']:
+                        if choice['value'] == item:
+                            out.append(choice['label'])
+        pkg_dict['vocab_' + field] = out
+    return pkg_dict
+
+
+class TestBeforeIndexBenchmark(object):
+
+    def test_choice_labels_lookup_vs_scan(self):
+        plugin = plugins.get_plugin('unhcr')
+        schema = scheming_get_dataset_schema('dataset')
+        packages = _synthetic_packages(schema, PACKAGES)
+
+        start = time.perf_counter()
+        legacy = [
+            _legacy_vocab_labels(scheming_get_dataset_schema('dataset'), dict(pkg))
+            for pkg in packages
+        ]
+        legacy_time = time.perf_counter() - start
+
+        # Download counts are pre-fetched per chunk by index_chunk
+        download_counts = {pkg['id']: 0 for pkg in packages}
+        start = time.perf_counter()
+        with display_names.indexing_batch(download_counts=download_counts):
+            indexed = [plugin.before_index(dict(pkg)) for pkg in packages]
+        indexed_time = time.perf_counter() - start
+
+        log.info('before_index labels for {} packages: scan {:.3f}s, lookup {:.3f}s'.format(
+            PACKAGES, legacy_time, indexed_time))
+
+        for old, new in zip(legacy, indexed):
+            for field in SELECT_FIELDS:
+                assert old['vocab_' + field] == new['vocab_' + field]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import logging
+import time
+import pytest
+from ckan import model
+from ckan.model.types import make_uuid
+from ckanext.unhcr import clamav
+
+
+log = logging.getLogger(__name__)
+
+TASKS = 200
+LATENCY = 0.02
+WORKERS = 8
+
+
+def _queue_tasks():
+    now = datetime.datetime.utcnow()
+    tasks = [
+        {
+            'id': make_uuid(),
+            'entity_id': make_uuid(),
+            'entity_type': 'resource',
+            'task_type': 'clamav',
+            'key': 'clamav',
+            'state': 'queued',
+            'last_updated': now,
+            'error': 'null',
+            'value': json.dumps({
+                'job_type': 'scan',
+                'result_url': 'http://test.ckan.net/api/3/action/scan_hook',
+                'metadata': {'resource_id': 'resource-{}'.format(i)},
+            }),
+        }
+        for i in range(TASKS)
+    ]
+    model.Session.execute(model.meta.metadata.tables['task_status'].insert(), tasks)
+    model.Session.commit()
+
+
+def _timed_submit(server, monkeypatch, ckan_config, workers):
+    monkeypatch.setitem(ckan_config, 'ckanext.unhcr.clamav_workers', str(workers))
+    # a new pool sized for the number of workers
+    monkeypatch.setattr(clamav, '_session', None)
+    server.jobs[:] = []
+    server.connections.clear()
+    _queue_tasks()
+
+    start = time.perf_counter()
+    stats = clamav.submit_pending_scans()
+    return time.perf_counter() - start, stats
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestClamAVSubmitBenchmark(object):
+
+    def test_submit_pending_scans(self, clamav_server, monkeypatch, ckan_config):
+        clamav_server.latency = LATENCY
+        monkeypatch.setitem(ckan_config, 'ckanext.unhcr.clamav_url', clamav_server.url)
+
+        serial_time, serial_stats = _timed_submit(clamav_server, monkeypatch, ckan_config, 1)
+        serial_connections = len(clamav_server.connections)
+        concurrent_time, concurrent_stats = _timed_submit(clamav_server, monkeypatch, ckan_config, WORKERS)
+        concurrent_connections = len(clamav_server.connections)
+
+        log.info('submit_pending_scans for {} tasks ({}s per job): 1 worker {:.3f}s ({} connections), '
+                 '{} workers {:.3f}s ({} connections)'.format(
+                     TASKS, LATENCY, serial_time, serial_connections,
+                     WORKERS, concurrent_time, concurrent_connections))
+
+        assert serial_stats == concurrent_stats == {'submitted': TASKS, 'failed': 0}
+        assert len(clamav_server.jobs) == TASKS
+        # connections are kept alive and reused
+        assert serial_connections == 1
+        assert concurrent_connections <= WORKERS
+        assert concurrent_time < serial_time
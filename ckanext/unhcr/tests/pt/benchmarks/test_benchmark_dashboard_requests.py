@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import pytest
+from sqlalchemy import event
+from ckan import model
+from ckan.model.types import make_uuid
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr.models import (
+    AccessRequest, USER_REQUEST_TYPE_NEW, USER_REQUEST_TYPE_RENEWAL,
+)
+from ckanext.unhcr.tests import factories
+
+
+log = logging.getLogger(__name__)
+
+PENDING_CONTAINERS = 20
+ACCOUNT_REQUESTS = 200
+RENEWAL_REQUESTS = 100
+CONTAINER_REQUESTS = 100
+DATASET_REQUESTS = 100
+MAX_SECONDS = 10
+MAX_STATEMENTS = 100
+
+
+def _create_requests(container, dataset):
+    users = []
+    requests = []
+    user_requests = [USER_REQUEST_TYPE_NEW] * ACCOUNT_REQUESTS + [USER_REQUEST_TYPE_RENEWAL] * RENEWAL_REQUESTS
+    for i, request_type in enumerate(user_requests):
+        user_id = make_uuid()
+        users.append({
+            'id': user_id,
+            'name': 'requesting-user-{}'.format(i),
+            'email': 'requesting-user-{}@example.com'.format(i),
+            'state': model.State.PENDING if request_type == USER_REQUEST_TYPE_NEW else model.State.ACTIVE,
+            'plugin_extras': {'unhcr': {
+                'focal_point': 'focal-point-{}'.format(i),
+                'default_containers': [container['id']],
+            }},
+        })
+        requests.append({
+            'id': make_uuid(),
+            'user_id': user_id,
+            'object_id': user_id,
+            'object_type': 'user',
+            'message': '',
+            'role': 'member',
+            'data': {'user_request_type': request_type, 'default_containers': [container['id']]},
+        })
+    for i in range(CONTAINER_REQUESTS + DATASET_REQUESTS):
+        is_container = i < CONTAINER_REQUESTS
+        requests.append({
+            'id': make_uuid(),
+            'user_id': users[i]['id'],
+            'object_id': container['id'] if is_container else dataset['id'],
+            'object_type': 'organization' if is_container else 'package',
+            'message': '',
+            'role': 'member',
+            'data': {},
+        })
+    model.Session.execute(model.meta.metadata.tables['user'].insert(), users)
+    model.Session.execute(AccessRequest.__table__.insert(), requests)
+    model.Session.commit()
+    return len(requests)
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestDashboardRequestsBenchmark(object):
+
+    def test_dashboard_requests(self, app):
+        sysadmin = core_factories.Sysadmin()
+        container = factories.DataContainer()
+        dataset = factories.Dataset(owner_org=container['id'])
+        for i in range(PENDING_CONTAINERS):
+            factories.DataContainer(
+                name='pending-container-{}'.format(i),
+                state='approval_needed',
+                groups=[{'name': container['name']}],
+            )
+        total = _create_requests(container, dataset)
+
+        statements = []
+
+        def count_statement(*args, **kwargs):
+            statements.append(1)
+
+        event.listen(model.meta.engine, 'before_cursor_execute', count_statement)
+        try:
+            start = time.perf_counter()
+            resp = app.get(
+                url='/dashboard/requests',
+                extra_environ={'REMOTE_USER': sysadmin['name'].encode('ascii')},
+                status=200,
+            )
+            elapsed = time.perf_counter() - start
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute', count_statement)
+
+        log.info('/dashboard/requests with {} pending containers and {} access requests: '
+                 '{:.3f}s, {} statements'.format(PENDING_CONTAINERS, total, elapsed, len(statements)))
+
+        assert 'pending-container-{}'.format(PENDING_CONTAINERS - 1) in resp.body
+        # each pending container is shown under its parent container
+        parent_link = 'href="/data-container/{}" title="Parent data container"'.format(container['name'])
+        assert resp.body.count(parent_link) == PENDING_CONTAINERS
+        assert 'focal-point-{}'.format(ACCOUNT_REQUESTS + RENEWAL_REQUESTS - 1) in resp.body
+        assert len(statements) < MAX_STATEMENTS
+        assert elapsed < MAX_SECONDS
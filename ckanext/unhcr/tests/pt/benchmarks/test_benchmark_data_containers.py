@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import pytest
+from ckan import model
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import helpers
+from ckanext.unhcr.tests import factories
+
+
+log = logging.getLogger(__name__)
+
+CONTAINERS = 300
+
+
+def _legacy_get_all_data_containers(exclude_ids, include_ids, userobj, dataset):
+    """ The per-container loop get_all_data_containers used before """
+    data_containers = []
+    context = {'model': model, 'ignore_auth': True}
+    orgs = toolkit.get_action('organization_list_all_fields')(context, {})
+    for org in orgs:
+        if org['id'] in exclude_ids:
+            continue
+        if org['approval_status'] != u'approved':
+            continue
+        if org['id'] in include_ids:
+            data_containers.append(org)
+            continue
+        if userobj.external and not org.get('visible_external'):
+            continue
+        if (
+            dataset
+            and not helpers.user_is_curator(userobj)
+            and not userobj.sysadmin
+            and not userobj.external
+            and dataset['creator_user_id'] != userobj.id
+        ):
+            user_orgs = toolkit.get_action('organization_list_for_user')(
+                context,
+                {'id': userobj.id, "permission": "admin"}
+            )
+            if org['id'] not in [o['id'] for o in user_orgs]:
+                continue
+        data_containers.append(org)
+    return data_containers
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate', 'with_request_context')
+class TestDataContainersBenchmark(object):
+
+    def test_dataset_form_dropdown(self):
+        deposit = factories.DataContainer(id='data-deposit', name='data-deposit')
+        user = core_factories.User()
+        for i in range(CONTAINERS):
+            users = [{'name': user['name'], 'capacity': 'admin'}] if i % 3 == 0 else []
+            factories.DataContainer(users=users)
+        userobj = model.User.get(user['id'])
+        dataset = {'creator_user_id': 'someone-else', 'owner_org_dest': None}
+
+        start = time.perf_counter()
+        legacy = _legacy_get_all_data_containers([deposit['id']], [], userobj, dataset)
+        legacy_time = time.perf_counter() - start
+
+        # The options of the dropdown, as the owner_org_dest form snippet gets them
+        start = time.perf_counter()
+        current = helpers.get_all_data_containers(
+            exclude_ids=[deposit['id']],
+            include_ids=[dataset['owner_org_dest']],
+            userobj=userobj,
+            dataset=dataset,
+        )
+        current_time = time.perf_counter() - start
+
+        log.info('Data container dropdown for {} containers: loop {:.3f}s, set-based {:.3f}s'.format(
+            CONTAINERS, legacy_time, current_time))
+
+        assert [org['id'] for org in current] == [org['id'] for org in legacy]
+        assert len(current) == CONTAINERS // 3
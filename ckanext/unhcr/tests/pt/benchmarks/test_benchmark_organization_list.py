@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import pytest
+from sqlalchemy import and_, select
+from sqlalchemy.orm import aliased
+from ckan import model
+from ckan.model.types import make_uuid
+from ckan.tests.helpers import call_action
+from ckanext.unhcr.cache import invalidate_all
+
+
+log = logging.getLogger(__name__)
+
+CONTAINERS = 1000
+EXTRAS = 30
+
+
+def _create_containers():
+    groups = []
+    extras = []
+    for i in range(CONTAINERS):
+        group_id = make_uuid()
+        groups.append({
+            'id': group_id,
+            'name': 'container-{}'.format(i),
+            'title': 'Container {}'.format(i),
+            'type': 'data-container',
+            'is_organization': True,
+            'state': 'active',
+            'approval_status': 'approved',
+            'image_url': '',
+            'description': '',
+        })
+        extras.append({'id': make_uuid(), 'group_id': group_id, 'key': 'visible_external',
+                       'value': 'true', 'state': 'active'})
+        extras.append({'id': make_uuid(), 'group_id': group_id, 'key': 'country',
+                       'value': '["SVN"]', 'state': 'active'})
+        for j in range(EXTRAS - 2):
+            extras.append({'id': make_uuid(), 'group_id': group_id, 'key': 'extra_{}'.format(j),
+                           'value': 'value {}'.format(j), 'state': 'active'})
+    model.Session.execute(model.meta.metadata.tables['group'].insert(), groups)
+    model.Session.execute(model.meta.metadata.tables['group_extra'].insert(), extras)
+    model.Session.commit()
+
+
+def _legacy_query():
+    """ The query with one outer join per extra key used before """
+    session = model.Session
+    extra_cols = [rec[0] for rec in session.query(model.GroupExtra.key).distinct()]
+    group_table = model.meta.metadata.tables['group']
+    group_extra_table = model.meta.metadata.tables['group_extra']
+    join_obj = group_table
+    select_cols = [col for col in group_table.columns]
+    for col in extra_cols:
+        extras_alias = aliased(group_extra_table, name='extras_{}'.format(col))
+        select_cols.append(extras_alias.c.value.label(col))
+        join_obj = join_obj.join(
+            extras_alias,
+            and_(
+                group_table.c.id==extras_alias.c.group_id,
+                extras_alias.c.key==col,
+                extras_alias.c.state=='active',
+            ), isouter=True,
+        )
+    sql = select(select_cols).select_from(join_obj).where(
+        and_(
+            group_table.c.type=='data-container',
+            group_table.c.state=='active',
+            group_table.c.is_organization==True,
+        )
+    ).order_by('title')
+    return session.execute(sql).fetchall()
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestOrganizationListBenchmark(object):
+
+    def test_organization_list_all_fields(self):
+        _create_containers()
+
+        joins_time, rows = _timed(_legacy_query)
+
+        invalidate_all()
+        full_time, full = _timed(call_action, 'organization_list_all_fields', {'ignore_auth': True})
+        cached_time, cached = _timed(call_action, 'organization_list_all_fields', {'ignore_auth': True})
+        fields_time, pruned = _timed(
+            call_action,
+            'organization_list_all_fields',
+            {'ignore_auth': True},
+            fields=['visible_external'],
+        )
+
+        log.info(
+            'organization_list_all_fields for {} containers with {} extras: '
+            'joins query {:.3f}s, pivot + validation {:.3f}s, cached {:.3f}s, '
+            'fields=visible_external {:.3f}s'.format(
+                CONTAINERS, EXTRAS, joins_time, full_time, cached_time, fields_time)
+        )
+
+        assert len(rows) == len(full) == len(cached) == len(pruned) == CONTAINERS
+        assert [row['id'] for row in rows] == [org['id'] for org in full]
+        assert cached == full
+        for org, row in zip(pruned, rows):
+            assert org['id'] == row['id']
+            assert org['visible_external'] is True
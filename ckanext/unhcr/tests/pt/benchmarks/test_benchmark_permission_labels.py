@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import mock
+import pytest
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import permission_labels
+from ckanext.unhcr.tests import factories
+
+
+log = logging.getLogger(__name__)
+
+CONTAINERS = 200
+SEARCHES = 50
+
+
+def _time_searches(user):
+    start = time.perf_counter()
+    for i in range(SEARCHES):
+        result = toolkit.get_action('package_search')(
+            {'user': user['name']}, {'q': '*:*', 'rows': 10}
+        )
+    return time.perf_counter() - start, result['count']
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestPermissionLabelsBenchmark(object):
+
+    def test_package_search_with_and_without_cache(self):
+        factories.DataContainer(id='data-deposit', name='data-deposit')
+        user = core_factories.User()
+        for i in range(CONTAINERS):
+            container = factories.DataContainer(
+                users=[{'name': user['name'], 'capacity': 'editor'}]
+            )
+            if i % 20 == 0:
+                factories.Dataset(owner_org=container['id'], private=True)
+
+        with mock.patch.object(permission_labels, 'is_cache_enabled', return_value=False):
+            uncached_time, uncached_count = _time_searches(user)
+
+        permission_labels.invalidate_user_labels()
+        with mock.patch.object(permission_labels, 'is_cache_enabled', return_value=True):
+            cached_time, cached_count = _time_searches(user)
+
+        log.info('{} package_search calls for a member of {} containers: '
+                 'no cache {:.3f}s, cache {:.3f}s'.format(
+                     SEARCHES, CONTAINERS, uncached_time, cached_time))
+
+        assert uncached_count == cached_count == CONTAINERS // 20
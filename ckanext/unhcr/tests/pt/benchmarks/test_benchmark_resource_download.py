@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import pytest
+from ckan import model
+from ckan.logic.auth import get_resource_object
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import auth, helpers
+from ckanext.unhcr.tests import factories
+
+
+log = logging.getLogger(__name__)
+
+DOWNLOADS = 1000
+
+
+def _legacy_resource_download(context, data_dict):
+    """ The resource_download auth function before the fast path """
+    context['model'] = context.get('model') or model
+    user = context.get('user')
+    resource = get_resource_object(context, data_dict)
+    dataset = toolkit.get_action('package_show')(
+        {'ignore_auth': True}, {'id': resource.package_id})
+    visibility = resource.extras.get('visibility')
+    user_id = getattr(context.get('auth_user_obj'), 'id', None)
+    if dataset.get('type') == 'deposited-dataset':
+        is_depositor = dataset.get('creator_user_id') == user_id
+        curators = [u['id'] for u in helpers.get_data_curation_users(dataset)]
+        is_curator = user_id in curators
+    else:
+        is_depositor = False
+        is_curator = False
+    if not user or is_depositor or is_curator or not visibility or visibility != 'restricted':
+        try:
+            toolkit.check_access('resource_show', context, data_dict)
+            return {'success': True}
+        except toolkit.NotAuthorized:
+            return {'success': False}
+    if dataset.get('owner_org'):
+        user_orgs = toolkit.get_action('organization_list_for_user')(
+            {'ignore_auth': True}, {'id': user})
+        if any(org['id'] == dataset['owner_org'] for org in user_orgs):
+            return {'success': True}
+    datasets = toolkit.get_action('package_collaborator_list_for_user')(context, {'id': user})
+    return {'success': resource.package_id in [d['package_id'] for d in datasets]}
+
+
+def _authorize_all(auth_function, requests):
+    start = time.perf_counter()
+    results = [
+        auth_function(
+            {'user': user['name'], 'auth_user_obj': model.User.get(user['id'])},
+            {'id': resource['id']},
+        )['success']
+        for user, resource in requests
+    ]
+    return time.perf_counter() - start, results
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestResourceDownloadBenchmark(object):
+
+    def test_authorize_downloads(self):
+        curator = core_factories.User()
+        member = core_factories.User()
+        outsider = core_factories.User()
+        collaborator = core_factories.User()
+        deposit = factories.DataContainer(
+            id='data-deposit',
+            users=[{'name': curator['name'], 'capacity': 'editor'}],
+        )
+        container = factories.DataContainer(
+            users=[{'name': member['name'], 'capacity': 'member'}],
+        )
+
+        resources = []
+        for visibility in ['public', 'restricted']:
+            dataset = factories.Dataset(owner_org=container['id'])
+            resources.append(factories.Resource(
+                package_id=dataset['id'], url_type='upload', visibility=visibility))
+            toolkit.get_action('package_collaborator_create')(
+                {'ignore_auth': True},
+                {'id': dataset['id'], 'user_id': collaborator['id'], 'capacity': 'member'},
+            )
+        deposited = factories.DepositedDataset(
+            owner_org=deposit['id'], owner_org_dest=container['id'])
+        resources.append(factories.Resource(
+            package_id=deposited['id'], url_type='upload', visibility='restricted'))
+
+        users = [curator, member, outsider, collaborator]
+        requests = [
+            (users[i % len(users)], resources[(i // len(users)) % len(resources)])
+            for i in range(DOWNLOADS)
+        ]
+
+        legacy_time, legacy = _authorize_all(_legacy_resource_download, requests)
+        fast_time, fast = _authorize_all(auth.resource_download, requests)
+
+        log.info('Authorizing {} downloads: legacy {:.3f}s, fast path {:.3f}s'.format(
+            DOWNLOADS, legacy_time, fast_time))
+
+        assert fast == legacy
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import mock
 import pytest
 from ckan.lib import search
 import ckan.model as model
@@ -41,6 +42,7 @@ class TestSearchIndexController(object):
         env = {'REMOTE_USER': user['name'].encode('ascii')}
         app.post('/ckan-admin/search_index/rebuild', extra_environ=env, status=403)
 
+    @pytest.mark.ckan_config('ckanext.unhcr.search_index_rebuild_background', False)
     def test_search_index_rebuild_sysadmin(self, app):
         user = core_factories.Sysadmin()
         data_dict = { 'q': '*:*', 'rows': 0,}
@@ -63,6 +65,18 @@ class TestSearchIndexController(object):
         packages = toolkit.get_action('package_search')(context, data_dict)
         assert 1 == packages['count']
 
+    @mock.patch('ckan.plugins.toolkit.enqueue_job')
+    def test_search_index_rebuild_background(self, enqueue_job, app):
+        user = core_factories.Sysadmin()
+        factories.Dataset()
+
+        env = {'REMOTE_USER': user['name'].encode('ascii')}
+        resp = app.post('/ckan-admin/search_index/rebuild', extra_environ=env, status=200)
+
+        assert enqueue_job.call_count == 1
+        assert 'search-index-progress' in resp.body
+        assert 'data-state="running"' in resp.body
+
 
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestGISSearchIndex(object):
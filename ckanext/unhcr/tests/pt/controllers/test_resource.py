@@ -1,4 +1,3 @@
-import datetime
 import mock
 import pytest
 from sqlalchemy import select, and_
@@ -7,6 +6,8 @@ from ckan.plugins import toolkit
 from ckan.tests import helpers as core_helpers
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr.actions import _validate_kobo_filters
+from ckanext.unhcr import scan_status
+from ckanext.unhcr.activity import get_download_buffer
 from ckanext.unhcr.tests import factories, mocks
 
 
@@ -133,25 +134,7 @@ class TestResourceViews(object):
         )
 
     def test_resource_download_blocked(self, app):
-        toolkit.get_action('task_status_update')(
-            {
-                'ignore_auth': True,
-                # task_status_update wants a user object
-                # for no reason, even with 'ignore_auth': True
-                # give it an empty string to keep it happy
-                'user': ''
-            },
-            {
-                'entity_id': self.resource1['id'],
-                'entity_type': 'resource',
-                'task_type': 'clamav',
-                'last_updated': datetime.datetime.utcnow().isoformat(),
-                'state': 'complete',
-                'key': 'clamav',
-                'value': '{"data": {"status_code": 1}}',
-                'error': 'null',
-            }
-        )
+        scan_status.set_verdict(self.resource1['id'], infected=True)
 
         resp = self.make_resource_download_request(
             app, dataset_id='dataset1', resource_id=self.resource1['id'], user='user1',
@@ -178,6 +161,9 @@ class TestResourceViews(object):
             status=200
         )
 
+        # the activity is written by the flusher of the download buffer
+        get_download_buffer().flush()
+
         # after we've downloaded the resource, we should also
         # have also logged a 'download resource' action for this user/resource
         result = model.Session.execute(sql).fetchall()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+from sqlalchemy import select, and_
+from ckan import model
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import activity
+from ckanext.unhcr.tests import factories
+
+
+def _get_download_activities(dataset_id):
+    activity_table = model.meta.metadata.tables['activity']
+    sql = select([activity_table]).where(
+        and_(
+            activity_table.c.activity_type == 'download resource',
+            activity_table.c.object_id == dataset_id,
+        )
+    )
+    return model.Session.execute(sql).fetchall()
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestDownloadActivity(object):
+
+    def setup(self):
+        self.user = core_factories.User()
+        self.container = factories.DataContainer()
+        self.dataset = factories.Dataset(owner_org=self.container['id'])
+        self.resource = factories.Resource(package_id=self.dataset['id'], url_type='upload')
+        self.user_obj = model.User.get(self.user['id'])
+        self.resource_obj = model.Resource.get(self.resource['id'])
+
+    def test_record_download_activity_buffered(self):
+        buffer = activity.DownloadActivityBuffer(max_size=10, batch_size=10, flush_interval=60)
+        with mock.patch.object(activity, 'get_download_buffer', return_value=buffer):
+            activity.record_download_activity(self.user_obj, self.resource_obj)
+            activity.record_download_activity(self.user_obj, self.resource_obj)
+
+        assert buffer.stats()['queued'] == 2
+        assert len(_get_download_activities(self.dataset['id'])) == 0
+
+        assert buffer.flush() == 2
+
+        activities = _get_download_activities(self.dataset['id'])
+        assert len(activities) == 2
+        for row in activities:
+            assert row['user_id'] == self.user['id']
+            assert row['data']['id'] == self.resource['id']
+            assert row['data']['name'] == self.resource['name']
+        assert buffer.stats() == {
+            'queued': 0, 'retrying': 0, 'written': 2, 'dropped': 0, 'failed': 0
+        }
+        buffer.stop()
+
+    @pytest.mark.ckan_config('ckanext.unhcr.download_activity_buffer', False)
+    def test_record_download_activity_unbuffered(self):
+        activity.record_download_activity(self.user_obj, self.resource_obj)
+
+        assert len(_get_download_activities(self.dataset['id'])) == 1
+
+    def test_flush_writes_batches_with_one_insert_each(self):
+        buffer = activity.DownloadActivityBuffer(max_size=10, batch_size=2, flush_interval=60)
+        # no flusher thread, so that the batches are written by this flush
+        with mock.patch.object(activity, 'get_download_buffer', return_value=buffer), \
+                mock.patch.object(buffer, '_ensure_thread'):
+            for i in range(5):
+                activity.record_download_activity(self.user_obj, self.resource_obj)
+
+        with mock.patch.object(
+            activity, 'insert_download_activities', wraps=activity.insert_download_activities
+        ) as insert:
+            buffer.flush()
+
+        assert [len(call[0][0]) for call in insert.call_args_list] == [2, 2, 1]
+        assert len(_get_download_activities(self.dataset['id'])) == 5
+        buffer.stop()
+
+    def test_dropped_events(self):
+        buffer = activity.DownloadActivityBuffer(max_size=2, batch_size=10, flush_interval=60)
+        with mock.patch.object(activity, 'get_download_buffer', return_value=buffer):
+            for i in range(5):
+                activity.record_download_activity(self.user_obj, self.resource_obj)
+
+        assert buffer.stats()['queued'] == 2
+        assert buffer.stats()['dropped'] == 3
+        buffer.stop()
+
+    def test_stop_flushes(self):
+        buffer = activity.DownloadActivityBuffer(max_size=10, batch_size=10, flush_interval=60)
+        with mock.patch.object(activity, 'get_download_buffer', return_value=buffer):
+            activity.record_download_activity(self.user_obj, self.resource_obj)
+
+        buffer.stop()
+
+        assert len(_get_download_activities(self.dataset['id'])) == 1
+        assert buffer.stats()['written'] == 1
+
+    def test_failed_batch_retried_on_next_flush(self):
+        buffer = activity.DownloadActivityBuffer(
+            max_size=10, batch_size=10, flush_interval=60, max_retries=2
+        )
+        with mock.patch.object(activity, 'get_download_buffer', return_value=buffer), \
+                mock.patch.object(buffer, '_ensure_thread'):
+            activity.record_download_activity(self.user_obj, self.resource_obj)
+            activity.record_download_activity(self.user_obj, self.resource_obj)
+
+        with mock.patch.object(
+            activity, 'insert_download_activities', side_effect=Exception('Database restarted')
+        ):
+            assert buffer.flush() == 0
+        assert buffer.stats()['retrying'] == 2
+        assert buffer.stats()['failed'] == 0
+        assert len(_get_download_activities(self.dataset['id'])) == 0
+
+        assert buffer.flush() == 2
+        assert buffer.stats()['retrying'] == 0
+        assert buffer.stats()['failed'] == 0
+        assert len(_get_download_activities(self.dataset['id'])) == 2
+        buffer.stop()
+
+    def test_failed_batch_written_row_by_row(self):
+        buffer = activity.DownloadActivityBuffer(
+            max_size=10, batch_size=10, flush_interval=60, max_retries=0
+        )
+        with mock.patch.object(activity, 'get_download_buffer', return_value=buffer), \
+                mock.patch.object(buffer, '_ensure_thread'):
+            for i in range(3):
+                activity.record_download_activity(self.user_obj, self.resource_obj)
+        bad_event_id = list(buffer._queue.queue)[1]['id']
+
+        insert_download_activities = activity.insert_download_activities
+
+        def insert(events):
+            if bad_event_id in [event['id'] for event in events]:
+                raise Exception('Bad event')
+            insert_download_activities(events)
+
+        with mock.patch.object(activity, 'insert_download_activities', side_effect=insert):
+            assert buffer.flush() == 2
+
+        assert buffer.stats()['retrying'] == 0
+        assert buffer.stats()['failed'] == 1
+        assert len(_get_download_activities(self.dataset['id'])) == 2
+        buffer.stop()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+import time
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import arcgis
+from ckanext.unhcr.cache import LRUCache, TieredCache, get_redis
+from ckanext.unhcr.models import get_geography_cache
+from ckanext.unhcr.tests import factories
+
+
+class TestLRUCache(object):
+
+    def test_eviction(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        # "b" was the least recently used
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+
+    def test_counters(self):
+        cache = LRUCache(max_size=10)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        assert cache.hits == 2
+        assert cache.misses == 1
+
+    def test_ttl(self):
+        cache = LRUCache(max_size=10)
+        cache.set('a', 1, ttl=60)
+        cache.set('b', 2)
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            assert cache.get('a') is None
+            assert cache.get('b') == 2
+
+
+class TestTieredCache(object):
+
+    def test_get_set(self):
+        cache = TieredCache('test-tiered', max_size=10)
+        cache.invalidate()
+        assert cache.get('key') is None
+        cache.set('key', {'value': 1})
+        assert cache.get('key') == {'value': 1}
+        assert cache.stats()['lru_hits'] == 1
+
+    def test_redis_tier_shared(self):
+        cache1 = TieredCache('test-tiered', max_size=10)
+        cache2 = TieredCache('test-tiered', max_size=10)
+        cache1.invalidate()
+        cache1.set('key', {'value': 1})
+        assert cache2.get('key') == {'value': 1}
+        assert cache2.stats()['redis_hits'] == 1
+
+    def test_lru_tier_expires(self):
+        cache1 = TieredCache('test-tiered', max_size=10, ttl=60)
+        cache1.invalidate()
+        cache1.set('key', {'value': 1})
+        # the Redis entry is gone (e.g. expired), the LRU one expires too
+        get_redis().delete(cache1._redis_key('key', cache1._generation))
+        assert cache1.get('key') == {'value': 1}
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            assert cache1.get('key') is None
+
+    def test_invalidate(self):
+        cache1 = TieredCache('test-tiered', max_size=10, generation_check_seconds=0)
+        cache2 = TieredCache('test-tiered', max_size=10, generation_check_seconds=0)
+        cache1.set('key', {'value': 1})
+        assert cache2.get('key') == {'value': 1}
+        cache1.invalidate()
+        assert cache1.get('key') is None
+        assert cache2.get('key') is None
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestGeographyCache(object):
+
+    def test_dictize_uses_cache(self):
+        geog = factories.Geography()
+        cache = get_geography_cache()
+        cache.invalidate()
+        geog.dictize()
+        hits = cache.stats()['lru_hits']
+        geog.dictize()
+        assert cache.stats()['lru_hits'] == hits + 1
+
+    @mock.patch('ckanext.unhcr.arcgis._import_geographies')
+    def test_import_geographies_invalidates(self, mock_import):
+        cache = get_geography_cache()
+        cache.set('some-pcode', {'geography': {}, 'parents': []})
+        arcgis.import_geographies()
+        assert cache.get('some-pcode') is None
+
+    def test_geography_cache_stats_sysadmin_only(self):
+        sysadmin = core_factories.Sysadmin()
+        user = core_factories.User()
+        stats = toolkit.get_action('geography_cache_stats')({'user': sysadmin['name']}, {})
+        assert stats['namespace'] == 'geography'
+        with pytest.raises(toolkit.NotAuthorized):
+            toolkit.get_action('geography_cache_stats')({'user': user['name']}, {})
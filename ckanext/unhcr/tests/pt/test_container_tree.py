@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import container_tree, helpers
+from ckanext.unhcr.tests import factories
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestContainerTree(object):
+
+    def setup(self):
+        container_tree.invalidate()
+        self.deposit = factories.DataContainer(id='data-deposit', name='data-deposit')
+        self.africa = factories.DataContainer(name='africa', title='Africa')
+        self.europe = factories.DataContainer(name='europe', title='Europe')
+        self.kenya = factories.DataContainer(
+            name='kenya', title='Kenya', groups=[{'name': 'africa'}]
+        )
+        self.nairobi = factories.DataContainer(
+            name='nairobi', title='Nairobi', groups=[{'name': 'kenya'}]
+        )
+
+    def test_descendant_ids(self):
+        assert sorted(container_tree.get_descendant_ids(self.africa['id'])) == sorted(
+            [self.kenya['id'], self.nairobi['id']]
+        )
+        assert container_tree.get_descendant_ids(self.kenya['id']) == [self.nairobi['id']]
+        assert container_tree.get_descendant_ids(self.europe['id']) == []
+        assert container_tree.get_descendant_ids('not-a-container') == []
+
+    def test_index_is_cached(self):
+        container_tree.get_descendants_index()
+        with mock.patch.object(container_tree, '_build_descendants_index') as build:
+            container_tree.get_descendants_index()
+        assert build.call_count == 0
+
+    def test_organization_update_invalidates(self):
+        container_tree.get_descendants_index()
+        toolkit.get_action('organization_patch')(
+            {'ignore_auth': True, 'user': core_factories.Sysadmin()['name']},
+            {'id': self.nairobi['id'], 'groups': [{'name': 'europe'}]}
+        )
+        assert container_tree.get_descendant_ids(self.europe['id']) == [self.nairobi['id']]
+        assert container_tree.get_descendant_ids(self.kenya['id']) == []
+
+    def test_organization_create_invalidates(self):
+        container_tree.get_descendants_index()
+        mombasa = factories.DataContainer(name='mombasa', groups=[{'name': 'kenya'}])
+        assert mombasa['id'] in container_tree.get_descendant_ids(self.africa['id'])
+
+    def test_organization_purge_invalidates(self):
+        html = helpers.render_tree()
+        assert 'node_nairobi' in html
+        # rejecting a data container request purges it
+        toolkit.get_action('organization_purge')({'ignore_auth': True}, {'id': self.nairobi['id']})
+        assert container_tree.get_descendant_ids(self.kenya['id']) == []
+        assert 'node_nairobi' not in helpers.render_tree()
+
+    def test_render_tree(self):
+        html = helpers.render_tree()
+        assert html.startswith('<ul class="hierarchy-tree-top">')
+        assert (
+            '<li id="node_africa"><a href="/data-container/africa">Africa</a>'
+            '<ul class="hierarchy-tree"><li id="node_kenya">'
+        ) in html
+        assert 'node_data-deposit' not in html
+
+    def test_render_tree_is_cached(self):
+        html = helpers.render_tree()
+        with mock.patch('ckan.plugins.toolkit.get_action') as get_action:
+            assert helpers.render_tree() == html
+        assert get_action.call_count == 0
+
+        factories.DataContainer(name='spain', title='Spain', groups=[{'name': 'europe'}])
+        assert 'node_spain' in helpers.render_tree()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+from ckan import model
+import ckan.plugins as plugins
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import display_names
+from ckanext.unhcr.display_names import DisplayNameResolver
+from ckanext.unhcr.tests import factories
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestDisplayNameResolver(object):
+
+    def setup(self):
+        self.curator = core_factories.User(fullname='Curator Name')
+        self.depositor = core_factories.User(fullname='')
+        self.deposit = factories.DataContainer(id='data-deposit', name='data-deposit')
+        self.target = factories.DataContainer(title='Target Container')
+        self.dataset = factories.DepositedDataset(
+            owner_org=self.deposit['id'],
+            owner_org_dest=self.target['id'],
+            curator_id=self.curator['id'],
+        )
+
+    def test_user(self):
+        names = DisplayNameResolver()
+        assert names.user(self.curator['id']) == 'Curator Name'
+        assert names.user(self.curator['name']) == 'Curator Name'
+        # fall back to the name, like User.display_name
+        assert names.user(self.depositor['id']) == self.depositor['name']
+        assert names.user('not-a-user') is None
+
+    def test_organization(self):
+        names = DisplayNameResolver()
+        assert names.organization(self.target['id']) == 'Target Container'
+        assert names.organization(self.target['name']) == 'Target Container'
+        assert names.organization('not-an-org') is None
+
+    def test_memoized(self):
+        names = DisplayNameResolver()
+        names.prefetch(user_ids=[self.curator['id'], 'not-a-user'])
+        with mock.patch.object(model.Session, 'query') as query:
+            assert names.user(self.curator['id']) == 'Curator Name'
+            assert names.user('not-a-user') is None
+        assert query.call_count == 0
+
+    def test_prefetched_maps(self):
+        names = DisplayNameResolver(users={'some-id': 'Some User'}, orgs={'org-id': 'Some Org'})
+        with mock.patch.object(model.Session, 'query') as query:
+            assert names.user('some-id') == 'Some User'
+            assert names.organization('org-id') == 'Some Org'
+        assert query.call_count == 0
+
+    def test_get_deposit_related_ids(self):
+        user_ids, org_ids = display_names.get_deposit_related_ids([self.dataset['id']])
+        assert user_ids == {self.curator['id'], self.dataset['creator_user_id']}
+        assert org_ids == {self.target['id']}
+
+    def test_indexing_batch(self):
+        with display_names.indexing_batch(users={'some-id': 'Some User'}) as names:
+            assert display_names.get_resolver() is names
+        assert display_names.get_resolver() is not names
+
+    def test_indexing_batch_download_counts(self):
+        assert display_names.get_batch_download_count('some-id') is None
+        with display_names.indexing_batch(download_counts={'some-id': 3}):
+            assert display_names.get_batch_download_count('some-id') == 3
+            assert display_names.get_batch_download_count('other-id') is None
+        assert display_names.get_batch_download_count('some-id') is None
+
+    def test_before_index(self):
+        plugin = plugins.get_plugin('unhcr')
+        pkg_dict = {
+            'type': 'deposited-dataset',
+            'curator_id': self.curator['id'],
+            'creator_user_id': self.depositor['id'],
+            'owner_org_dest': self.target['id'],
+        }
+        pkg_dict = plugin.before_index(pkg_dict)
+        assert pkg_dict['curator_display_name'] == 'Curator Name'
+        assert pkg_dict['depositor_display_name'] == self.depositor['name']
+        assert pkg_dict['owner_org_dest_display_name'] == 'Target Container'
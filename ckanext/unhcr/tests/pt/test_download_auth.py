@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+from ckan import model
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import auth, download_auth
+from ckanext.unhcr.tests import factories
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestDownloadAuth(object):
+
+    def setup(self):
+        self.depadmin = core_factories.User()
+        self.curator = core_factories.User()
+        self.target_admin = core_factories.User()
+        self.deposit = factories.DataContainer(
+            id='data-deposit',
+            users=[
+                {'name': self.depadmin['name'], 'capacity': 'admin'},
+                {'name': self.curator['name'], 'capacity': 'editor'},
+            ]
+        )
+        self.target = factories.DataContainer(
+            users=[{'name': self.target_admin['name'], 'capacity': 'admin'}]
+        )
+
+    def test_curator_ids(self):
+        assert download_auth.get_curator_ids(self.deposit['id'], self.target['id']) == {
+            self.depadmin['id'], self.curator['id'], self.target_admin['id'],
+        }
+        assert download_auth.get_curator_ids(self.deposit['id'], 'unknown') == {
+            self.depadmin['id'], self.curator['id'],
+        }
+
+    def test_curator_ids_cached(self):
+        download_auth.get_curator_ids(self.deposit['id'], self.target['id'])
+        with mock.patch.object(model.Session, 'query') as query:
+            download_auth.get_curator_ids(self.deposit['id'], self.target['id'])
+        assert query.call_count == 0
+
+    def test_curator_ids_invalidated_on_membership_change(self):
+        download_auth.get_curator_ids(self.deposit['id'], self.target['id'])
+        new_admin = core_factories.User()
+        toolkit.get_action('organization_member_create')(
+            {'ignore_auth': True},
+            {'id': self.target['id'], 'username': new_admin['name'], 'role': 'admin', 'not_notify': True}
+        )
+        assert new_admin['id'] in download_auth.get_curator_ids(self.deposit['id'], self.target['id'])
+
+        toolkit.get_action('organization_member_delete')(
+            {'ignore_auth': True},
+            {'id': self.target['id'], 'user_id': new_admin['id'], 'not_notify': True}
+        )
+        assert new_admin['id'] not in download_auth.get_curator_ids(self.deposit['id'], self.target['id'])
+
+    def test_curator_ids_invalidated_on_plain_member_change(self):
+        download_auth.get_curator_ids(self.deposit['id'], self.target['id'])
+        new_curator = core_factories.User()
+        toolkit.get_action('member_create')(
+            {'ignore_auth': True},
+            {'id': self.deposit['id'], 'object': new_curator['id'], 'object_type': 'user', 'capacity': 'editor'}
+        )
+        assert new_curator['id'] in download_auth.get_curator_ids(self.deposit['id'], self.target['id'])
+
+        toolkit.get_action('member_delete')(
+            {'ignore_auth': True},
+            {'id': self.deposit['id'], 'object': self.curator['id'], 'object_type': 'user'}
+        )
+        assert self.curator['id'] not in download_auth.get_curator_ids(self.deposit['id'], self.target['id'])
+
+    def test_is_member_of_owner_org_deleted_container(self):
+        user_obj = model.User.get(self.target_admin['id'])
+        assert download_auth.is_member_of_owner_org(user_obj, self.target['id'])
+
+        model.Group.get(self.target['id']).state = 'deleted'
+        model.Session.commit()
+
+        assert not download_auth.is_member_of_owner_org(user_obj, self.target['id'])
+
+    def test_restricted_resource_parent_container_admin(self):
+        parent_admin = core_factories.User()
+        parent = factories.DataContainer(
+            name='parent',
+            users=[{'name': parent_admin['name'], 'capacity': 'admin'}]
+        )
+        child = factories.DataContainer(groups=[{'name': parent['name']}])
+        dataset = factories.Dataset(owner_org=child['id'])
+        resource = factories.Resource(
+            package_id=dataset['id'], url_type='upload', visibility='restricted'
+        )
+        other_user = core_factories.User()
+
+        assert auth.resource_download({'user': parent_admin['name']}, resource) == {'success': True}
+        assert auth.resource_download({'user': other_user['name']}, resource) == {'success': False}
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import mock
+import pytest
+from ckan import model
+import ckan.plugins as plugins
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import display_names, download_stats
+from ckanext.unhcr.activity import create_download_activity, insert_download_activities
+from ckanext.unhcr.models import DownloadStat
+from ckanext.unhcr.tests import factories
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestDownloadStats(object):
+
+    def setup(self):
+        self.user1 = core_factories.User()
+        self.user2 = core_factories.User()
+        self.container = factories.DataContainer()
+        self.dataset1 = factories.Dataset(owner_org=self.container['id'])
+        self.dataset2 = factories.Dataset(owner_org=self.container['id'])
+        self.resource1 = factories.Resource(package_id=self.dataset1['id'], url_type='upload')
+        self.resource2 = factories.Resource(package_id=self.dataset2['id'], url_type='upload')
+
+    def _download(self, user, resource):
+        create_download_activity({'user': user['name']}, resource['id'])
+
+    def test_counters_updated_on_download(self):
+        self._download(self.user1, self.resource1)
+        self._download(self.user1, self.resource1)
+        self._download(self.user2, self.resource1)
+        self._download(self.user2, self.resource2)
+
+        rows = model.Session.query(DownloadStat).filter(
+            DownloadStat.package_id == self.dataset1['id']
+        ).all()
+        assert {(row.user_id, row.count) for row in rows} == {
+            (self.user1['id'], 2), (self.user2['id'], 1)
+        }
+        assert download_stats.get_download_counts(
+            [self.dataset1['id'], self.dataset2['id'], 'unknown']
+        ) == {self.dataset1['id']: 3, self.dataset2['id']: 1, 'unknown': 0}
+
+    def test_counters_updated_on_bulk_insert(self):
+        now = datetime.datetime.utcnow()
+        events = [
+            {
+                'id': 'activity-{}'.format(i),
+                'timestamp': now - datetime.timedelta(days=i % 2),
+                'user_id': self.user1['id'],
+                'object_id': self.dataset1['id'],
+                'activity_type': 'download resource',
+                'data': {'id': self.resource1['id']},
+            }
+            for i in range(5)
+        ]
+        insert_download_activities(events)
+
+        rows = model.Session.query(DownloadStat).order_by(DownloadStat.day).all()
+        assert [(row.day, row.count) for row in rows] == [
+            ((now - datetime.timedelta(days=1)).date(), 2),
+            (now.date(), 3),
+        ]
+
+    def test_rebuild(self):
+        self._download(self.user1, self.resource1)
+        self._download(self.user2, self.resource1)
+        self._download(self.user2, self.resource2)
+        expected = {
+            (row.package_id, row.user_id, row.day, row.count)
+            for row in model.Session.query(DownloadStat).all()
+        }
+        model.Session.query(DownloadStat).delete()
+        model.Session.commit()
+
+        assert download_stats.rebuild() == 3
+
+        model.Session.expire_all()
+        assert {
+            (row.package_id, row.user_id, row.day, row.count)
+            for row in model.Session.query(DownloadStat).all()
+        } == expected
+
+    def test_top_datasets_and_users(self):
+        deposit = factories.DataContainer(id='data-deposit', name='data-deposit')
+        deposited = factories.DepositedDataset(owner_org=deposit['id'], owner_org_dest=self.container['id'])
+        deposited_resource = factories.Resource(package_id=deposited['id'], url_type='upload')
+        self._download(self.user1, self.resource1)
+        self._download(self.user2, self.resource1)
+        self._download(self.user2, self.resource2)
+        sysadmin = core_factories.Sysadmin()
+        self._download(sysadmin, deposited_resource)
+        self._download(sysadmin, deposited_resource)
+
+        datasets = download_stats.get_top_datasets()
+        assert [(row['id'], row['count']) for row in datasets] == [
+            (self.dataset1['id'], 2), (self.dataset2['id'], 1)
+        ]
+
+        users = download_stats.get_top_users()
+        assert [(row['id'], row['count']) for row in users] == [
+            (self.user2['id'], 2), (self.user1['id'], 1)
+        ]
+        users = download_stats.get_top_users(exclude_user_names=[self.user2['name']])
+        assert [row['id'] for row in users] == [self.user1['id']]
+
+    def test_download_count_indexed(self):
+        self._download(self.user1, self.resource1)
+        self._download(self.user2, self.resource1)
+        toolkit.get_action('package_patch')(
+            {'ignore_auth': True, 'user': self.user1['name']},
+            {'id': self.dataset1['id'], 'notes': 'reindex'}
+        )
+
+        result = toolkit.get_action('package_search')(
+            {'ignore_auth': True}, {'fq': 'downloads:2', 'include_private': True}
+        )
+        assert [pkg['id'] for pkg in result['results']] == [self.dataset1['id']]
+
+    def test_download_count_prefetched_in_indexing_batch(self):
+        self._download(self.user1, self.resource1)
+        self._download(self.user2, self.resource1)
+        plugin = plugins.get_plugin('unhcr')
+        counts = download_stats.get_download_counts([self.dataset1['id']])
+        assert counts == {self.dataset1['id']: 2}
+
+        with mock.patch.object(download_stats, 'get_download_count') as get_download_count:
+            with display_names.indexing_batch(download_counts=counts):
+                pkg_dict = plugin.before_index({'id': self.dataset1['id'], 'type': 'dataset'})
+            assert pkg_dict['downloads'] == 2
+            assert not get_download_count.called
+
+        # Outside a batch the count is read from the database
+        pkg_dict = plugin.before_index({'id': self.dataset1['id'], 'type': 'dataset'})
+        assert pkg_dict['downloads'] == 2
@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import os
+import mock
 import pytest
 from ckan import model
 from ckan.plugins import toolkit
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr.models import AccessRequest
 from ckanext.unhcr.tests import factories
-from ckanext.unhcr import helpers
+from ckanext.unhcr import helpers, pending_requests
 from ckanext.unhcr.activity import create_curation_activity
 from ckanext.unhcr.mailer import notify_renewal_request
 
@@ -342,6 +343,69 @@ class TestPendingRequests(object):
         assert count == 0
 
 
+    def test_get_pending_requests_total_cached(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        context = {'model': model, 'user': 'sysadmin'}
+        assert helpers.get_pending_requests_total(context=context) == 0
+
+        with mock.patch.object(helpers, '_count_pending_requests') as count:
+            assert helpers.get_pending_requests_total(context=context) == 0
+        assert count.call_count == 0
+
+    def test_get_pending_requests_total_invalidated(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        container = factories.DataContainer()
+        requesting_user = core_factories.User()
+        context = {'model': model, 'user': 'sysadmin'}
+        assert helpers.get_pending_requests_total(context=context) == 0
+
+        # new access request
+        request = toolkit.get_action('access_request_create')(
+            {'model': model, 'user': requesting_user['name']},
+            {
+                'object_id': container['id'],
+                'object_type': 'organization',
+                'message': 'Let me in',
+                'role': 'member',
+            }
+        )
+        assert helpers.get_pending_requests_total(context=context) == 1
+
+        # new data container waiting for approval
+        factories.DataContainer(name='pending-container', state='approval_needed')
+        assert helpers.get_pending_requests_total(context=context) == 2
+
+        # request rejected
+        toolkit.get_action('access_request_update')(
+            {'model': model, 'user': 'sysadmin'},
+            {'id': request['id'], 'status': 'rejected'}
+        )
+        assert helpers.get_pending_requests_total(context=context) == 1
+
+        # data container request rejected (the container is purged)
+        toolkit.get_action('organization_purge')(
+            {'model': model, 'user': 'sysadmin'},
+            {'id': 'pending-container'}
+        )
+        assert helpers.get_pending_requests_total(context=context) == 0
+
+    @pytest.mark.ckan_config('ckanext.unhcr.pending_requests_cache_seconds', 0)
+    def test_get_pending_requests_total_cache_disabled(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        context = {'model': model, 'user': 'sysadmin'}
+        # created again with the TTL of this test
+        pending_requests._pending_requests_cache = None
+        try:
+            with mock.patch.object(
+                helpers, '_count_pending_requests', return_value=0
+            ) as count:
+                helpers.get_pending_requests_total(context=context)
+                helpers.get_pending_requests_total(context=context)
+            assert count.call_count == 2
+        finally:
+            pending_requests._pending_requests_cache = None
+
+
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestDataDeposit(object):
 
@@ -911,6 +975,28 @@ class TestFunctions(object):
         assert self.sysadmin3['id'] in [s.id for s in sysadmins]
 
 
+class TestSchemaLabels(object):
+
+    def test_get_choice_label(self):
+        assert helpers.get_choice_label('process_status', 'raw') == 'Raw-Uncleaned'
+        assert helpers.get_choice_label('process_status', 'not-a-choice') == 'not-a-choice'
+        assert helpers.get_choice_label('not-a-field', 'raw') is None
+
+    def test_get_field_label(self):
+        assert helpers.get_field_label('process_status') == 'Dataset Process Status'
+        assert helpers.get_field_label('not-a-field') is None
+
+    def test_get_schema_labels_cached(self):
+        labels = helpers.get_schema_labels('dataset')
+        assert helpers.get_schema_labels('dataset') is labels
+        assert labels['dataset_choices'][('identifiability', 'anonymized_public')]
+
+    def test_get_schema_labels_rebuilt_on_schema_change(self):
+        labels = helpers.get_schema_labels('dataset')
+        helpers._schema_labels_cache['dataset'] = (object(), labels)
+        assert helpers.get_schema_labels('dataset') is not labels
+
+
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestRenewalMailer(object):
 
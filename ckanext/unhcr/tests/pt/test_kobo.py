@@ -1,11 +1,22 @@
 import datetime
+import hashlib
 import json
 import mock
+import os
 import pytest
+import responses
 import tempfile
+import time
+from urllib.parse import quote
+from requests.exceptions import ConnectionError
 from ckan import model
 from ckan.plugins import toolkit
-from ckanext.unhcr.jobs import download_kobo_file
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr.cache import get_redis
+from ckanext.unhcr.jobs import download_kobo_file, poll_kobo_exports
+from ckanext.unhcr.kobo import export_poller, rate_limit
+from ckanext.unhcr.kobo.api import KoBoAPI, KoBoSurvey, get_session
+from ckanext.unhcr.kobo.exceptions import KoboApiError
 from ckanext.unhcr.models import DEFAULT_GEOGRAPHY_CODE
 from ckanext.unhcr.tests import factories, mocks
 
@@ -350,6 +361,7 @@ class TestKoBoJobs(object):
     @mock.patch('ckanext.unhcr.kobo.api.KoBoSurvey.get_total_submissions')
     def setup(self, get_total_submissions, create_kobo_resources):
         get_total_submissions.return_value = 5  # any, > 0
+        get_redis().delete(export_poller.PENDING_EXPORTS_KEY)
         self.kobo_user = factories.InternalKoBoUser()
         self.internal_user = factories.InternalUser()
         self.data_container = factories.DataContainer(
@@ -451,14 +463,19 @@ class TestKoBoJobs(object):
         }
         update_kobo_details.return_value = {}
 
+        before = time.time()
         download_kobo_file(self.kobo_resource['id'])
 
         # test we update the download_attempts counter
         assert update_kobo_details.call_args_list[0][0][2]['kobo_download_attempts'] == 2
 
-        # assert we call again to download_kobo_file function
+        # assert the export is checked again later, without waiting in this job
+        next_check = get_redis().zscore(export_poller.PENDING_EXPORTS_KEY, self.kobo_resource['id'])
+        assert next_check >= before + 60
+        assert export_poller.get_stats()['in_flight'] == 1
+        assert export_poller.get_stats()['due'] == 0
         jobs_called = [fn[0][0].__name__ for fn in enqueue_job.call_args_list]
-        assert 'download_kobo_file' in jobs_called
+        assert 'download_kobo_file' not in jobs_called
 
     @mock.patch('ckanext.unhcr.kobo.api.KoBoSurvey.get_export')
     @mock.patch('ckanext.unhcr.kobo.kobo_dataset.KoboDataset.update_kobo_details')
@@ -483,3 +500,336 @@ class TestKoBoJobs(object):
         # assert we DON'T call again to download_kobo_file function
         jobs_called = [fn[0][0].__name__ for fn in enqueue_job.call_args_list]
         assert 'download_kobo_file' not in jobs_called
+        assert export_poller.get_stats()['in_flight'] == 0
+
+    @pytest.mark.ckan_config('ckanext.unhcr.kobo_export_max_attempts', '10')
+    @mock.patch('ckanext.unhcr.kobo.api.KoBoSurvey.get_export')
+    @mock.patch('ckanext.unhcr.kobo.kobo_dataset.KoboDataset.update_kobo_details')
+    @mock.patch('ckan.plugins.toolkit.enqueue_job')
+    @mock.patch('ckanext.unhcr.kobo.api.KoBoSurvey.get_total_submissions')
+    def test_max_attempts_download_kobo_file(self, get_total_submissions, enqueue_job, update_kobo_details, get_export):
+        get_total_submissions.return_value = 5  # any, > 0
+        get_export.return_value = {'uid': 'new_export_uid', 'status': 'processing'}
+        update_kobo_details.return_value = {}
+
+        download_kobo_file(self.kobo_resource_last_attempt['id'])
+
+        assert update_kobo_details.call_args_list[0][0][2]['kobo_download_attempts'] == 6
+        assert export_poller.get_stats()['in_flight'] == 1
+
+    @pytest.mark.ckan_config('ckanext.unhcr.kobo_export_poll_seconds', '0')
+    @mock.patch('ckan.plugins.toolkit.enqueue_job')
+    def test_poll_kobo_exports(self, enqueue_job):
+        export_poller.schedule_check(self.kobo_resource['id'], 1)
+        get_redis().zadd(export_poller.PENDING_EXPORTS_KEY, {'not-due': time.time() + 3600})
+
+        assert poll_kobo_exports() == 1
+
+        assert enqueue_job.call_args_list[0][0][0].__name__ == 'download_kobo_file'
+        assert enqueue_job.call_args_list[0][0][1] == [self.kobo_resource['id']]
+        assert export_poller.get_stats()['in_flight'] == 1
+        # already claimed
+        assert poll_kobo_exports() == 0
+
+    def test_kobo_export_poll_stats_sysadmin_only(self):
+        export_poller.schedule_check(self.kobo_resource['id'], 1)
+        sysadmin = core_factories.Sysadmin()
+        stats = toolkit.get_action('kobo_export_poll_stats')({'user': sysadmin['name']}, {})
+        assert stats['in_flight'] == 1
+        assert stats['due'] == 0
+        with pytest.raises(toolkit.NotAuthorized):
+            toolkit.get_action('kobo_export_poll_stats')({'user': self.kobo_user['name']}, {})
+
+    def test_export_poll_delay(self):
+        assert [export_poller.get_delay(attempts) for attempts in range(1, 7)] == [30, 60, 120, 240, 480, 600]
+
+
+class TestKoBoDownloads(object):
+
+    def setup(self):
+        kobo_api = KoBoAPI('token', 'https://kobo.unhcr.org')
+        # always hit the mocked KoBo API
+        kobo_api.cache = None
+        self.survey = KoBoSurvey('asset-id', kobo_api)
+        self.destination = tempfile.mkdtemp()
+
+    @responses.activate
+    def test_download_data_streamed(self):
+        content = b'a,b\n' + b'1,2\n' * 100000
+        url = 'https://kobo.unhcr.org/exports/export-id.csv'
+        responses.add(responses.GET, url, body=content, status=200)
+
+        with mock.patch('ckanext.unhcr.kobo.api.DOWNLOAD_CHUNK_SIZE', 1024):
+            file_path = self.survey.download_data(self.destination, 'resource', 'csv', url)
+
+        assert file_path == os.path.join(self.destination, 'resource__asset-id_data.csv')
+        assert open(file_path, 'rb').read() == content
+        assert self.survey.last_download == {
+            'size': len(content),
+            'sha256': hashlib.sha256(content).hexdigest(),
+        }
+        assert responses.calls[0].request.headers['Authorization'] == 'Token token'
+        # only the final file is left
+        assert os.listdir(self.destination) == ['resource__asset-id_data.csv']
+
+    @responses.activate
+    def test_download_questionnaire(self):
+        responses.add(responses.GET, 'https://kobo.unhcr.org/api/v2/assets/asset-id.xls', body=b'xls', status=200)
+
+        file_path = self.survey.download_questionnaire(self.destination)
+
+        assert open(file_path, 'rb').read() == b'xls'
+        assert self.survey.last_download['size'] == 3
+
+    @responses.activate
+    def test_download_error_keeps_previous_file(self):
+        url = 'https://kobo.unhcr.org/exports/export-id.xls'
+        responses.add(responses.GET, url, status=500)
+        file_path = os.path.join(self.destination, 'resource__asset-id_data.xls')
+        open(file_path, 'wb').write(b'previous')
+
+        with pytest.raises(KoboApiError):
+            self.survey.download_data(self.destination, 'resource', 'xls', url)
+
+        assert open(file_path, 'rb').read() == b'previous'
+        assert os.listdir(self.destination) == ['resource__asset-id_data.xls']
+
+    def _add_data_pages(self, pages, query=None):
+        """ Mock the data.json pages of the survey (linked with `next`) """
+        base_url = 'https://kobo.unhcr.org/api/v2/assets/asset-id/data.json'
+        urls = ['{}?query={}'.format(base_url, quote(json.dumps(query))) if query else base_url]
+        urls += ['{}?page={}&delta={}'.format(base_url, number, bool(query)) for number in range(1, len(pages))]
+        for number, results in enumerate(pages):
+            next_url = urls[number + 1] if number + 1 < len(pages) else None
+            responses.add(
+                responses.GET, urls[number],
+                json={'results': results, 'next': next_url},
+                match_querystring=True,
+            )
+
+    def _submission(self, day):
+        return {'_id': day, '_submission_time': '2021-01-{:02d}T10:00:00'.format(day), 'q1': 'answer'}
+
+    @responses.activate
+    def test_download_json_data(self):
+        submissions = [self._submission(day) for day in [3, 1, 7, 5]]
+        self._add_data_pages([submissions[:2], submissions[2:]])
+
+        file_path = self.survey.download_json_data(self.destination, 'resource')
+
+        assert open(file_path).read() == json.dumps(submissions, indent=4)
+        assert self.survey.last_download['submissions'] == 4
+        assert self.survey.last_download['first_submission_time'] == '2021-01-01T10:00:00'
+        assert self.survey.last_download['last_submission_time'] == '2021-01-07T10:00:00'
+        assert self.survey.last_download['sha256'] == hashlib.sha256(open(file_path, 'rb').read()).hexdigest()
+        # no need to download the data again
+        assert self.survey.get_submission_times() == ('2021-01-01T10:00:00', '2021-01-07T10:00:00')
+        assert len(responses.calls) == 2
+
+    @responses.activate
+    def test_download_json_data_delta(self):
+        submissions = [self._submission(day) for day in [1, 2]]
+        new_submissions = [self._submission(day) for day in [3, 4]]
+        self._add_data_pages([submissions])
+        since = '2021-01-02T10:00:00'
+        self._add_data_pages([new_submissions], query={'_submission_time': {'$gt': since}})
+
+        file_path = self.survey.download_json_data(self.destination, 'resource')
+        saved_file_path = self.survey.save_json_data(file_path)
+        assert saved_file_path == os.path.join(self.destination, 'resource__asset-id_data.json')
+        file_path = self.survey.download_json_data(self.destination, 'resource', since=since)
+
+        assert json.load(open(file_path)) == submissions + new_submissions
+        assert open(file_path).read() == json.dumps(submissions + new_submissions, indent=4)
+        assert self.survey.last_download['delta']
+        assert self.survey.last_download['submissions'] == 2
+        assert self.survey.last_download['last_submission_time'] == '2021-01-04T10:00:00'
+        # the saved file is not replaced until the resource is updated
+        assert json.load(open(saved_file_path)) == submissions
+        self.survey.save_json_data(file_path)
+        assert json.load(open(saved_file_path)) == submissions + new_submissions
+        assert os.listdir(os.path.join(self.destination, '.staging')) == []
+
+    @responses.activate
+    def test_download_json_data_delta_discarded(self):
+        submissions = [self._submission(day) for day in [1, 2]]
+        since = '2021-01-02T10:00:00'
+        self._add_data_pages([submissions])
+        self._add_data_pages([[self._submission(3)]], query={'_submission_time': {'$gt': since}})
+        saved_file_path = self.survey.save_json_data(
+            self.survey.download_json_data(self.destination, 'resource')
+        )
+
+        file_path = self.survey.download_json_data(self.destination, 'resource', since=since)
+        self.survey.discard_json_data(file_path)
+
+        # the next delta sync starts again from the saved file
+        assert not os.path.exists(file_path)
+        assert json.load(open(saved_file_path)) == submissions
+
+    @responses.activate
+    def test_download_json_data_delta_without_file(self):
+        self._add_data_pages([[self._submission(1)]])
+
+        self.survey.download_json_data(self.destination, 'resource', since='2021-01-01T10:00:00')
+
+        # a full download is done
+        assert not self.survey.last_download['delta']
+        assert self.survey.last_download['submissions'] == 1
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+
+class TestKoBoSubmissionTimes(object):
+
+    def setup(self):
+        self.kobo_api = KoBoAPI('token', 'https://kobo.unhcr.org')
+        self.kobo_api.cache = FakeRedis()
+
+    def _add_asset(self, last_submission_time):
+        responses.add(
+            responses.GET, 'https://kobo.unhcr.org/me',
+            json={'username': 'kobo-user'},
+        )
+        responses.add(
+            responses.GET, 'https://kobo.unhcr.org/api/v2/assets/asset-id.json',
+            json={'uid': 'asset-id', 'deployment__last_submission_time': last_submission_time},
+        )
+
+    def _add_edge_submission(self, direction, submission_time):
+        url = 'https://kobo.unhcr.org/api/v2/assets/asset-id/data.json?sort={}&limit=1&fields={}'.format(
+            quote(json.dumps({'_submission_time': direction})),
+            quote(json.dumps(['_submission_time'])),
+        )
+        results = [{'_submission_time': submission_time}] if submission_time else []
+        responses.add(responses.GET, url, json={'results': results}, match_querystring=True)
+
+    def _data_calls(self):
+        return [call for call in responses.calls if '/data.json' in call.request.url]
+
+    @responses.activate
+    def test_submission_times(self):
+        self._add_asset('2021-01-07T10:00:00')
+        self._add_edge_submission(1, '2021-01-01T10:00:00')
+        self._add_edge_submission(-1, '2021-01-07T10:00:00')
+
+        survey = KoBoSurvey('asset-id', self.kobo_api)
+
+        assert survey.get_submission_times() == ('2021-01-01T10:00:00', '2021-01-07T10:00:00')
+        # only the first and the last submissions are requested
+        assert len(self._data_calls()) == 2
+
+    @responses.activate
+    def test_submission_times_no_submissions(self):
+        self._add_asset(None)
+        self._add_edge_submission(1, None)
+
+        survey = KoBoSurvey('asset-id', self.kobo_api)
+
+        assert survey.get_submission_times() == (None, None)
+        assert len(self._data_calls()) == 1
+
+    @responses.activate
+    def test_submission_times_cached_until_new_submission(self):
+        self._add_asset('2021-01-07T10:00:00')
+        self._add_edge_submission(1, '2021-01-01T10:00:00')
+        self._add_edge_submission(-1, '2021-01-07T10:00:00')
+        KoBoSurvey('asset-id', self.kobo_api).get_submission_times()
+
+        # unchanged survey: only the asset is requested
+        times = KoBoSurvey('asset-id', self.kobo_api).get_submission_times()
+        assert times == ('2021-01-01T10:00:00', '2021-01-07T10:00:00')
+        assert len(self._data_calls()) == 2
+
+        # new submission: the cached range is not valid anymore
+        responses.reset()
+        self._add_asset('2021-01-09T10:00:00')
+        self._add_edge_submission(1, '2021-01-01T10:00:00')
+        self._add_edge_submission(-1, '2021-01-09T10:00:00')
+        times = KoBoSurvey('asset-id', self.kobo_api).get_submission_times()
+        assert times == ('2021-01-01T10:00:00', '2021-01-09T10:00:00')
+        assert len(self._data_calls()) == 2
+
+
+class TestKoBoRequests(object):
+
+    def setup(self):
+        get_redis().delete(rate_limit.KEY_PREFIX + 'bucket')
+
+    def test_session_shared(self):
+        kobo_api_1 = KoBoAPI('token-1', 'https://kobo.unhcr.org')
+        kobo_api_2 = KoBoAPI('token-2', 'https://kobo.unhcr.org')
+
+        assert get_session() is get_session()
+        adapter = get_session().get_adapter('https://kobo.unhcr.org')
+        assert adapter.max_retries.total == 3
+        assert 429 in adapter.max_retries.status_forcelist
+        # and the Redis connection pool
+        assert kobo_api_1.cache.connection_pool is kobo_api_2.cache.connection_pool
+
+    @responses.activate
+    def test_request_timeout_and_token(self):
+        responses.add(responses.GET, 'https://kobo.unhcr.org/api/v2/assets/asset-id.json', json={'uid': 'asset-id'})
+        kobo = KoBoAPI('token', 'https://kobo.unhcr.org')
+
+        with mock.patch.object(get_session(), 'request', wraps=get_session().request) as request:
+            kobo._get('assets/asset-id.json', force=True)
+
+        assert request.call_args[1]['timeout'] == (10, 60)
+        assert request.call_args[1]['headers'] == {'Authorization': 'Token token'}
+
+    @responses.activate
+    def test_post_connection_error(self):
+        url = 'https://kobo.unhcr.org/api/v2/assets/asset-id/exports/?format=json'
+        responses.add(responses.POST, url, body=ConnectionError('Connection refused'))
+        kobo = KoBoAPI('token', 'https://kobo.unhcr.org')
+
+        with pytest.raises(KoboApiError):
+            kobo._post(url, {'type': 'json'})
+
+    @pytest.mark.ckan_config('ckanext.unhcr.kobo_rate_limit', '10')
+    @pytest.mark.ckan_config('ckanext.unhcr.kobo_rate_limit_burst', '2')
+    def test_rate_limit(self):
+        now = 1000
+        waits = [rate_limit.acquire('bucket', now=now) for i in range(4)]
+        assert waits == [0, 0, pytest.approx(0.1), pytest.approx(0.2)]
+
+        # the bucket is refilled over time
+        assert rate_limit.acquire('bucket', now=now + 10) == 0
+
+    @pytest.mark.ckan_config('ckanext.unhcr.kobo_rate_limit', '10')
+    @pytest.mark.ckan_config('ckanext.unhcr.kobo_rate_limit_burst', '1')
+    def test_rate_limit_max_wait(self):
+        now = 1000
+        assert rate_limit.acquire('bucket', now=now, max_wait=0.15) == 0
+        assert rate_limit.acquire('bucket', now=now, max_wait=0.15) == pytest.approx(0.1)
+        # too long, so no token is reserved
+        assert rate_limit.acquire('bucket', now=now, max_wait=0.15) == pytest.approx(0.2)
+        assert rate_limit.acquire('bucket', now=now, max_wait=0.15) == pytest.approx(0.2)
+
+    @pytest.mark.ckan_config('ckanext.unhcr.kobo_rate_limit_max_wait', '5')
+    def test_throttle_max_wait(self):
+        with mock.patch.object(rate_limit, 'acquire', return_value=30), \
+                mock.patch.object(rate_limit.time, 'sleep') as sleep:
+            with pytest.raises(KoboApiError):
+                rate_limit.throttle('bucket')
+            assert not sleep.called
+
+            # background jobs wait for their turn
+            with mock.patch.object(rate_limit, 'get_current_job', return_value=mock.Mock()):
+                rate_limit.throttle('bucket')
+            sleep.assert_called_once_with(30)
+
+    @pytest.mark.ckan_config('ckanext.unhcr.kobo_rate_limit', '0')
+    def test_rate_limit_disabled(self):
+        assert [rate_limit.acquire('bucket', now=1000) for i in range(20)] == [0] * 20
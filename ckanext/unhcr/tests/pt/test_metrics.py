@@ -1,9 +1,14 @@
+import datetime
 import json
+import mock
 import pytest
 from pathlib import Path
+from ckan import model
+from ckan.plugins import toolkit
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr.tests import factories
 from ckanext.unhcr.activity import create_download_activity
+from ckanext.unhcr.models import TimeSeriesMetric
 import ckanext.unhcr.metrics as metrics
 
 
@@ -212,3 +217,161 @@ class TestMetrics:
             self.users[1]['fullname'] not in
             [row['display_name'] for row in table['data']]
         )
+
+    def test_get_users_by_datasets_total(self):
+        table = metrics.get_users_by_datasets({'user': self.sysadmin['name']})
+
+        users = toolkit.get_action('user_list')({'ignore_auth': True}, {})
+        assert table['total'] == len(users)
+
+    def test_get_metrics(self):
+        panels = metrics.get_metrics()
+
+        assert [panel['id'] for panel in panels] == [
+            'total-number-of-datasets',
+            'datasets-by-downloads',
+            'total-number-of-containers',
+            'downloads-and-active-users',
+            'deposits-by-curation-state',
+            'data-containers',
+            'tags',
+            'keywords',
+            'users-by-datasets-created',
+            'users-by-downloads',
+        ]
+        assert panels[1] == metrics.get_datasets_by_downloads({'user': self.sysadmin['name']})
+
+    def test_get_metrics_cached(self):
+        panels = metrics.get_metrics()
+
+        with mock.patch.object(metrics, '_compute_panels') as compute:
+            assert metrics.get_metrics() == panels
+        assert compute.call_count == 0
+
+    @pytest.mark.ckan_config('ckanext.unhcr.metrics_cache_seconds.tags', 0)
+    def test_get_metrics_panel_ttl(self):
+        metrics.get_metrics()
+
+        with mock.patch.object(
+            metrics, '_compute_panels', wraps=metrics._compute_panels
+        ) as compute:
+            metrics.get_metrics()
+        assert [key for key, _, _ in compute.call_args[0][0]] == ['tags']
+
+    def test_get_metrics_permission_scope(self):
+        factories.Dataset(
+            private=True,
+            tags=[{'name': 'secret'}],
+            owner_org=self.containers[1]['id'],
+        )
+        curator = core_factories.User()
+        toolkit.get_action('organization_member_create')(
+            {'ignore_auth': True},
+            {'id': 'data-deposit', 'username': curator['name'], 'role': 'editor'},
+        )
+
+        tags = [row['name'] for row in metrics.get_metrics()[6]['data']]
+        assert 'secret' in tags
+
+        # the curator can't see the private dataset, nor get the cached panel
+        curator_obj = model.User.get(curator['id'])
+        tags = [row['name'] for row in metrics.get_metrics(curator_obj)[6]['data']]
+        assert 'secret' not in tags
+
+        # the sysadmin scope is shared with the CLI (no user)
+        sysadmin_obj = model.User.get(self.sysadmin['id'])
+        assert metrics.get_permission_scope(sysadmin_obj) == metrics.get_permission_scope(None)
+        assert metrics.get_permission_scope(curator_obj) != metrics.get_permission_scope(None)
+
+    def test_get_metrics_refresh(self):
+        metrics.get_metrics()
+
+        with mock.patch.object(
+            metrics, '_compute_panels', wraps=metrics._compute_panels
+        ) as compute:
+            metrics.get_metrics(refresh=True)
+        assert len(compute.call_args[0][0]) == len(metrics.METRICS_PANELS)
+
+    @pytest.mark.usefixtures('with_request_context')
+    @pytest.mark.ckan_config('ckanext.unhcr.metrics_workers', 4)
+    def test_get_metrics_thread_pool(self):
+        with mock.patch.object(
+            metrics, '_compute_panel', wraps=metrics._compute_panel
+        ) as compute_panel:
+            panels = metrics.get_metrics(refresh=True)
+        assert compute_panel.call_count == len(metrics.METRICS_PANELS)
+
+        with mock.patch('flask.has_app_context', return_value=False):
+            assert metrics.get_metrics(refresh=True) == panels
+
+    def test_take_snapshot(self):
+        rec = metrics.take_snapshot()
+
+        assert rec.datasets_count == 4
+        assert rec.deposits_count == 1
+        assert rec.deposits_draft_count == 1
+        assert rec.deposits_submitted_count == 0
+        assert rec.deposits_review_count == 0
+        # data-target, data-deposit and the two containers
+        assert rec.containers_count == 4
+        assert rec.downloads_count == 6
+        assert rec.kobo_imports_count == 0
+        assert rec.active_users_count >= 2
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestTimeSeries:
+    def setup(self):
+        for timestamp, count in [
+            (datetime.datetime(2021, 12, 31, 10), 1),
+            (datetime.datetime(2022, 1, 3, 10), 2),
+            (datetime.datetime(2022, 1, 3, 20), 3),
+            (datetime.datetime(2022, 1, 5, 10), 4),
+            (datetime.datetime(2022, 2, 1, 10), 5),
+        ]:
+            model.Session.add(TimeSeriesMetric(
+                timestamp=timestamp, datasets_count=count, deposits_count=count * 10
+            ))
+        model.Session.commit()
+
+    def test_get_timeseries_by_day(self):
+        rows = metrics.get_timeseries(['datasets_count', 'deposits_count'])
+
+        assert rows == [
+            (datetime.date(2021, 12, 31), {'datasets_count': 1, 'deposits_count': 10}),
+            (datetime.date(2022, 1, 3), {'datasets_count': 3, 'deposits_count': 30}),
+            (datetime.date(2022, 1, 5), {'datasets_count': 4, 'deposits_count': 40}),
+            (datetime.date(2022, 2, 1), {'datasets_count': 5, 'deposits_count': 50}),
+        ]
+
+    def test_get_timeseries_by_week(self):
+        rows = metrics.get_timeseries(['datasets_count'], bucket='week')
+
+        # weeks start on monday
+        assert rows == [
+            (datetime.date(2021, 12, 27), {'datasets_count': 1}),
+            (datetime.date(2022, 1, 3), {'datasets_count': 4}),
+            (datetime.date(2022, 1, 31), {'datasets_count': 5}),
+        ]
+
+    def test_get_timeseries_by_month(self):
+        rows = metrics.get_timeseries(['datasets_count'], bucket='month')
+
+        assert rows == [
+            (datetime.date(2021, 12, 1), {'datasets_count': 1}),
+            (datetime.date(2022, 1, 1), {'datasets_count': 4}),
+            (datetime.date(2022, 2, 1), {'datasets_count': 5}),
+        ]
+
+    def test_get_timeseries_date_range(self):
+        rows = metrics.get_timeseries(
+            ['datasets_count'],
+            start=datetime.date(2022, 1, 1),
+            end=datetime.date(2022, 1, 3),
+        )
+
+        assert rows == [(datetime.date(2022, 1, 3), {'datasets_count': 3})]
+
+    def test_get_timeseries_invalid_bucket(self):
+        with pytest.raises(toolkit.ValidationError):
+            metrics.get_timeseries(['datasets_count'], bucket='year')
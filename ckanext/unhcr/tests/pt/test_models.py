@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from ckanext.unhcr.models import get_geography_vocab, get_parent_pcodes, resolve_geographies
+from ckanext.unhcr.tests import factories
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestResolveGeographies(object):
+
+    def setup(self):
+        factories.Geography(
+            pcode='IRQ',
+            iso3='IRQ',
+            gis_name='Iraq',
+            layer='wrl_polbnd_int_1m_a_unhcr',
+            hierarchy_pcode='IRQ',
+        )
+        factories.Geography(
+            pcode='20IRQ015',
+            iso3='IRQ',
+            gis_name='Ninewa',
+            layer='wrl_polbnd_adm1_a_unhcr',
+            hierarchy_pcode='20IRQ015',
+        )
+        factories.Geography(
+            pcode='20IRQ015004',
+            iso3='IRQ',
+            gis_name='Mosul',
+            layer='wrl_polbnd_adm2_a_unhcr',
+            hierarchy_pcode='20IRQ015004',
+        )
+        factories.Geography(
+            pcode='IRQr000019225',
+            iso3='IRQ',
+            gis_name='Mosul',
+            hierarchy_pcode='20IRQ015004159',
+        )
+        factories.Geography(
+            pcode='20IRQ016',
+            iso3='IRQ',
+            gis_name='Old Province',
+            gis_status='inactive',
+            layer='wrl_polbnd_adm1_a_unhcr',
+            hierarchy_pcode='20IRQ016',
+        )
+        factories.Geography(
+            pcode='IRQr000019226',
+            iso3='IRQ',
+            gis_name='Village',
+            hierarchy_pcode='20IRQ016001159',
+        )
+
+    def test_get_parent_pcodes(self):
+        assert get_parent_pcodes('20IRQ015004159') == ['20IRQ015004', '20IRQ015', 'IRQ']
+        assert get_parent_pcodes('20IRQ015') == ['IRQ']
+        assert get_parent_pcodes('IRQ') == []
+
+    def test_resolve_geographies(self):
+        resolved = resolve_geographies(['IRQr000019225', '20IRQ015', 'not-a-pcode'])
+        assert sorted(resolved.keys()) == ['20IRQ015', 'IRQr000019225']
+
+        geog, parents = resolved['IRQr000019225']
+        assert geog.gis_name == 'Mosul'
+        assert [p.pcode for p in parents] == ['20IRQ015004', '20IRQ015', 'IRQ']
+
+        geog, parents = resolved['20IRQ015']
+        assert [p.pcode for p in parents] == ['IRQ']
+
+    def test_resolve_geographies_matches_parents(self):
+        resolved = resolve_geographies(['IRQr000019225', 'IRQr000019226'])
+        for geog, parents in resolved.values():
+            assert [p.pcode for p in parents] == [p.pcode for p in geog.parents]
+
+    def test_resolve_geographies_skips_inactive_parents(self):
+        resolved = resolve_geographies(['IRQr000019226'])
+        geog, parents = resolved['IRQr000019226']
+        assert [p.pcode for p in parents] == ['IRQ']
+
+    def test_resolve_geographies_without_parents(self):
+        resolved = resolve_geographies(['IRQr000019225'], include_parents=False)
+        assert resolved['IRQr000019225'][1] == []
+
+    def test_get_geography_vocab(self):
+        names, pcodes = get_geography_vocab(['IRQr000019225', 'not-a-pcode', '20IRQ015'])
+        assert names == ['Mosul', 'Mosul', 'Ninewa', 'Iraq', 'Ninewa', 'Iraq']
+        assert pcodes == ['IRQr000019225', '20IRQ015004', '20IRQ015', 'IRQ', '20IRQ015', 'IRQ']
+
+    def test_dictize_with_resolved_parents(self):
+        geog, parents = resolve_geographies(['IRQr000019225'])['IRQr000019225']
+        dct = geog.dictize(include_parents=True, parents=parents)
+        assert dct['name'] == geog.display_full_name
+        assert [p['pcode'] for p in dct['parents']] == ['20IRQ015004', '20IRQ015', 'IRQ']
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+from ckan import model
+import ckan.plugins as plugins
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import permission_labels
+from ckanext.unhcr.tests import factories
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate', 'with_request_context')
+class TestUserDatasetLabels(object):
+
+    def setup(self):
+        self.plugin = plugins.get_plugin('unhcr')
+        self.deposit = factories.DataContainer(id='data-deposit', name='data-deposit')
+        self.user = core_factories.User()
+        self.container = factories.DataContainer(
+            users=[{'name': self.user['name'], 'capacity': 'admin'}]
+        )
+        self.user_obj = model.User.get(self.user['id'])
+
+    def _compute_calls(self):
+        return mock.patch.object(
+            self.plugin,
+            '_get_user_dataset_labels',
+            wraps=self.plugin._get_user_dataset_labels,
+        )
+
+    def test_labels(self):
+        labels = self.plugin.get_user_dataset_labels(self.user_obj)
+        assert 'creator-{}'.format(self.user['id']) in labels
+        assert 'member-{}'.format(self.container['id']) in labels
+        assert 'deposited-dataset-{}'.format(self.container['id']) in labels
+
+    def test_memoized_per_request(self):
+        with self._compute_calls() as compute:
+            first = self.plugin.get_user_dataset_labels(self.user_obj)
+            second = self.plugin.get_user_dataset_labels(self.user_obj)
+        assert first == second
+        assert compute.call_count == 1
+
+    def test_member_create_invalidates(self):
+        container = factories.DataContainer()
+        self.plugin.get_user_dataset_labels(self.user_obj)
+        toolkit.get_action('organization_member_create')(
+            {'ignore_auth': True},
+            {'id': container['id'], 'username': self.user['name'], 'role': 'editor', 'not_notify': True}
+        )
+        labels = self.plugin.get_user_dataset_labels(self.user_obj)
+        assert 'member-{}'.format(container['id']) in labels
+
+    def test_member_delete_invalidates(self):
+        self.plugin.get_user_dataset_labels(self.user_obj)
+        toolkit.get_action('organization_member_delete')(
+            {'ignore_auth': True},
+            {'id': self.container['id'], 'user_id': self.user['id'], 'not_notify': True}
+        )
+        labels = self.plugin.get_user_dataset_labels(self.user_obj)
+        assert 'member-{}'.format(self.container['id']) not in labels
+
+    @pytest.mark.ckan_config('ckanext.unhcr.permission_labels_cache', True)
+    def test_plain_member_delete_invalidates(self):
+        permission_labels.invalidate_user_labels()
+        self.plugin.get_user_dataset_labels(self.user_obj)
+        toolkit.get_action('member_delete')(
+            {'ignore_auth': True},
+            {'id': self.container['id'], 'object': self.user['id'], 'object_type': 'user'}
+        )
+        permission_labels._get_request_memo().clear()
+        labels = self.plugin.get_user_dataset_labels(self.user_obj)
+        assert 'member-{}'.format(self.container['id']) not in labels
+
+    @pytest.mark.ckan_config('ckanext.unhcr.permission_labels_cache', True)
+    def test_organization_purge_invalidates(self):
+        permission_labels.invalidate_user_labels()
+        self.plugin.get_user_dataset_labels(self.user_obj)
+        toolkit.get_action('organization_purge')({'ignore_auth': True}, {'id': self.container['id']})
+        permission_labels._get_request_memo().clear()
+        labels = self.plugin.get_user_dataset_labels(self.user_obj)
+        assert 'member-{}'.format(self.container['id']) not in labels
+
+    @pytest.mark.ckan_config('ckanext.unhcr.permission_labels_cache', True)
+    def test_redis_cache(self):
+        permission_labels.invalidate_user_labels()
+        labels = self.plugin.get_user_dataset_labels(self.user_obj)
+        assert permission_labels.get_labels_cache().get(self.user_obj.id) == labels
+
+        # a new request (empty memo) reads the cache
+        permission_labels._get_request_memo().clear()
+        with self._compute_calls() as compute:
+            assert self.plugin.get_user_dataset_labels(self.user_obj) == labels
+        assert compute.call_count == 0
+
+        permission_labels.invalidate_user_labels()
+        assert permission_labels.get_labels_cache().get(self.user_obj.id) is None
+
+    def test_anonymous(self):
+        assert self.plugin.get_user_dataset_labels(None) == ['public']
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestDatasetLabels(object):
+
+    def setup(self):
+        self.plugin = plugins.get_plugin('unhcr')
+        self.deposit = factories.DataContainer(id='data-deposit', name='data-deposit')
+        self.target = factories.DataContainer()
+        self.dataset = factories.DepositedDataset(
+            owner_org=self.deposit['id'],
+            owner_org_dest=self.target['id'],
+        )
+
+    def test_deposited_dataset_labels(self):
+        dataset_obj = model.Package.get(self.dataset['id'])
+        with mock.patch('ckan.plugins.toolkit.get_action', wraps=toolkit.get_action) as get_action:
+            labels = self.plugin.get_dataset_labels(dataset_obj)
+        assert not any(call[0][0] == 'package_show' for call in get_action.call_args_list)
+        assert labels == [
+            'deposited-dataset',
+            'creator-{}'.format(self.dataset['creator_user_id']),
+            'deposited-dataset-{}'.format(self.target['id']),
+        ]
+
+    def test_deposited_dataset_labels_unknown_target(self):
+        dataset = factories.DepositedDataset(
+            owner_org=self.deposit['id'],
+            owner_org_dest='unknown',
+        )
+        labels = self.plugin.get_dataset_labels(model.Package.get(dataset['id']))
+        assert labels == [
+            'deposited-dataset',
+            'creator-{}'.format(dataset['creator_user_id']),
+        ]
+
+    def test_deposited_dataset_labels_cached_by_metadata_modified(self):
+        dataset_obj = model.Package.get(self.dataset['id'])
+        self.plugin.get_dataset_labels(dataset_obj)
+        with mock.patch.object(permission_labels, 'get_owner_org_dest') as get_owner_org_dest:
+            self.plugin.get_dataset_labels(dataset_obj)
+        assert get_owner_org_dest.call_count == 0
+
+        target = factories.DataContainer()
+        toolkit.get_action('package_patch')(
+            {'ignore_auth': True},
+            {'id': self.dataset['id'], 'owner_org_dest': target['id']}
+        )
+        labels = self.plugin.get_dataset_labels(model.Package.get(self.dataset['id']))
+        assert 'deposited-dataset-{}'.format(target['id']) in labels
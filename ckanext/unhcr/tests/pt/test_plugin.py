@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import json
 import pytest
 import mock
+import ckan.plugins as plugins
 from ckan.plugins import toolkit
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr.models import DEFAULT_GEOGRAPHY_CODE
@@ -206,3 +208,19 @@ class TestHooks(object):
         action = toolkit.get_action("package_delete")
         action({'user': self.user['name'], 'job': True}, self.dataset)
         mock_hook.assert_not_called()
+
+    def test_before_index_select_labels(self):
+        plugin = plugins.get_plugin('unhcr')
+        pkg_dict = plugin.before_index({
+            'id': self.dataset['id'],
+            'type': 'dataset',
+            'keywords': json.dumps(['1', ['1'], {'value': '1'}]),
+        })
+        assert pkg_dict['vocab_keywords'] == ['Health and Nutrition']
+
+        pkg_dict = plugin.before_index({
+            'id': self.dataset['id'],
+            'type': 'dataset',
+            'keywords': '5',
+        })
+        assert pkg_dict['vocab_keywords'] == []
@@ -1,11 +1,10 @@
 # -*- coding: utf-8 -*-
 
-import datetime
 import pytest
 from ckan.plugins import toolkit
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr.tests import factories
-from ckanext.unhcr import utils
+from ckanext.unhcr import helpers, scan_status, utils
 
 
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
@@ -30,66 +29,46 @@ class TestUtils(object):
             resource['id']
         )
 
-    def test_resource_is_blocked_task_status_ok(self):
+    def test_resource_is_blocked_scan_clean(self):
         user = core_factories.User()
         dataset = factories.Dataset()
         resource = factories.Resource(
             package_id=dataset['id'],
             url_type='upload',
         )
-        toolkit.get_action('task_status_update')(
-            {
-                'ignore_auth': True,
-                # task_status_update wants a user object
-                # for no reason, even with 'ignore_auth': True
-                # give it an empty string to keep it happy
-                'user': ''
-            },
-            {
-                'entity_id': resource['id'],
-                'entity_type': 'resource',
-                'task_type': 'clamav',
-                'last_updated': datetime.datetime.utcnow().isoformat(),
-                'state': 'complete',
-                'key': 'clamav',
-                'value': '{"data": {"status_code": 0}}',
-                'error': 'null',
-            }
-        )
+        scan_status.set_verdict(resource['id'], infected=False)
 
         assert not utils.resource_is_blocked(
             {'user': user['name']},
             resource['id']
         )
 
-    def test_resource_is_blocked_task_status_infected(self):
+    def test_resource_is_blocked_scan_infected(self):
         user = core_factories.User()
         dataset = factories.Dataset()
         resource = factories.Resource(
             package_id=dataset['id'],
             url_type='upload',
         )
-        toolkit.get_action('task_status_update')(
-            {
-                'ignore_auth': True,
-                # task_status_update wants a user object
-                # for no reason, even with 'ignore_auth': True
-                # give it an empty string to keep it happy
-                'user': ''
-            },
-            {
-                'entity_id': resource['id'],
-                'entity_type': 'resource',
-                'task_type': 'clamav',
-                'last_updated': datetime.datetime.utcnow().isoformat(),
-                'state': 'complete',
-                'key': 'clamav',
-                'value': '{"data": {"status_code": 1}}',
-                'error': 'null',
-            }
-        )
+        scan_status.set_verdict(resource['id'], infected=True)
 
         assert utils.resource_is_blocked(
             {'user': user['name']},
             resource['id']
         )
+
+    def test_blocked_resource_ids(self):
+        dataset = factories.Dataset()
+        resources = [
+            factories.Resource(package_id=dataset['id'], url_type='upload')
+            for i in range(3)
+        ]
+        scan_status.set_verdict(resources[0]['id'], infected=True)
+        scan_status.set_verdict(resources[1]['id'], infected=False)
+        dataset = toolkit.get_action('package_show')({'ignore_auth': True}, {'id': dataset['id']})
+
+        assert helpers.get_blocked_resource_ids(dataset) == {resources[0]['id']}
+
+        # a new verdict replaces the previous one
+        scan_status.set_verdict(resources[0]['id'], infected=False)
+        assert helpers.get_blocked_resource_ids(dataset) == set()
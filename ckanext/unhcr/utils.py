@@ -1,6 +1,6 @@
-import json
 from functools import wraps
 import ckan.plugins.toolkit as toolkit
+from ckanext.unhcr import scan_status
 # TODO: move here helpers not used in templates
 from ckanext.unhcr.helpers import user_is_editor
 
@@ -55,22 +55,8 @@ def user_is_external(user):
 
 
 def resource_is_blocked(context, resource_id):
-    try:
-        task = toolkit.get_action('task_status_show')(context, {
-            'entity_id': resource_id,
-            'task_type': 'clamav',
-            'key': 'clamav'
-        })
-        if task['state'] == 'complete' and task['value']:
-            task_data = json.loads(task['value'])
-            if task_data.get('data'):
-                scan_status = task_data.get('data').get('status_code', '')
-                if scan_status == 1:
-                    return True
-    except toolkit.ObjectNotFound:
-        pass
-
-    return False
+    """ True if the last Clam AV scan found the resource file infected """
+    return scan_status.is_infected(resource_id)
 
 
 def require_user(func):
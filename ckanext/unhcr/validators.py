@@ -6,6 +6,7 @@ from ckan.logic import validators
 from ckanext.scheming.validation import scheming_validator
 from ckanext.scheming import helpers as sh
 from ckanext.unhcr import helpers, utils
+from ckanext.unhcr.models import resolve_geographies
 log = logging.getLogger(__name__)
 
 OneOf = get_validator('OneOf')
@@ -50,10 +51,9 @@ def linked_datasets(value, context):
 
 def geographies(value, context):
     values = helpers.normalize_list(value)
+    resolved = resolve_geographies(values, include_parents=False)
     for id_ in values:
-        try:
-            toolkit.get_action('geography_show')(context, {'id': id_})
-        except toolkit.ObjectNotFound:
+        if id_ not in resolved:
             raise Invalid('Invalid Geography: {}'.format(id_))
     return values
 